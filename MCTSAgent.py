@@ -1,18 +1,93 @@
-from engine import RiskGame
+from engine import GamePool, RiskGame, REDUCED_ACTIONS
 import agent
 import helper_functions as hf
+import math
 import numpy as np
-import random
 import time
 
+class MCTSTree:
+    """A search tree kept in preallocated arrays, one entry per node. The
+    children of a node are stored next to each other, from first_child to
+    first_child + n_children, so they can be scored as one slice. Nodes only
+    hold the action id that leads to them, the states are rebuilt by 
+    replaying the actions from the root, which is determinized so replays
+    always reach the same states. An edge is a whole move made with
+    do_macro_action_id, the way the agent and the rollouts move."""
+    def __init__(self, game, capacity=1024):
+        self.pool = GamePool()
+        self.game = game.copy(True)
+        self.size = 1
+        self.n = np.zeros(capacity)
+        self.v = np.zeros((capacity, 2))
+        self.parent = np.full(capacity, -1, dtype=np.int32)
+        self.first_child = np.zeros(capacity, dtype=np.int32)
+        self.n_children = np.zeros(capacity, dtype=np.int32)
+        self.action_ids = np.full(capacity, -1, dtype=np.int32)
+    
+    def _grow(self, capacity):
+        self.n = np.resize(self.n, capacity)
+        self.v = np.resize(self.v, (capacity, 2))
+        self.parent = np.resize(self.parent, capacity)
+        self.first_child = np.resize(self.first_child, capacity)
+        self.n_children = np.resize(self.n_children, capacity)
+        self.action_ids = np.resize(self.action_ids, capacity)
+    
+    def add_children(self, node, action_ids):
+        first = self.size
+        self.size += len(action_ids)
+        if self.size > len(self.n):
+            self._grow(max(2 * len(self.n), self.size))
+        self.n[first:self.size] = 0
+        self.v[first:self.size] = 0
+        self.parent[first:self.size] = node
+        self.first_child[first:self.size] = 0
+        self.n_children[first:self.size] = 0
+        self.action_ids[first:self.size] = action_ids
+        self.first_child[node] = first
+        self.n_children[node] = len(action_ids)
+    
+    def best_child(self, node, C, column):
+        """The first unvisited child, otherwise the child with the highest 
+        UCB score, with values taken from column."""
+        first = self.first_child[node]
+        children = slice(first, first + self.n_children[node])
+        n = self.n[children]
+        i = n.argmin()
+        if n[i] == 0:
+            return first + i
+        scores = self.v[children, column] / n + C * np.sqrt((2 * math.log(self.n[node])) / n)
+        return first + scores.argmax()
+    
+    def replay(self, path):
+        """A determinized game at the last node of path, taken from the pool
+        of the tree."""
+        game = self.pool.copy(self.game, True)
+        for node in path[1:]:
+            game.do_macro_action_id(self.action_ids[node])
+        return game
+    
+    def release(self, game):
+        self.pool.release(game)
+    
+    def backpropogate(self, path, scores):
+        self.n[path] += 1.0
+        self.v[path] += scores
+
 class MCTSAgent(agent.BaseAgent):
-    def __init__(self, n_simulations_per_move, n_steps, proj_n_turns, C, logfile="mcts_log.log"):
+    def __init__(self, n_simulations_per_move, n_steps, proj_n_turns, C, logfile="mcts_log.log", time_limit=None, max_nodes=None):
+        """Each move is searched in a single tree until the first budget runs
+        out: n_simulations_per_move, time_limit seconds or max_nodes nodes.
+        Budgets that are None are unlimited."""
         super().__init__()
+        assert n_simulations_per_move is not None or time_limit is not None or max_nodes is not None
         self.n_simulations_per_move = n_simulations_per_move
+        self.time_limit = time_limit
+        self.max_nodes = max_nodes
         self.n_steps = n_steps
         self.proj_n_turns = proj_n_turns
         self.C = C
         self.logfile_path = logfile
+        self.pool = GamePool()
         
         with open(logfile, "w") as f:
             pass
@@ -25,124 +100,104 @@ class MCTSAgent(agent.BaseAgent):
         with open(outfile_path, "w") as f:
             f.write(s)
     
-    def get_legal_moves(self, game):
-        return hf.get_reduced_actions(game)
+    def get_legal_move_ids(self, game):
+        return game.get_pruned_action_ids(REDUCED_ACTIONS)
+    
+    def do_actions_to_game(self, action, game):
+        #The same transition as the edges of the tree
+        game.do_macro_action_id(game.encode_action(action))
     
     def log(self, msg):
         with open(self.logfile_path, "a") as f:
             f.write(msg + "\n")
     
     def recompute_actions(self):
-        self.actions = hf.get_reduced_actions(self.game)
-        trees = []
-        best_score = float('-inf')
-        best_action = None
-        scores = []
+        action_ids = self.get_legal_move_ids(self.game)
+        if len(action_ids) == 1:
+            self.actions = [self.game.decode_action(action_ids[0])]
+            return
         
-        for action in self.actions:
-            game_copy = self.game.copy(True)
-            self.do_actions_to_game(action, game_copy)
-            trees.append(self.mcts_tree(self.n_simulations_per_move, game_copy))
-            score = trees[-1]["v"][0]
-            scores.append(score / self.n_simulations_per_move)
-            if score > best_score:
-                best_score = score
-                best_action = action
-
-        scores = sorted(scores, reverse=True)
+        deadline = None if self.time_limit is None else time.perf_counter() + self.time_limit
+        tree = self.mcts_tree(self.n_simulations_per_move, self.game, deadline, self.max_nodes)
+        first = tree.first_child[0]
+        children = slice(first, first + tree.n_children[0])
+        n = tree.n[children]
+        means = tree.v[children, 0] / np.maximum(n, 1)
+        #The most visited action, the best mean breaks ties
+        best = np.lexsort((means, n))[-1]
+        
+        scores = np.sort(means[n > 0])[::-1]
         if len(scores) > 1:
             diff = scores[0] - scores[1]
             lowest_diff = scores[0] - scores[-1]
         else:
             diff = 0
             lowest_diff = 0
-        self.log("{:.5f}, {:.5f}, {:.5f}".format(scores[0], diff, lowest_diff))
-        self.actions = [best_action]
+        self.log("{:.5f}, {:.5f}, {:.5f}, {}".format(scores[0], diff, lowest_diff, int(tree.n[0])))
+        self.actions = [self.game.decode_action(tree.action_ids[first + best])]
     
-    def mcts_tree(self, n_simulations, game):
-        root = {"v": [0.0, 0.0], "n": 0.0, "children": {}, "game": game.copy(True), "parent": None}
+    def mcts_tree(self, n_simulations, game, deadline=None, max_nodes=None):
+        """Searches from game until the first budget runs out: n_simulations,
+        the time.perf_counter deadline or max_nodes nodes in the tree. None
+        leaves a budget unlimited, at least one simulation is always run."""
+        tree = MCTSTree(game)
         self.root_statistics = []
         self.player = game.get_player_turn()
         
-        for i in range(n_simulations):
-            leaf = self.tree_policy(root)
-            scores = self.simulate(leaf)
-            self.backpropogation(leaf, scores)
-            
-        return root
-        
-    def tree_policy(self, node):
-        while not node["game"].has_finished():
-            if len(node["children"]) == 0:
-                return self.expand(node)
-            else:
-                node = self.best_child(node)
-        return node
-    
-    def best_child(self, node):
-        best_score = float('-inf')
-        best_move = None
-        
-        for move in node["children"]:
-            child = node["children"][move]
-            if child["n"] == 0:
-                return child
-            else:
-                if node["game"].get_player_turn() == self.player:
-                    child_v = child["v"][0]
-                else:
-                    child_v = child["v"][1]
-
-                score = child_v / child["n"] + self.C * np.sqrt((2 * np.log(node["n"])) / child["n"])
-                if score > best_score:
-                    best_score = score
-                    best_move = move
-        return node["children"][best_move]
-    
-    def expand(self, node):
-        legal_moves = self.get_legal_moves(node["game"])
-        for move in legal_moves:
-            game_copy = node["game"].copy(True)
-            self.do_actions_to_game(move, game_copy)
-            node["children"][move] = {"v": [0.0, 0.0], "n": 0.0, "children": {}, "game": game_copy, "parent": node}
-        move = random.choice(legal_moves)
-        return node["children"][move]
-    
-    def simulate(self, node):
-        game_copy = node["game"].copy(False)
-        deterministic_agent = agent.DeterministicAgent()
-        deterministic_agent.set_game(game_copy)
         i = 0
-        while not game_copy.has_finished() and i < self.n_steps:
-            move = deterministic_agent.get_action()
-            deterministic_agent.do_actions_to_game(move, game_copy)
+        while True:
+            (path, game_copy) = self.tree_policy(tree)
+            scores = self.simulate(game_copy)
+            tree.release(game_copy)
+            self.backpropogation(tree, path, scores)
             i += 1
+            if ((n_simulations is not None and i >= n_simulations)
+                or (deadline is not None and time.perf_counter() >= deadline)
+                or (max_nodes is not None and tree.size >= max_nodes)):
+                break
             
-        if game_copy.has_finished():
-            return [1, 0] if game_copy.get_winner() == self.player else [0, 1]
-        else:
-            score = self.heuristic(game_copy)
-            return [score, 1 - score]
+        return tree
+        
+    def tree_policy(self, tree):
+        """Descends from the root and expands the first leaf it reaches, 
+        playing the chosen actions on a single replayed game. Returns the 
+        path of nodes and the game at its end."""
+        path = [0]
+        game = tree.replay(path)
+        while not game.has_finished():
+            node = path[-1]
+            if tree.n_children[node] == 0:
+                path.append(self.expand(tree, node, game))
+                game.do_macro_action_id(tree.action_ids[path[-1]])
+                break
+            column = 0 if game.get_player_turn() == self.player else 1
+            path.append(tree.best_child(node, self.C, column))
+            game.do_macro_action_id(tree.action_ids[path[-1]])
+        return (path, game)
+    
+    def expand(self, tree, node, game):
+        legal_move_ids = self.get_legal_move_ids(game)
+        tree.add_children(node, legal_move_ids)
+        return tree.first_child[node] + self.rng.randrange(len(legal_move_ids))
+    
+    def simulate(self, game):
+        #Plays DeterministicAgent in the engine
+        game_copy = self.pool.copy(game, False)
+        score = game_copy.rollout('greedy', self.n_steps, self.rng.getrandbits(64), self.player, self.proj_n_turns)
+        self.pool.release(game_copy)
+        return [score, 1 - score]
         
     def heuristic(self, game):
-        n_armies = hf.get_projected_n_armies(game, self.player, self.proj_n_turns)
-        all_armies = max(1, sum([hf.get_projected_n_armies(game, i, self.proj_n_turns) for i in range(game.get_n_players())]))
-        return n_armies / all_armies
+        projected = hf.evaluate_all_players(game, self.proj_n_turns)
+        return projected[self.player] / max(1, projected.sum())
         
-    def backpropogation(self, node, scores):
-        while node["parent"] is not None:
-            node["v"][0] += scores[0]
-            node["v"][1] += scores[1]
-            node["n"] += 1.0
-            node = node["parent"]
-        node["v"][0] += scores[0]
-        node["v"][1] += scores[1]
-        node["n"] += 1.0
+    def backpropogation(self, tree, path, scores):
+        tree.backpropogate(path, scores)
         self.root_statistics.append(scores[0])
         
 if __name__ == "__main__":
     game = RiskGame(6)
-    mcts_agent = MCTSAgent(50, 0, 1 / np.sqrt(2), 240)
+    mcts_agent = MCTSAgent(None, 0, 1 / np.sqrt(2), 240, time_limit=1.0)
     mcts_agent.set_game(game)
     #Agent MCTSAgent(50, 120, 1 / np.sqrt(2)) had a score of 0.500+-0.179
     
@@ -1,43 +1,70 @@
+import hashlib
+import json
+import numpy as np
+import os
+
+#Bumped whenever the layout of the compiled map cache changes
+MAP_CACHE_VERSION = 1
+
 class Graph:
     def __init__(self):
         self.G_nodes = set()
         self.G_edges = set()
         self.t = {}
         self.edge_dict = {}
+        #Sorted nodes, reset whenever a node is added
+        self.sorted_nodes = None
         
     def add_edge(self, x, y):
         self.G_edges.add((x, y))
         self.G_edges.add((y, x))
-        self.G_nodes.add(x)
-        self.G_nodes.add(y)
+        if x not in self.G_nodes or y not in self.G_nodes:
+            self.G_nodes.add(x)
+            self.G_nodes.add(y)
+            self.sorted_nodes = None
         
     def compile_edge_dict(self):
-        for t in self.get_territories():
-            self.edge_dict[t] = []
-            
-        for t in self.get_territories():
-            for (t1, t2) in self.G_edges:
-                if t == t1:
-                    self.edge_dict[t].append(t2)
-        
-        for t in self.get_territories():
-            self.edge_dict[t] = sorted(self.edge_dict[t])
-        
+        self.edge_dict = {t: [] for t in self.get_territories()}
+        for (t1, t2) in self.G_edges:
+            self.edge_dict[t1].append(t2)
+        for t in self.edge_dict:
+            self.edge_dict[t].sort()
+        
+    def set_adjacency(self, territories, neighbor_offsets, neighbors):
+        """Sets the graph from compressed sparse rows, where the neighbors of
+        territories[i] are neighbors[neighbor_offsets[i]:neighbor_offsets[i + 1]]
+        as indices into territories, which must be sorted."""
+        self.G_nodes = set(territories)
+        self.G_edges = set()
+        self.edge_dict = {}
+        self.sorted_nodes = tuple(territories)
+        for (i, t) in enumerate(territories):
+            self.edge_dict[t] = [territories[j] for j in neighbors[neighbor_offsets[i]:neighbor_offsets[i + 1]]]
+            self.G_edges.update([(t, t2) for t2 in self.edge_dict[t]])
+    
     def number_of_nodes(self):
-        return len(list(self.G_nodes))
+        return len(self.G_nodes)
     
     def nodes(self):
-        return sorted(list(self.G_nodes))
+        return self.get_territories()
     
     def get_territories(self):
-        return sorted(list(self.G_nodes))
+        if self.sorted_nodes is None:
+            self.sorted_nodes = tuple(sorted(self.G_nodes))
+        return list(self.sorted_nodes)
 
     def neighbors(self, t):
         return self.edge_dict[t]
 
 class RiskMap:
-    def __init__(self):
+    def __init__(self, map_file=None):
+        """Without a map file, this is the classic map. See load_map_file for
+        the format of map files."""
         self.m = Graph()
+        self.positions = None
+        if map_file is not None:
+            load_map_file(self, map_file)
+            return
         
         #North America
         self.m.add_edge("alaska", "northwest_territory")
@@ -294,6 +321,8 @@ class RiskMap:
         self.m.compile_edge_dict()
 
     def get_territory_positions(self, size):
+        if self.positions is not None:
+            return {t: (x * size, y * size) for (t, (x, y)) in self.positions.items()}
         relative_pos = {"alaska": (1, 1),
                "alberta": (1, 2),
                "central_america": (1, 4),
@@ -360,6 +389,99 @@ class RiskMap:
         assert len(self.continents[("asia", 7)]) == 12
         assert len(self.continents[("australia", 2)]) == 4
 
+def compile_map(data):
+    """Compiles the contents of a map file to arrays: the sorted territories,
+    their neighbors in compressed sparse rows, the continents and their 
+    members, and the positions of the territories."""
+    territories = sorted(data['territories'])
+    ids = {t: i for (i, t) in enumerate(territories)}
+    assert len(ids) == len(data['territories'])
+    
+    neighbors = [set() for _ in territories]
+    for (t1, t2) in data['edges']:
+        assert t1 != t2
+        neighbors[ids[t1]].add(ids[t2])
+        neighbors[ids[t2]].add(ids[t1])
+    neighbor_offsets = np.zeros(len(territories) + 1, dtype=np.int32)
+    neighbor_offsets[1:] = np.cumsum([len(n) for n in neighbors])
+    
+    continent_names = sorted(data['continents'])
+    members = [sorted(ids[t] for t in data['continents'][c]['territories']) for c in continent_names]
+    all_members = [i for m in members for i in m]
+    assert len(all_members) == len(set(all_members))
+    continent_offsets = np.zeros(len(continent_names) + 1, dtype=np.int32)
+    continent_offsets[1:] = np.cumsum([len(m) for m in members])
+    
+    return {'territories': np.array(territories, dtype=np.str_),
+            'neighbor_offsets': neighbor_offsets,
+            'neighbors': np.array([j for n in neighbors for j in sorted(n)], dtype=np.int32),
+            'continent_names': np.array(continent_names, dtype=np.str_),
+            'continent_bonuses': np.array([data['continents'][c]['bonus'] for c in continent_names], dtype=np.int32),
+            'continent_offsets': continent_offsets,
+            'continent_members': np.array(all_members, dtype=np.int32),
+            'positions': np.array([data['territories'][t] for t in territories], dtype=np.float64).reshape(-1, 2)}
+
+def load_compiled_map(map_file):
+    """Returns the compiled map of a map file. The compiled map is cached in
+    map_file + '.npz' and only recompiled when the map file changes."""
+    with open(map_file, 'rb') as f:
+        source = f.read()
+    digest = hashlib.sha1(source).hexdigest()
+    cache_file = map_file + '.npz'
+    
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as cache:
+            if int(cache['version']) == MAP_CACHE_VERSION and str(cache['digest']) == digest:
+                return {key: cache[key] for key in cache.files if key not in ('version', 'digest')}
+    
+    compiled = compile_map(json.loads(source))
+    try:
+        with open(cache_file, 'wb') as f:
+            np.savez(f, version=MAP_CACHE_VERSION, digest=digest, **compiled)
+    except OSError:
+        #The cache is optional, maps in read-only directories are compiled every time
+        pass
+    return compiled
+
+def load_map_file(risk_map, map_file):
+    """Loads a map file into risk_map. A map file is JSON of the form
+    
+    {"territories": {"alaska": [1, 1], ...},
+     "edges": [["alaska", "alberta"], ...],
+     "continents": {"north_america": {"bonus": 5, "territories": ["alaska", ...]}, ...}}
+    
+    where the territories map to their position for drawing, in units of 
+    1/11th of the picture, and edges go both ways."""
+    compiled = load_compiled_map(map_file)
+    territories = [str(t) for t in compiled['territories']]
+    risk_map.m.set_adjacency(territories, compiled['neighbor_offsets'].tolist(), compiled['neighbors'].tolist())
+    
+    offsets = compiled['continent_offsets'].tolist()
+    members = compiled['continent_members'].tolist()
+    risk_map.continents = {}
+    for (c, (name, bonus)) in enumerate(zip(compiled['continent_names'], compiled['continent_bonuses'])):
+        risk_map.continents[(str(name), int(bonus))] = [territories[i] for i in members[offsets[c]:offsets[c + 1]]]
+    risk_map.positions = {t: tuple(p) for (t, p) in zip(territories, compiled['positions'].tolist())}
+
+def write_map_file(risk_map, map_file):
+    """Writes a map in the format of load_map_file."""
+    risk_map.compile_edge_dict()
+    positions = risk_map.get_territory_positions(1)
+    data = {'territories': {t: list(positions[t]) for t in risk_map.get_territories()},
+            'edges': sorted((t1, t2) for (t1, t2) in risk_map.get_map().G_edges if t1 < t2),
+            'continents': {name: {'bonus': bonus, 'territories': sorted(ts)} 
+                           for ((name, bonus), ts) in sorted(risk_map.get_continents().items())}}
+    #One territory, edge or continent per line
+    lines = []
+    for key in ['territories', 'edges', 'continents']:
+        items = data[key].items() if key != 'edges' else enumerate(data[key])
+        entries = [json.dumps(value) if key == 'edges' else '{}: {}'.format(json.dumps(name), json.dumps(value)) 
+                   for (name, value) in items]
+        brackets = '[]' if key == 'edges' else '{}'
+        lines.append(' "{}": {}\n  {}{}'.format(key, brackets[0], ',\n  '.join(entries), brackets[1]))
+    with open(map_file, 'w') as f:
+        f.write('{\n' + ',\n'.join(lines) + '\n}\n')
+
 if __name__ == "__main__":
     m = RiskMap()
     m.test_map()
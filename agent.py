@@ -7,8 +7,12 @@ import random
 import time
 
 class BaseAgent:
-    def __init__(self):
+    def __init__(self, seed=None):
         self.game = None
+        self.seed(seed)
+        
+    def seed(self, seed):
+        self.rng = random.Random(seed)
     
     def set_game(self, game: RiskGame):
         self.game = game
@@ -23,26 +27,14 @@ class BaseAgent:
     
     def get_action(self):
         self.recompute_actions()
-        action = random.choice(self.actions)
+        action = self.rng.choice(self.actions)
         return action
     
     def do_actions(self, action):
         self.do_actions_to_game(action, self.game)
     
     def do_actions_to_game(self, action, game):
-        state = game.get_state()
-        if state == 'reinforcement':
-            n_armies = (game.get_n_armies_to_deploy() - 1) // 5 + 1
-            for _ in range(n_armies):
-                game.do_action(action)
-        elif state == 'attack':            
-            legal_actions = game.get_legal_actions()
-            
-            while action in legal_actions:
-                game.do_action(action)
-                legal_actions = game.get_legal_actions()
-        else:
-            game.do_action(action)
+        game.apply_turn_plan([action])
 
 class BetterAgent(BaseAgent):
     def recompute_actions(self):
@@ -58,10 +50,7 @@ class BetterAgent(BaseAgent):
             best_action = self.actions[0]
             
             for action in self.actions:
-                game_copy = self.game.copy(True)
-                player = self.game.get_player_turn()
-                game_copy.do_action(action)
-                score = game_copy.get_continent_troop_bonuses(player)
+                score = self.game.get_action_delta(action)[2]
                 if score > best_score:
                     best_action = action
                     best_score = score
@@ -71,7 +60,7 @@ class BetterAgent(BaseAgent):
 class DeterministicAgent(BaseAgent):
     def move_score(self, game, action):
         state = game.get_state()
-        score = random.random() * 0.01
+        score = self.rng.random() * 0.01
         if state == 'setup':
             pass
         elif state == 'reinforcement' or state == 'setup_deployment':
@@ -108,16 +97,18 @@ class DeterministicAgent(BaseAgent):
         self.actions = hf.eliminate_pass(self.game, self.actions)
         self.actions = [self.get_best_move()]
 
-def play_game(n_games, i, agent, verbose=False):
+def play_game(n_games, i, agent, verbose=False, seed=None):
     if verbose:
         print("Playing game {}/{}".format(i+1, n_games))
     
-    n_players = random.randint(3, 6)
+    rng = random.Random(seed)
+    n_players = rng.randint(3, 6)
 
-    game = RiskGame(n_players)
-    player = random.randint(0, n_players - 1)
+    game = RiskGame(n_players, rng.getrandbits(64))
+    player = rng.randint(0, n_players - 1)
 
-    base_agent = BaseAgent()
+    base_agent = BaseAgent(rng.getrandbits(64))
+    agent.seed(rng.getrandbits(64))
     base_agent.set_game(game)
     agent.set_game(game)
     
@@ -131,17 +122,24 @@ def play_game(n_games, i, agent, verbose=False):
             
     return 1 if game.get_winner() == player else 0
 
-def f(agent):
-    return play_game(1, 0, agent)
+def f(args):
+    (agent, seed) = args
+    return play_game(1, 0, agent, seed=seed)
+
+def get_game_seeds(n_games, seed):
+    """Every game gets its own seed, so that a run can be replayed exactly
+    no matter which worker plays which game."""
+    rng = random.Random(seed)
+    return [rng.getrandbits(64) for _ in range(n_games)]
 
-def play_n_games(n_games, agent):
+def play_n_games(n_games, agent, seed=None):
     with Pool(8) as p:
-        l = p.map(f, [agent for _ in range(n_games)])
+        l = p.map(f, [(agent, game_seed) for game_seed in get_game_seeds(n_games, seed)])
     n_wins = sum(l)
     return compute_confidence_intervals(n_wins, n_games)
 
-def play_n_games_seq(n_games, agent):
-    l = [f(agent) for _ in range(n_games)]
+def play_n_games_seq(n_games, agent, seed=None):
+    l = [f((agent, game_seed)) for game_seed in get_game_seeds(n_games, seed)]
     n_wins = sum(l)
     return compute_confidence_intervals(n_wins, n_games)
     
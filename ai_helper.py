@@ -1,4 +1,5 @@
 from RiskMap import RiskMap
+from helper_functions import BorderInfo
 import functools
 import numpy as np
 import sklearn.model_selection as skm
@@ -13,40 +14,46 @@ def get_data(states, results):
     (xs_train, xs_test, ys_train, ys_test) = skm.train_test_split(xs, ys, test_size=0.33)
     return (xs_train, xs_test, ys_train, ys_test)
 
-def get_prop_held_back_armies(game, player):
-    n_mobile_armies = sum([game.get_number_of_armies(t) - 1 for t in game.get_player_territories(player) if game.has_hostile_neighbor(t)])
-    n_held_back_armies = sum([game.get_number_of_armies(t) - 1 for t in game.get_player_territories(player) if not game.has_hostile_neighbor(t)])
+def get_prop_held_back_armies(game, player, info=None):
+    if info is None:
+        info = BorderInfo(game)
+    n_mobile_armies = info.get_n_mobile_armies(player)
+    n_held_back_armies = info.get_n_held_back_armies(player)
     
     if n_mobile_armies + n_held_back_armies > 0:
         return n_held_back_armies / (n_mobile_armies + n_held_back_armies)
     else:
         return 0
 
-def get_link_to_t_ratio(game, player):
+def get_link_to_t_ratio(game, player, info=None):
+    if info is None:
+        info = BorderInfo(game)
     n_ters = len(game.get_player_territories(player))
-    n_links = sum([len(game.get_hostile_neighbors(t)) for t in game.get_player_territories(player)])
+    n_links = info.get_n_links(player)
     return n_links / max(n_ters, 1)
 
-def get_prop_border_territories(game, player):
-    return len([1 for t in game.get_player_territories(player) if game.has_hostile_neighbor(t)]) / max(len(game.get_player_territories(player)), 1)
+def get_prop_border_territories(game, player, info=None):
+    if info is None:
+        info = BorderInfo(game)
+    return info.get_n_border_territories(player) / max(len(game.get_player_territories(player)), 1)
 
-def is_threatened(game, t):
-    hostile_neighbors = game.get_hostile_neighbors(t)
-    n_threatening_armies = sum([game.get_number_of_armies(hn) - 1 for hn in hostile_neighbors])
-    n_defending_armies = game.get_number_of_armies(t)
-    return n_threatening_armies > n_defending_armies * 0.8
+def is_threatened(game, t, info=None):
+    if info is None:
+        info = BorderInfo(game)
+    return info.is_threatened(t)
 
 def get_state(game):
     player = game.get_player_turn()
+    info = BorderInfo(game)
     _n_territories = len(game.get_player_territories(player))
     total_armies_on_board = game.get_total_armies_on_board() +  game.get_setup_armies_to_place(player) + game.get_n_armies_to_deploy()
     
     n_territories = [_n_territories]
     n_cards_in_hand = [len(game.get_player_hand(player))]
     n_armies_player = [game.get_n_player_armies(player) + game.get_setup_armies_to_place(player) + game.get_n_armies_to_deploy() / total_armies_on_board if total_armies_on_board > 0 else 0]
-    prop_border_ters = [len([1 for t in game.get_player_territories(player) if game.has_hostile_neighbor(t)]) / max(_n_territories, 1)]
-    prop_threatened_border_ters = [sum([1 for t in game.get_player_territories(player) if is_threatened(game, t)]) / _n_territories]
-    continents = get_continents()
+    prop_border_ters = [info.get_n_border_territories(player) / max(_n_territories, 1)]
+    prop_threatened_border_ters = [info.get_n_threatened(player) / _n_territories]
+    continents = sorted(game.get_continents().items())
     continent_armies = []
     bonus_card_obtained = [1 if game.get_territory_conquest_bonus() else 0]
     prop_alive_players = [game.get_n_alive_players() / game.get_n_players()]
@@ -75,8 +82,9 @@ def get_state(game):
 
 def get_state_2(game):
     player = game.get_player_turn()
-    armies = [0 for _ in range(42)]
-    ownership = [0 for _ in range(42)]
+    n_territories = len(game.get_all_territories())
+    armies = [0 for _ in range(n_territories)]
+    ownership = [0 for _ in range(n_territories)]
     n_cards_in_hand = [len(game.get_player_hand(player))]
     n_sets_traded_in = [game.get_n_sets_traded_in()]
     has_conquered_territory_this_turn = [1 if game.get_territory_conquest_bonus() else 0]
@@ -93,7 +101,7 @@ def get_state_2(game):
     prop_alive_players = [game.get_n_alive_players() / game.get_n_players()]
     n_armies_to_deploy = [game.get_n_armies_to_deploy()]
     
-    _continents = get_continents()
+    _continents = sorted(game.get_continents().items())
     continents = []
     for (continent, ts) in _continents:
         total_owned_ters = 0
@@ -0,0 +1,89 @@
+from engine import RiskGame, get_map_topology
+from RiskMap import RiskMap
+import json
+import os
+import random
+import tempfile
+import time
+
+def make_grid_map(width, height, n_continents):
+    """A width x height grid of territories, each bordering the territories
+    next to it and the one diagonally below and to the right. The grid is cut
+    into n_continents bands of rows."""
+    def name(x, y):
+        return "t_{}_{}".format(x, y)
+
+    territories = {name(x, y): [1 + 9 * x / max(width - 1, 1), 1 + 9 * y / max(height - 1, 1)]
+                   for x in range(width) for y in range(height)}
+    edges = []
+    for x in range(width):
+        for y in range(height):
+            if x + 1 < width:
+                edges.append([name(x, y), name(x + 1, y)])
+            if y + 1 < height:
+                edges.append([name(x, y), name(x, y + 1)])
+            if x + 1 < width and y + 1 < height:
+                edges.append([name(x, y), name(x + 1, y + 1)])
+    continents = {}
+    for c in range(n_continents):
+        rows = range(c * height // n_continents, (c + 1) * height // n_continents)
+        ts = [name(x, y) for x in range(width) for y in rows]
+        continents["continent_{}".format(c)] = {"bonus": max(len(ts) // 3, 1), "territories": ts}
+    return {"territories": territories, "edges": edges, "continents": continents}
+
+def time_call(f, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        f()
+    return (time.perf_counter() - start) / n
+
+def benchmark_loading(map_file, n=5):
+    """Returns the time to compile a map file and to load it from its cache."""
+    def compile_map():
+        if os.path.exists(map_file + '.npz'):
+            os.remove(map_file + '.npz')
+        RiskMap(map_file)
+    compile_time = time_call(compile_map, n)
+    load_time = time_call(lambda: RiskMap(map_file), n)
+    return (compile_time, load_time)
+
+def benchmark_playing(map_file, n_players=4, n_steps=20000, seed=0):
+    """Returns the time to start a game and the time per random action."""
+    rng = random.Random(seed)
+    game = RiskGame(n_players, seed, map_file)
+    new_game_time = time_call(lambda: game.new_game(n_players), 100)
+
+    step_time = 0
+    n = 0
+    while n < n_steps:
+        game = RiskGame(n_players, rng.getrandbits(64), map_file)
+        start = time.perf_counter()
+        while not game.has_finished() and n < n_steps:
+            game.do_action_id(rng.choice(game.get_legal_action_ids()))
+            n += 1
+        step_time += time.perf_counter() - start
+    return (new_game_time, step_time / n_steps, len(game.to_bytes()))
+
+if __name__ == "__main__":
+    #Maps larger than the engine supports are only loaded
+    sizes = [(3, 3), (4, 4), (6, 6), (7, 7), (8, 8), (16, 16), (32, 32), (64, 64)]
+
+    print("{:>6} {:>6} {:>12} {:>12} {:>12} {:>12} {:>8}".format(
+        "n_ter", "n_edge", "compile ms", "cached ms", "new_game us", "step us", "bytes"))
+    with tempfile.TemporaryDirectory() as directory:
+        for (width, height) in sizes:
+            data = make_grid_map(width, height, min(height, 6))
+            map_file = os.path.join(directory, "grid_{}x{}.json".format(width, height))
+            with open(map_file, "w") as f:
+                json.dump(data, f)
+
+            (compile_time, load_time) = benchmark_loading(map_file)
+            row = [width * height, 2 * len(data["edges"]), 1e3 * compile_time, 1e3 * load_time]
+            try:
+                get_map_topology(map_file)
+            except ValueError:
+                print("{:>6} {:>6} {:>12.2f} {:>12.2f} {:>12} {:>12} {:>8}".format(*row, "-", "-", "-"))
+            else:
+                (new_game_time, step_time, n_bytes) = benchmark_playing(map_file)
+                print("{:>6} {:>6} {:>12.2f} {:>12.2f} {:>12.1f} {:>12.2f} {:>8}".format(
+                    *row, 1e6 * new_game_time, 1e6 * step_time, n_bytes))
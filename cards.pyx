@@ -2,30 +2,50 @@ from RiskMap import RiskMap
 from itertools import combinations
 import random
 
+#Cards in a fixed order, the position of a card is its id
+CARDS = [('japan', 'horse'), ('china', 'canon'), ('ukraine', 'soldier'), 
+         ('north_africa', 'soldier'), ('congo', 'canon'), 
+         ('afghanistan', 'soldier'), ('middle_east', 'canon'), 
+         ('venezuela', 'horse'), ('southern_europe', 'soldier'),
+         ('northern_europe', 'horse'), ('greenland', 'horse'),
+         ('siam', 'horse'), ('irkutsk', 'canon'), ('india', 'horse'),
+         ('alberta', 'canon'), ('egypt', 'horse'), ('kamchatka', 'canon'),
+         ('western_europe', 'soldier'), ('indonesia', 'soldier'),
+         ('yakutsk', 'canon'), ('argentina', 'soldier'), 
+         ('eastern_australia', 'horse'), ('east_africa', 'soldier'),
+         ('western_australia', 'canon'), ('madagascar', 'horse'),
+         ('siberia', 'soldier'), ('ontario', 'canon'), 
+         ('central_america', 'soldier'), ('brazil', 'soldier'),
+         ('northwest_territory', 'horse'), ('peru', 'horse'), 
+         ('south_africa', 'canon'), ('western_us', 'soldier'),
+         ('quebec', 'canon'), ('great_britain', 'soldier'),
+         ('scandinavia', 'soldier'), ('mongolia', 'horse'),
+         ('ural', 'soldier'), ('iceland', 'horse'), 
+         ('eastern_us', 'canon'), ('new_guinea', 'horse'),
+         ('alaska', 'canon'), ('null', 'wildcard'), ('null', 'wildcard')]
+
+#Identical cards (the wildcards) map to the first of their ids
+CARD_IDS = {}
+for (i, card) in enumerate(CARDS):
+    CARD_IDS.setdefault(card, i)
+
 def get_new_deck():
-    deck = [('japan', 'horse'), ('china', 'canon'), ('ukraine', 'soldier'), 
-            ('north_africa', 'soldier'), ('congo', 'canon'), 
-            ('afghanistan', 'soldier'), ('middle_east', 'canon'), 
-            ('venezuela', 'horse'), ('southern_europe', 'soldier'),
-            ('northern_europe', 'horse'), ('greenland', 'horse'),
-            ('siam', 'horse'), ('irkutsk', 'canon'), ('india', 'horse'),
-            ('alberta', 'canon'), ('egypt', 'horse'), ('kamchatka', 'canon'),
-            ('western_europe', 'soldier'), ('indonesia', 'soldier'),
-            ('yakutsk', 'canon'), ('argentina', 'soldier'), 
-            ('eastern_australia', 'horse'), ('east_africa', 'soldier'),
-            ('western_australia', 'canon'), ('madagascar', 'horse'),
-            ('siberia', 'soldier'), ('ontario', 'canon'), 
-            ('central_america', 'soldier'), ('brazil', 'soldier'),
-            ('northwest_territory', 'horse'), ('peru', 'horse'), 
-            ('south_africa', 'canon'), ('western_us', 'soldier'),
-            ('quebec', 'canon'), ('great_britain', 'soldier'),
-            ('scandinavia', 'soldier'), ('mongolia', 'horse'),
-            ('ural', 'soldier'), ('iceland', 'horse'), 
-            ('eastern_us', 'canon'), ('new_guinea', 'horse'),
-            ('alaska', 'canon'), ('null', 'wildcard'), ('null', 'wildcard')]
+    deck = list(CARDS)
     random.shuffle(deck)
     return deck
 
+def get_card_ids(cards):
+    """Returns the sorted ids of a collection of cards, giving identical 
+    cards consecutive ids."""
+    ids = []
+    for card in cards:
+        i = CARD_IDS[card]
+        while i in ids:
+            i += 1
+        assert i < len(CARDS) and CARDS[i] == card
+        ids.append(i)
+    return sorted(ids)
+
 def _is_set(c1, c2, c3):
     l = sorted([c1[1], c2[1], c3[1]])
     n_wildcards = sum([1 if c == 'wildcard' else 0 for c in l])
@@ -59,7 +59,8 @@ def gather_armies_data():
                 states.append(state)
                 i = 0
                 
-                game_copy = game.copy(False)
+                #A forked copy does not foresee the dice of the game
+                game_copy = game.copy(False, True)
                 base_agent.set_game(game_copy) 
                 while i < 300 and not game_copy.has_finished():
                     base_agent.do_actions(base_agent.get_action())
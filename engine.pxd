@@ -0,0 +1,343 @@
+#Declarations of the engine, so that other Cython modules can cimport RiskGame
+
+cdef extern from *:
+    int popcount "__builtin_popcountll" (unsigned long long x) nogil
+    int lowest_bit "__builtin_ctzll" (unsigned long long x) nogil
+
+ctypedef unsigned long long mask_t
+
+cdef inline unsigned long long splitmix64(unsigned long long *x) noexcept nogil:
+    """Used to expand a seed into a generator state."""
+    cdef unsigned long long z
+    x[0] += 0x9e3779b97f4a7c15ULL
+    z = x[0]
+    z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9ULL
+    z = (z ^ (z >> 27)) * 0x94d049bb133111ebULL
+    return z ^ (z >> 31)
+
+cdef enum:
+    #Territories are bits of a mask_t, so maps have at most 64 of them
+    MAX_TERRITORIES = 64
+    MAX_PLAYERS = 6
+    MAX_CONTINENTS = 16
+    MAX_EDGES = 4032
+    #Largest occupation or fortification that has an action id
+    MAX_MOVE_ARMIES = 128
+    #Cards are identified by their position in cards.CARDS
+    N_CARDS = 44
+
+#Card types, in alphabetical order
+cdef enum:
+    CARD_CANON = 0
+    CARD_HORSE = 1
+    CARD_SOLDIER = 2
+    CARD_WILDCARD = 3
+    N_CARD_TYPES = 4
+
+#Game phases, in the order of get_state's names
+cdef enum:
+    PHASE_SETUP = 0
+    PHASE_SETUP_DEPLOYMENT = 1
+    PHASE_REINFORCEMENT = 2
+    PHASE_ATTACK = 3
+    PHASE_OCCUPATION = 4
+    PHASE_TRADING = 5
+    PHASE_FORTIFY = 6
+    PHASE_GAME_END = 7
+
+cdef struct TerritoryRecord:
+    int territory
+    int owner
+    int armies
+
+#The hands of all players. Bit i of cards[player] stands for card i, counts 
+#and territories (the territories of the cards, as a bitboard) follow from it.
+cdef struct Hands:
+    mask_t cards[MAX_PLAYERS]
+    int counts[MAX_PLAYERS][N_CARD_TYPES]
+    mask_t territories[MAX_PLAYERS]
+    unsigned long long hashes[MAX_PLAYERS]
+
+cdef class UndoRecord:
+    cdef int phase, player_turn, turn, step, armies_to_deploy
+    cdef int mandatory_occupation_armies, occupation_from_ter, occupation_to_ter
+    cdef int occupation_player_elimination, n_sets_traded_in, winner
+    cdef bint player_has_taken_territory_this_turn, elimination_player_trade
+    cdef int journal_mark, deck_size
+    cdef mask_t journaled_mask
+    cdef int setup_armies_to_place[MAX_PLAYERS]
+    cdef list legal_actions
+    cdef bint legal_actions_stale
+    cdef unsigned long long rng_state[4]
+    cdef Hands hands
+
+cdef class MapTopology:
+    cdef object risk_map, G
+    cdef dict continents, territory_ids
+    cdef list territory_names, continent_keys
+    cdef object map_file
+    #Identifies the map in serialized games
+    cdef unsigned long long fingerprint
+    cdef int n_territories
+    cdef mask_t territory_mask
+    cdef mask_t neighbor_masks[MAX_TERRITORIES]
+    cdef int n_continents
+    cdef mask_t continent_masks[MAX_CONTINENTS]
+    cdef int continent_bonuses[MAX_CONTINENTS]
+    cdef int continent_sizes[MAX_CONTINENTS]
+    cdef int territory_continents[MAX_TERRITORIES]
+    #Compressed sparse rows: the directed edges of territory t are
+    #edge_offsets[t] to edge_offsets[t + 1] - 1, edge e goes from edge_from[e]
+    #to edge_to[e]
+    cdef int n_edges
+    cdef int edge_from[MAX_EDGES]
+    cdef int edge_to[MAX_EDGES]
+    cdef int edge_offsets[MAX_TERRITORIES + 1]
+    cdef int attack_offset, attack_pass_id, occupation_offset, fortify_offset
+    cdef int fortify_pass_id, trade_offset, trade_pass_id, n_actions
+    #Territory id of each card, -1 for wildcards and territories not on the map
+    cdef int card_territories[N_CARDS]
+
+cdef class RiskGame:
+    #The map. The arrays below point into the shared topology.
+    cdef MapTopology topology
+    cdef object risk_map, G
+    cdef dict continents, territory_ids
+    cdef list territory_names, continent_keys
+    cdef int n_players, player_turn, turn, step, armies_to_deploy
+    cdef int mandatory_occupation_armies
+    cdef int setup_armies_to_place[MAX_PLAYERS]
+    cdef int phase
+    cdef int occupation_from_ter, occupation_to_ter
+    #Board state, indexed by territory id (position in the sorted territory list)
+    cdef int owners[MAX_TERRITORIES]
+    cdef int armies[MAX_TERRITORIES]
+    #Bitboards, bit i stands for territory i
+    cdef mask_t owner_masks[MAX_PLAYERS]
+    cdef mask_t unclaimed_mask
+    cdef int n_territories
+    cdef mask_t territory_mask
+    cdef mask_t *neighbor_masks
+    cdef int n_continents
+    cdef mask_t *continent_masks
+    cdef int *continent_bonuses
+    cdef int *continent_sizes
+    cdef int *territory_continents
+    #Running aggregates, kept in sync by _set_owner and _add_armies
+    cdef int total_armies
+    cdef int player_armies[MAX_PLAYERS]
+    cdef int player_continent_counts[MAX_PLAYERS][MAX_CONTINENTS]
+    cdef int player_continent_bonuses[MAX_PLAYERS]
+    cdef bint player_has_taken_territory_this_turn, elimination_player_trade
+    cdef bint is_determinized
+    cdef Hands hands
+    cdef int *card_territories
+    #Card ids of the deck, the next card to draw is deck[deck_size - 1]
+    cdef unsigned char deck[N_CARDS]
+    cdef int deck_size
+    cdef list legal_actions
+    #Legal actions are built lazily from per-territory chunks of attack and
+    #fortify moves. A chunk is rebuilt only when its territory is marked dirty.
+    cdef bint legal_actions_stale
+    cdef list attack_chunks, fortify_chunks
+    cdef mask_t attack_dirty, fortify_dirty
+    cdef int n_sets_traded_in, winner, occupation_player_elimination
+    #Integer action space, see encode_action and MapTopology
+    cdef int n_edges
+    cdef int *edge_from
+    cdef int *edge_to
+    cdef int *edge_offsets
+    cdef int attack_offset, attack_pass_id, occupation_offset, fortify_offset
+    cdef int fortify_pass_id, trade_offset, trade_pass_id, n_actions
+    #Undo stack of push_action. While a record is open every territory is 
+    #journaled before _set_owner or _add_armies first changes it, the ones 
+    #journaled since the last record are in journaled_mask. Room for every
+    #territory is reserved when a record is pushed, so journaling never fails.
+    cdef list undo_records
+    cdef TerritoryRecord *journal
+    cdef int journal_size, journal_capacity
+    cdef bint journal_enabled
+    cdef mask_t journaled_mask
+    #Zobrist hash of the board, see get_hash
+    cdef unsigned long long board_hash
+    #State of the xoshiro256** generator used for dice and deck shuffles
+    cdef unsigned long long rng_state[4]
+    
+    cpdef void seed(self, unsigned long long seed)
+    cdef unsigned long long _next_random(self) noexcept nogil
+    cdef double _random_unit(self) noexcept nogil
+    cdef void _jump_random(self) noexcept nogil
+    cdef int _randint(self, int n) noexcept nogil
+    cdef void _roll_dice(self, int *dice, int n_dice) noexcept nogil
+    cpdef tuple get_rng_state(self)
+    cpdef void set_rng_state(self, tuple state)
+    cpdef void new_game(self, int n_players)
+    cdef void _set_topology(self, MapTopology topology)
+    cdef int _tid(self, str t) except -1
+    cdef mask_t _owner_mask(self, int player) noexcept nogil
+    cdef mask_t _hostile_neighbor_mask(self, int t) noexcept nogil
+    cdef void _set_owner(self, int t, int player) noexcept nogil
+    cdef void _add_armies(self, int t, int n_armies) noexcept nogil
+    cdef void _journal(self, int t) noexcept nogil
+    cdef list _mask_to_names(self, mask_t mask)
+    cpdef tuple to_tuple(self)
+    cdef unsigned long long _compute_board_hash(self)
+    cdef void _hash_hand(self, int player) noexcept nogil
+    cdef void _give_card(self, int player, int card) noexcept nogil
+    cdef void _clear_hand(self, int player) noexcept nogil
+    cdef void _set_hand(self, int player, cards)
+    cdef bint _has_set(self, int player) noexcept nogil
+    cdef tuple _get_canonical_set(self, int player)
+    cdef void _hash_all_hands(self)
+    cdef unsigned long long _hash_scalars(self)
+    cpdef unsigned long long get_hash(self)
+    cpdef unsigned long long compute_hash(self)
+    cpdef bytes to_bytes(self)
+    cdef void _load_bytes(self, data) except *
+    cpdef void compute_legal_actions(self)
+    cpdef void compute_setup_legal_actions(self)
+    cpdef void compute_setup_deployment_legal_actions(self)
+    cpdef void compute_reinforcement_legal_actions(self)
+    cdef list _get_attack_chunk(self, int t)
+    cdef list _get_fortify_chunk(self, int t)
+    cpdef void compute_attack_legal_actions(self)
+    cpdef void compute_occupation_legal_actions(self)
+    cpdef void compute_trading_legal_actions(self)
+    cpdef void compute_fortify_legal_actions(self)
+    cdef bint _can_place(self, int t) noexcept nogil
+    cdef bint _can_attack(self, int from_ter, int to_ter, int n_dice) noexcept nogil
+    cdef bint _can_occupy(self, int n_armies) noexcept nogil
+    cdef bint _can_fortify(self, int from_ter, int to_ter, int n_armies) noexcept nogil
+    cdef bint _can_trade_set(self) noexcept nogil
+    cdef bint _can_pass_trade(self) noexcept nogil
+    cdef bint _can_trade(self, tuple cards)
+    cdef bint _is_legal_action(self, action)
+    cpdef void do_action(self, action)
+    cdef void _after_action(self, int before_phase) noexcept nogil
+    cdef void _do_action_id(self, int action_id) noexcept nogil
+    cpdef void do_setup_action(self, str action)
+    cdef void _do_setup(self, int t) noexcept nogil
+    cpdef void do_setup_deployment_action(self, str action)
+    cdef void _do_setup_deployment(self, int t) noexcept nogil
+    cpdef void do_reinforce_action(self, str action)
+    cdef void _do_reinforce(self, int t) noexcept nogil
+    cpdef tuple get_determinized_casaulties(self, int n_atk_dice, int n_def_dice)
+    cpdef void do_attack_action(self, tuple action)
+    cdef void _do_attack_pass(self) noexcept nogil
+    cdef void _do_attack(self, int from_ter, int to_ter, int n_atk_dice) noexcept nogil
+    cdef void _apply_attack_result(self, int from_ter, int to_ter, int n_atk_dice, int atk_casaulties, int def_casualties) noexcept nogil
+    cpdef void resolve_attack(self, str from_ter, str to_ter, int n_dice)
+    cdef void _resolve_attack(self, int from_ter, int to_ter, int n_dice) noexcept nogil
+    cpdef bint attack_until(self, str from_ter, str to_ter, int n_dice, int stop_armies=*)
+    cpdef void reinforce(self, str territory, int n_armies)
+    cpdef void apply_turn_plan(self, plan) except *
+    cpdef double get_attack_win_probability(self, str from_ter, str to_ter, int n_dice)
+    cpdef void do_occupation_action(self, int action)
+    cdef void _do_occupation(self, int n_armies_to_move) noexcept nogil
+    cpdef void do_trading_action(self, tuple action)
+    cdef void _do_trade_pass(self) noexcept nogil
+    cdef void _do_trade(self) noexcept nogil
+    cpdef int get_n_reinforcements_for_set(self)
+    cpdef void do_fortify_action(self, tuple action)
+    cdef void _do_fortify(self, int from_ter, int to_ter, int n_armies) noexcept nogil
+    cdef void _do_fortify_pass(self) noexcept nogil
+    cpdef int get_reinforcement_amount(self, int player)
+    cdef int _reinforcement_amount(self, int player) noexcept nogil
+    cpdef compute_armies_to_deploy(self)
+    cdef void _compute_armies_to_deploy(self) noexcept nogil
+    cpdef increment_player_turn(self)
+    cdef void _increment_player_turn(self) noexcept nogil
+    cdef int _n_player_territories(self, int player) noexcept nogil
+    cdef list _get_player_territories(self, int player)
+    cpdef int n_unclaimed_territories(self)
+    cpdef list get_player_territories(self, int player)
+    cpdef list get_hostile_neighbors(self, str node)
+    cpdef bint has_hostile_neighbor(self, str node)
+    cpdef bint has_continent(self, int player, tuple continent)
+    cpdef int get_continent_troop_bonuses(self, int player)
+    cdef int _continent_troop_bonuses(self, int player) noexcept nogil
+    cpdef void make_new_deck(self)
+    cpdef void copy_into(self, RiskGame dst, bint is_determinized=*, bint fork_rng=*)
+    cpdef void set_territory_data(self, territory_data)
+    cpdef void set_setup_armies_to_place(self, setup_armies_to_place)
+    cpdef void set_player_hands(self, player_hands)
+    cpdef void set_deck(self, deck)
+    cpdef list get_deck(self)
+    cpdef bint has_finished(self)
+    cpdef list get_legal_actions(self)
+    cdef int _edge_id(self, int from_ter, int to_ter) noexcept nogil
+    cdef bint _is_edge(self, int from_ter, int to_ter) noexcept nogil
+    cpdef int get_n_actions(self)
+    cpdef int encode_action(self, action) except -1
+    cpdef object decode_action(self, int action_id)
+    cdef bint _is_legal_action_id(self, int action_id) noexcept nogil
+    cpdef bint is_legal_action_id(self, int action_id)
+    cpdef void do_action_id(self, int action_id)
+    cdef void _push_undo_record(self)
+    cdef void _reserve_journal(self, int capacity)
+    cdef void _drop_undo_record(self)
+    cpdef void push_action(self, action)
+    cpdef void push_action_id(self, int action_id)
+    cpdef void pop_action(self)
+    cpdef int get_undo_depth(self)
+    cdef int _legal_action_ids(self, int *out) noexcept nogil
+    cpdef list get_legal_action_ids(self)
+    cdef mask_t _border_mask(self, int player) noexcept nogil
+    cdef mask_t _placement_mask(self, int profile) noexcept nogil
+    cdef bint _attack_dice(self, int t, int profile, int *lo, int *hi) noexcept nogil
+    cdef bint _occupation_amounts(self, int profile, int *amounts, int *n) noexcept nogil
+    cpdef list get_pruned_actions(self, int profile)
+    cdef int _pruned_action_ids(self, int *out, int profile) noexcept nogil
+    cpdef list get_pruned_action_ids(self, int profile)
+    cpdef int get_observation_size(self)
+    cdef void _write_observation(self, float *out) noexcept nogil
+    cpdef tuple get_action_delta(self, action)
+    cdef int _play_random(self, int max_steps, int *legal_ids) noexcept nogil
+    cpdef int play_random(self, int max_steps=*) except -1
+    cdef int _choose_policy_action_id(self, int policy, int *ids, int n) noexcept nogil
+    cdef void _do_policy_action_id(self, int action_id) noexcept nogil
+    cpdef void do_macro_action_id(self, int action_id)
+    cdef int _rollout(self, int policy, int max_steps, int *ids) noexcept nogil
+    cpdef double rollout(self, policy=*, int max_steps=*, seed=*, int player=*, double proj_n_turns=*) except -1
+    cdef void _evaluate_all_players(self, double n_turns, double *out) noexcept nogil
+    cdef double _heuristic_value(self, int player, double n_turns) noexcept nogil
+    cpdef double get_heuristic_value(self, int player, double proj_n_turns)
+    cpdef str get_state(self)
+    cpdef int get_setup_armies_to_place(self, player)
+    cpdef int get_turn(self)
+    cpdef int get_step(self)
+    cpdef int get_player_turn(self)
+    cpdef int get_total_player_armies(self, player)
+    cpdef str get_occupy_from_ter(self)
+    cpdef str get_occupy_to_ter(self)
+    cpdef int get_n_armies_to_deploy(self)
+    cpdef int get_number_of_armies(self, t)
+    cpdef int get_owner(self, t)
+    cpdef void debug_set_territory_armies(self, t, n_armies)
+    cpdef void debug_set_territory_owner(self, t, player)
+    cpdef void debug_set_player_hand(self, player, hand)
+    cpdef void debug_set_player_territory_conquest_bonus(self, value)
+    cpdef void debug_set_elimination_player_trade(self, value)
+    cpdef list get_player_hand(self, player)
+    cpdef bint get_territory_conquest_bonus(self)
+    cpdef dict get_territory_data(self)
+    cpdef list get_all_territories(self)
+    cpdef dict get_continents(self)
+    cpdef MapTopology get_topology(self)
+    cpdef int get_winner(self)
+    cpdef int get_n_sets_traded_in(self)
+    cpdef void debug_set_n_sets_traded_in(self, value)
+    cpdef void set_determinization(self, value)
+    cpdef int get_n_player_armies(self, int player)
+    cpdef int get_n_player_territories(self, int player)
+    cpdef int get_total_armies_on_board(self)
+    cpdef list get_neighboring_territories(self, str t)
+    cpdef bint is_player_dead(self, int player)
+    cpdef int get_n_alive_players(self)
+    cpdef int get_n_players(self)
+
+cdef class GamePool:
+    cdef list free_games
+    cpdef RiskGame copy(self, RiskGame game, bint is_determinized, bint fork_rng=*)
+    cpdef void release(self, RiskGame game)
+    cpdef int get_n_free_games(self)
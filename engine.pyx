@@ -1,49 +1,460 @@
 # cython: boundscheck=False, wraparound=False, initializedcheck=False, cdivision=True, language_level=3, profile=False
 
 from RiskMap import RiskMap
-from cards import get_new_deck, legal_sets
+from cards import CARDS, CARD_IDS, get_card_ids, _is_set
+from libc.stdlib cimport malloc, realloc, free
+from libc.string cimport memcpy
+from operator import itemgetter
 import cython
-import copy
-import math
+import numpy as np
 import PIL
 import PIL.ImageDraw
+import hashlib
+import os
 import random
+import struct
+
+PHASE_NAMES = ['setup', 'setup_deployment', 'reinforcement', 'attack', 
+               'occupation', 'trading', 'fortify', 'game_end']
+
+ATTACK_PASS = ('pass', 'pass', 0)
+FORTIFY_PASS = ('pass', 'pass', 0)
+TRADE_PASS = (('pass', 'pass'), ('pass', 'pass'), ('pass', 'pass'))
+
+#Move generation profiles of RiskGame.get_pruned_actions, combined with |
+cpdef enum:
+    #Only place armies on territories with a hostile neighbor
+    PRUNE_BORDER_PLACEMENT = 1
+    #Only attack with three dice
+    PRUNE_THREE_DICE = 2
+    #Only attack with as many dice as the territory can
+    PRUNE_MAX_DICE = 4
+    #Only attack with more armies, less the one that stays, than the defender has
+    PRUNE_REASONABLE_ATTACKS = 8
+    #Only fortify from territories without hostile neighbors to ones with them
+    PRUNE_BORDER_FORTIFY = 16
+    #Only fortify with every army that can move
+    PRUNE_MAX_FORTIFY = 32
+    #Only occupy with the least, the middle and the most armies
+    PRUNE_OCCUPATION_HIGH_LOW = 64
+    #Occupy with the least armies when leaving the border for the interior,
+    #with the most when moving from the interior to the border
+    PRUNE_BORDER_OCCUPATION = 128
+    #Drop passes when there is something else to do
+    PRUNE_PASS = 256
+    #The moves of helper_functions.get_reduced_actions
+    REDUCED_ACTIONS = 1 | 2 | 8 | 16
+
+#Playout policies of RiskGame.rollout, in the order of the enum below
+ROLLOUT_POLICIES = ['random', 'better', 'greedy']
+cdef enum:
+    ROLLOUT_RANDOM = 0
+    ROLLOUT_BETTER = 1
+    ROLLOUT_GREEDY = 2
+
+CARD_TYPE_NAMES = ['canon', 'horse', 'soldier', 'wildcard']
+#Type of each card, and the ids of the cards of each type as a bitmask
+cdef int card_types[N_CARDS]
+cdef mask_t card_type_masks[N_CARD_TYPES]
+
+cdef void _build_card_tables():
+    cdef int i
+    assert len(CARDS) == N_CARDS
+    for i in range(N_CARD_TYPES):
+        card_type_masks[i] = 0
+    for (i, card) in enumerate(CARDS):
+        card_types[i] = CARD_TYPE_NAMES.index(card[1])
+        card_type_masks[card_types[i]] |= (<mask_t>1) << i
+
+_build_card_tables()
+
+cdef mask_t _first_cards(mask_t cards, int n):
+    """Returns the first n of the cards, ordered by type and then by id."""
+    cdef int t
+    cdef mask_t chosen = 0
+    cdef mask_t of_type
+    for t in range(N_CARD_TYPES):
+        of_type = cards & card_type_masks[t]
+        while of_type and n > 0:
+            chosen |= of_type & (~of_type + 1)
+            of_type &= of_type - 1
+            n -= 1
+    return chosen
+
+cdef tuple _cards_tuple(mask_t cards):
+    """Returns the cards ordered by type and then by id."""
+    cdef int t
+    cdef mask_t of_type
+    l = []
+    for t in range(N_CARD_TYPES):
+        of_type = cards & card_type_masks[t]
+        while of_type:
+            l.append(CARDS[lowest_bit(of_type)])
+            of_type &= of_type - 1
+    return tuple(l)
+
+#xoshiro256** by Blackman and Vigna, the state must not be all zero
+cdef inline unsigned long long _rotl(unsigned long long x, int k) noexcept nogil:
+    return (x << k) | (x >> (64 - k))
+
+cdef unsigned long long[4] XOSHIRO_JUMP = [0x180ec6d33cfd0abaULL, 0xd5a61266f0c9392cULL, 0xa9582618e03fc9aaULL, 0x39abdc4529b1661cULL]
+
+#Battle tables. roll_loss_probabilities[a][d][k] is the probability that the
+#attacker loses k armies when a attacker dice meet d defender dice, the 
+#defender loses the other min(a, d) - k. The battle tables are for an attack
+#that is repeated with the same number of dice until it conquers the 
+#territory, or until the attacker has too few armies left to roll that many.
+cdef enum:
+    MAX_BATTLE_ARMIES = 150
+
+cdef double roll_loss_probabilities[4][3][3]
+cdef double battle_win_probabilities[4][MAX_BATTLE_ARMIES + 1][MAX_BATTLE_ARMIES + 1]
+cdef double battle_atk_survivors[4][MAX_BATTLE_ARMIES + 1][MAX_BATTLE_ARMIES + 1]
+cdef double battle_def_survivors[4][MAX_BATTLE_ARMIES + 1][MAX_BATTLE_ARMIES + 1]
+
+cdef void _build_battle_tables():
+    cdef int a, d, k, i, roll, r, n_rolls, n_losses, n_atk, n_def, n_fought
+    cdef int dice[5]
+    cdef double p
+    
+    for a in range(1, 4):
+        for d in range(1, 3):
+            for k in range(3):
+                roll_loss_probabilities[a][d][k] = 0
+            n_rolls = 1
+            for i in range(a + d):
+                n_rolls *= 6
+            for roll in range(n_rolls):
+                r = roll
+                for i in range(a + d):
+                    dice[i] = 1 + r % 6
+                    r //= 6
+                _sort_descending(dice, a)
+                _sort_descending(dice + a, d)
+                n_losses = 0
+                for i in range(min(a, d)):
+                    if dice[i] <= dice[a + i]:
+                        n_losses += 1
+                roll_loss_probabilities[a][d][n_losses] += 1.0 / n_rolls
+    
+    for a in range(1, 4):
+        for n_atk in range(MAX_BATTLE_ARMIES + 1):
+            for n_def in range(MAX_BATTLE_ARMIES + 1):
+                if n_def == 0:
+                    battle_win_probabilities[a][n_atk][n_def] = 1
+                    battle_atk_survivors[a][n_atk][n_def] = n_atk
+                    battle_def_survivors[a][n_atk][n_def] = 0
+                elif n_atk < a + 1:
+                    battle_win_probabilities[a][n_atk][n_def] = 0
+                    battle_atk_survivors[a][n_atk][n_def] = n_atk
+                    battle_def_survivors[a][n_atk][n_def] = n_def
+                else:
+                    d = min(n_def, 2)
+                    n_fought = min(a, d)
+                    battle_win_probabilities[a][n_atk][n_def] = 0
+                    battle_atk_survivors[a][n_atk][n_def] = 0
+                    battle_def_survivors[a][n_atk][n_def] = 0
+                    for k in range(n_fought + 1):
+                        p = roll_loss_probabilities[a][d][k]
+                        battle_win_probabilities[a][n_atk][n_def] += p * battle_win_probabilities[a][n_atk - k][n_def - n_fought + k]
+                        battle_atk_survivors[a][n_atk][n_def] += p * battle_atk_survivors[a][n_atk - k][n_def - n_fought + k]
+                        battle_def_survivors[a][n_atk][n_def] += p * battle_def_survivors[a][n_atk - k][n_def - n_fought + k]
+
+def get_roll_outcome_probabilities(int n_atk_dice, int n_def_dice):
+    """Returns (attacker losses, defender losses, probability) for every 
+    outcome of a single roll."""
+    cdef int k
+    assert n_atk_dice >= 1 and n_atk_dice <= 3 and n_def_dice >= 1 and n_def_dice <= 2
+    return [(k, min(n_atk_dice, n_def_dice) - k, roll_loss_probabilities[n_atk_dice][n_def_dice][k]) for k in range(min(n_atk_dice, n_def_dice) + 1)]
+
+def get_attack_win_probability(int n_atk_armies, int n_def_armies, int n_dice=3):
+    """Probability that n_atk_armies armies on the attacking territory 
+    conquer a territory with n_def_armies armies, attacking with n_dice dice
+    for as long as they can. Armies above MAX_BATTLE_ARMIES count as 
+    MAX_BATTLE_ARMIES."""
+    assert n_dice >= 1 and n_dice <= 3 and n_atk_armies >= 0 and n_def_armies >= 0
+    return battle_win_probabilities[n_dice][min(n_atk_armies, MAX_BATTLE_ARMIES)][min(n_def_armies, MAX_BATTLE_ARMIES)]
+
+def get_expected_survivors(int n_atk_armies, int n_def_armies, int n_dice=3):
+    """Expected armies left on the attacking and the defending territory 
+    after the same attack as get_attack_win_probability."""
+    assert n_dice >= 1 and n_dice <= 3 and n_atk_armies >= 0 and n_def_armies >= 0
+    n_atk_armies = min(n_atk_armies, MAX_BATTLE_ARMIES)
+    n_def_armies = min(n_def_armies, MAX_BATTLE_ARMIES)
+    return (battle_atk_survivors[n_dice][n_atk_armies][n_def_armies], battle_def_survivors[n_dice][n_atk_armies][n_def_armies])
+
+#Kinds of Zobrist keys, see _zobrist_key
+cdef enum:
+    ZOBRIST_OWNER = 1
+    ZOBRIST_ARMIES = 2
+    ZOBRIST_CARD = 3
+    ZOBRIST_PHASE = 4
+    ZOBRIST_PLAYER_TURN = 5
+    ZOBRIST_SETS_TRADED_IN = 6
+    ZOBRIST_ARMIES_TO_DEPLOY = 7
+    ZOBRIST_SETUP_ARMIES = 8
+    ZOBRIST_OCCUPATION = 9
+    ZOBRIST_FLAGS = 10
+
+cdef inline unsigned long long _zobrist_key(int kind, int a, int b) noexcept nogil:
+    """A pseudorandom 64-bit key for value b of feature a. Keys are computed 
+    on the fly, so army counts need no bound."""
+    cdef unsigned long long x = ((<unsigned long long> kind) << 56) ^ ((<unsigned long long> a) << 32) ^ (<unsigned int> b)
+    return splitmix64(&x)
+
+#Layout of to_bytes: a header with the scalar fields and the map, the owners
+#and armies of the territories, the generator state, the hand sizes, and then
+#the card ids of the hands and of the deck in order.
+SERIALIZATION_VERSION = 3
+_HEADER = struct.Struct('<BBBBBiiHHbbbBbB%dHQB' % MAX_PLAYERS)
+_RNG = struct.Struct('<4Q%dB' % MAX_PLAYERS)
+#Games are deserialized into copies of these, so each map is only built once
+_template_games = {}
+
+def game_from_bytes(data):
+    """Rebuilds a game from RiskGame.to_bytes."""
+    cdef RiskGame game = RiskGame.__new__(RiskGame)
+    game._load_bytes(data)
+    return game
+
+cdef inline void _sort_descending(int *values, int n) noexcept nogil:
+    cdef int i, j, value
+    for i in range(1, n):
+        value = values[i]
+        j = i - 1
+        while j >= 0 and values[j] < value:
+            values[j + 1] = values[j]
+            j -= 1
+        values[j + 1] = value
+
+_build_battle_tables()
+
+cdef inline void _determinized_casaulties(int n_atk_dice, int n_def_dice, int *atk_casaulties, int *def_casualties) noexcept nogil:
+    if n_atk_dice == 3:
+        if n_def_dice == 2:
+            atk_casaulties[0] = 1
+            def_casualties[0] = 1
+        else:
+            atk_casaulties[0] = 0
+            def_casualties[0] = 1
+    elif n_atk_dice == 2:
+        if n_def_dice == 1:
+            atk_casaulties[0] = 1
+            def_casualties[0] = 0
+        else:
+            atk_casaulties[0] = 2
+            def_casualties[0] = 0
+    else:
+        atk_casaulties[0] = 1
+        def_casualties[0] = 0
+
+cdef class UndoRecord:
+    """Everything besides the board that push_action needs to restore. The
+    board itself is restored from the journal, starting at journal_mark."""
+
+cdef class MapTopology:
+    """Everything about a map that games need and never change: the sorted 
+    territory names and their ids, the adjacency of the territories as 
+    bitboards and in compressed sparse rows, the continents and the layout 
+    of the action space. It is built once per process and shared by every
+    game, see get_map_topology."""
+    def __init__(self, risk_map, map_file=None):
+        cdef int i, e
+        cdef mask_t targets
+        cdef str node, neighbor
+        cdef tuple continent
+        self.risk_map = risk_map
+        self.map_file = map_file
+        self.risk_map.compile_edge_dict()
+        self.G = self.risk_map.get_map()
+        self.continents = self.risk_map.get_continents()
+        
+        #Territories are identified by their position in the sorted territory list
+        self.territory_names = self.G.get_territories()
+        self.n_territories = len(self.territory_names)
+        if self.n_territories > MAX_TERRITORIES:
+            raise ValueError("Maps can have at most {} territories".format(MAX_TERRITORIES))
+        self.territory_ids = {node: i for (i, node) in enumerate(self.territory_names)}
+        self.territory_mask = (~(<mask_t>0)) >> (64 - self.n_territories)
+        for (i, card) in enumerate(CARDS):
+            self.card_territories[i] = self.territory_ids.get(card[0], -1)
+        
+        for (i, node) in enumerate(self.territory_names):
+            self.territory_continents[i] = -1
+            self.neighbor_masks[i] = 0
+            for neighbor in self.G.neighbors(node):
+                self.neighbor_masks[i] |= (<mask_t>1) << self.territory_ids[neighbor]
+        
+        self.continent_keys = sorted(self.continents)
+        self.n_continents = len(self.continent_keys)
+        assert self.n_continents <= MAX_CONTINENTS
+        for (i, continent) in enumerate(self.continent_keys):
+            self.continent_masks[i] = 0
+            self.continent_bonuses[i] = continent[1]
+            self.continent_sizes[i] = len(self.continents[continent])
+            for node in self.continents[continent]:
+                self.continent_masks[i] |= (<mask_t>1) << self.territory_ids[node]
+                self.territory_continents[self.territory_ids[node]] = i
+        
+        #Directed edges are numbered by source territory, then target territory,
+        #so the neighbors of t are edge_to[edge_offsets[t]:edge_offsets[t + 1]]
+        e = 0
+        for i in range(self.n_territories):
+            self.edge_offsets[i] = e
+            targets = self.neighbor_masks[i]
+            while targets:
+                assert e < MAX_EDGES
+                self.edge_from[e] = i
+                self.edge_to[e] = lowest_bit(targets)
+                targets &= targets - 1
+                e += 1
+        self.edge_offsets[self.n_territories] = e
+        self.n_edges = e
+        
+        self.attack_offset = self.n_territories
+        self.attack_pass_id = self.attack_offset + 3 * self.n_edges
+        self.occupation_offset = self.attack_pass_id + 1
+        self.fortify_offset = self.occupation_offset + MAX_MOVE_ARMIES + 1
+        self.fortify_pass_id = self.fortify_offset + MAX_MOVE_ARMIES * self.n_edges
+        self.trade_offset = self.fortify_pass_id + 1
+        self.trade_pass_id = self.trade_offset + 1
+        self.n_actions = self.trade_pass_id + 1
+        
+        fingerprint = hashlib.blake2b(repr((self.territory_names, 
+            [self.G.neighbors(node) for node in self.territory_names],
+            sorted((c, sorted(ts)) for (c, ts) in self.continents.items()))).encode(), digest_size=8)
+        self.fingerprint = int.from_bytes(fingerprint.digest(), 'little')
+    
+    def get_map_file(self):
+        return self.map_file
+    
+    def get_n_territories(self):
+        return self.n_territories
+
+#Topologies by map file (None for the classic map) and by fingerprint
+_map_topologies = {}
+_fingerprint_topologies = {}
+
+def get_map_topology(map_file=None):
+    """Returns the topology of a map file, see RiskMap.load_map_file, or of
+    the classic map. Every map is only loaded once per process."""
+    cdef MapTopology topology
+    key = None if map_file is None else os.path.abspath(map_file)
+    if key not in _map_topologies:
+        topology = MapTopology(RiskMap(key), key)
+        _map_topologies[key] = topology
+        _fingerprint_topologies.setdefault(topology.fingerprint, topology)
+    return _map_topologies[key]
 
 cdef class RiskGame:
-    cdef object risk_map, G
-    cdef dict continents, territory_data
-    cdef int n_players, player_turn, turn, step, armies_to_deploy
-    cdef int mandatory_occupation_armies
-    cdef list setup_armies_to_place
-    cdef str state, occupation_from_ter, occupation_to_ter
-    cdef bint player_has_taken_territory_this_turn, elimination_player_trade
-    cdef bint is_determinized
-    cdef list player_hands, deck, legal_actions
-    cdef int n_sets_traded_in, winner, occupation_player_elimination
-    
-    def __init__(self, int n_players):
+    def __cinit__(self):
+        self.undo_records = []
+        self.journal = NULL
+        self.journal_size = 0
+        self.journal_capacity = 0
+        self.journal_enabled = False
+        self.journaled_mask = 0
+        
+    def __dealloc__(self):
+        free(self.journal)
+    
+    def __init__(self, int n_players, seed=None, map_file=None):
+        """Without a seed, the dice and deck of the game are seeded from the 
+        random module. Without a map file, the game is on the classic map."""
         assert n_players >= 3
+        self._set_topology(get_map_topology(map_file))
+        self.seed(random.getrandbits(64) if seed is None else seed)
         self.new_game(n_players)
         
+    cpdef void seed(self, unsigned long long seed):
+        cdef int i
+        for i in range(4):
+            self.rng_state[i] = splitmix64(&seed)
+            
+    cdef inline unsigned long long _next_random(self) noexcept nogil:
+        cdef unsigned long long *s = self.rng_state
+        cdef unsigned long long result = _rotl(s[1] * 5, 7) * 9
+        cdef unsigned long long t = s[1] << 17
+        s[2] ^= s[0]
+        s[3] ^= s[1]
+        s[1] ^= s[2]
+        s[0] ^= s[3]
+        s[2] ^= t
+        s[3] = _rotl(s[3], 45)
+        return result
+    
+    cdef inline double _random_unit(self) noexcept nogil:
+        """Uniform in [0, 1)."""
+        return (self._next_random() >> 11) * (1.0 / 9007199254740992.0)
+    
+    cdef void _jump_random(self) noexcept nogil:
+        """Advances the generator by 2^128 draws."""
+        cdef unsigned long long s[4]
+        cdef int i, b
+        s[0] = s[1] = s[2] = s[3] = 0
+        for i in range(4):
+            for b in range(64):
+                if XOSHIRO_JUMP[i] & ((<unsigned long long>1) << b):
+                    s[0] ^= self.rng_state[0]
+                    s[1] ^= self.rng_state[1]
+                    s[2] ^= self.rng_state[2]
+                    s[3] ^= self.rng_state[3]
+                self._next_random()
+        memcpy(self.rng_state, s, sizeof(s))
+    
+    cdef inline int _randint(self, int n) noexcept nogil:
+        """Uniform in [0, n)."""
+        return ((self._next_random() >> 32) * n) >> 32
+    
+    cdef void _roll_dice(self, int *dice, int n_dice) noexcept nogil:
+        """Rolls n_dice dice, two from each draw of the generator."""
+        cdef int i = 0
+        cdef unsigned long long r
+        while i < n_dice:
+            r = self._next_random()
+            dice[i] = 1 + (((r >> 32) * 6) >> 32)
+            if i + 1 < n_dice:
+                dice[i + 1] = 1 + (((r & 0xffffffffULL) * 6) >> 32)
+            i += 2
+    
+    def roll_dice(self, int n_dice):
+        dice = np.empty(n_dice, dtype=np.intc)
+        cdef int[::1] dice_view = dice
+        if n_dice > 0:
+            self._roll_dice(&dice_view[0], n_dice)
+        return dice
+    
+    cpdef tuple get_rng_state(self):
+        return tuple([self.rng_state[i] for i in range(4)])
+    
+    cpdef void set_rng_state(self, tuple state):
+        cdef int i
+        assert len(state) == 4 and any(state)
+        for i in range(4):
+            self.rng_state[i] = state[i]
+        
     cpdef void new_game(self, int n_players):
-        assert n_players >= 3
-        self.risk_map = RiskMap()
-        self.risk_map.compile_edge_dict()
-        self.G = self.risk_map.get_map()
-        self.territory_data = {}
-        self.continents = self.risk_map.get_continents()
+        cdef int i, j
+        assert n_players >= 3 and n_players <= MAX_PLAYERS
+        if self.topology is None:
+            self._set_topology(get_map_topology())
         self.n_players = n_players
         self.player_turn = 0
         self.turn = 1
         self.step = 0
-        self.setup_armies_to_place = [max(35 - (n_players - 3) * 5, 20) for _ in range(n_players)]
+        for i in range(MAX_PLAYERS):
+            self.setup_armies_to_place[i] = max(35 - (n_players - 3) * 5, 20) if i < n_players else 0
         self.armies_to_deploy = 0
-        self.state = 'setup'
+        self.phase = PHASE_SETUP
+        self.undo_records = []
+        self.journal_size = 0
+        self.journal_enabled = False
+        self.journaled_mask = 0
         
         #Reset after occupation, only used in occupation state
         self.mandatory_occupation_armies = 0
-        self.occupation_from_ter = None
-        self.occupation_to_ter = None
+        self.occupation_from_ter = -1
+        self.occupation_to_ter = -1
         self.occupation_player_elimination = -1
         
         #Reset after fortification
@@ -53,418 +464,1849 @@ cdef class RiskGame:
         self.elimination_player_trade = False
         
         #More variables
-        self.player_hands = [[] for _ in range(n_players)]
+        for i in range(MAX_PLAYERS):
+            self._clear_hand(i)
         self.n_sets_traded_in = 0
         self.winner = -1
         self.is_determinized = False
         
         self.make_new_deck()
         
-        for node in self.G.G_nodes:
-            self.territory_data[node] = {}
-            self.territory_data[node]['armies'] = 0
-            self.territory_data[node]['owner'] = -1
-            
+        for i in range(MAX_PLAYERS):
+            self.owner_masks[i] = 0
+            self.player_armies[i] = 0
+            self.player_continent_bonuses[i] = 0
+            for j in range(MAX_CONTINENTS):
+                self.player_continent_counts[i][j] = 0
+        self.unclaimed_mask = 0
+        self.total_armies = 0
+        
+        for i in range(self.n_territories):
+            self.armies[i] = 0
+            self.owners[i] = -1
+        self.unclaimed_mask = self.territory_mask
+        
+        self.attack_chunks = [[] for _ in range(self.n_territories)]
+        self.fortify_chunks = [[] for _ in range(self.n_territories)]
+        self.attack_dirty = self.unclaimed_mask
+        self.fortify_dirty = self.unclaimed_mask
+        self.board_hash = self._compute_board_hash()
+        self._hash_all_hands()
         self.compute_legal_actions()
         
+    cdef void _set_topology(self, MapTopology topology):
+        """Points the game at a shared topology. The arrays are not copied."""
+        self.topology = topology
+        self.risk_map = topology.risk_map
+        self.G = topology.G
+        self.continents = topology.continents
+        self.continent_keys = topology.continent_keys
+        self.territory_ids = topology.territory_ids
+        self.territory_names = topology.territory_names
+        self.n_territories = topology.n_territories
+        self.territory_mask = topology.territory_mask
+        self.n_continents = topology.n_continents
+        self.neighbor_masks = topology.neighbor_masks
+        self.continent_masks = topology.continent_masks
+        self.continent_bonuses = topology.continent_bonuses
+        self.continent_sizes = topology.continent_sizes
+        self.territory_continents = topology.territory_continents
+        self.n_edges = topology.n_edges
+        self.edge_from = topology.edge_from
+        self.edge_to = topology.edge_to
+        self.edge_offsets = topology.edge_offsets
+        self.attack_offset = topology.attack_offset
+        self.attack_pass_id = topology.attack_pass_id
+        self.occupation_offset = topology.occupation_offset
+        self.fortify_offset = topology.fortify_offset
+        self.fortify_pass_id = topology.fortify_pass_id
+        self.trade_offset = topology.trade_offset
+        self.trade_pass_id = topology.trade_pass_id
+        self.n_actions = topology.n_actions
+        self.card_territories = topology.card_territories
+    
+    cdef inline int _tid(self, str t) except -1:
+        assert t in self.territory_ids
+        return self.territory_ids[t]
+    
+    cdef inline mask_t _owner_mask(self, int player) noexcept nogil:
+        return self.unclaimed_mask if player == -1 else self.owner_masks[player]
+    
+    cdef inline mask_t _hostile_neighbor_mask(self, int t) noexcept nogil:
+        return self.neighbor_masks[t] & ~self._owner_mask(self.owners[t])
+    
+    cdef void _set_owner(self, int t, int player) noexcept nogil:
+        cdef mask_t bit = (<mask_t>1) << t
+        cdef int old_player = self.owners[t]
+        cdef int c = self.territory_continents[t]
+        
+        if self.journal_enabled:
+            self._journal(t)
+        
+        #Moves from t and from its neighbors into t depend on the owner of t
+        self.attack_dirty |= bit | self.neighbor_masks[t]
+        self.fortify_dirty |= bit | self.neighbor_masks[t]
+        
+        if old_player == -1:
+            self.unclaimed_mask &= ~bit
+        else:
+            self.owner_masks[old_player] &= ~bit
+            self.player_armies[old_player] -= self.armies[t]
+            if c != -1:
+                if self.player_continent_counts[old_player][c] == self.continent_sizes[c]:
+                    self.player_continent_bonuses[old_player] -= self.continent_bonuses[c]
+                self.player_continent_counts[old_player][c] -= 1
+        
+        self.owners[t] = player
+        self.board_hash ^= _zobrist_key(ZOBRIST_OWNER, t, old_player + 1) ^ _zobrist_key(ZOBRIST_OWNER, t, player + 1)
+        if player == -1:
+            self.unclaimed_mask |= bit
+        else:
+            self.owner_masks[player] |= bit
+            self.player_armies[player] += self.armies[t]
+            if c != -1:
+                self.player_continent_counts[player][c] += 1
+                if self.player_continent_counts[player][c] == self.continent_sizes[c]:
+                    self.player_continent_bonuses[player] += self.continent_bonuses[c]
+    
+    cdef inline void _add_armies(self, int t, int n_armies) noexcept nogil:
+        if self.journal_enabled:
+            self._journal(t)
+        self.attack_dirty |= (<mask_t>1) << t
+        self.fortify_dirty |= (<mask_t>1) << t
+        self.board_hash ^= _zobrist_key(ZOBRIST_ARMIES, t, self.armies[t]) ^ _zobrist_key(ZOBRIST_ARMIES, t, self.armies[t] + n_armies)
+        self.armies[t] += n_armies
+        self.total_armies += n_armies
+        if self.owners[t] != -1:
+            self.player_armies[self.owners[t]] += n_armies
+    
+    cdef void _journal(self, int t) noexcept nogil:
+        cdef mask_t bit = (<mask_t>1) << t
+        if self.journaled_mask & bit:
+            return
+        self.journaled_mask |= bit
+        self.journal[self.journal_size].territory = t
+        self.journal[self.journal_size].owner = self.owners[t]
+        self.journal[self.journal_size].armies = self.armies[t]
+        self.journal_size += 1
+    
+    cdef list _mask_to_names(self, mask_t mask):
+        cdef list l = []
+        while mask:
+            l.append(self.territory_names[lowest_bit(mask)])
+            mask &= mask - 1
+        return l
+        
     cpdef tuple to_tuple(self):
+        cdef int i
         t = [self.get_state()]
-        hands = [tuple(hand) for hand in self.player_hands]
+        hands = [tuple(self.get_player_hand(player)) for player in range(self.n_players)]
         t.extend(hands)
-        t.extend(self.setup_armies_to_place)
+        t.extend([self.setup_armies_to_place[i] for i in range(self.n_players)])
         t.append(self.armies_to_deploy)
         t.append(self.mandatory_occupation_armies)
-        t.append(self.occupation_from_ter)
-        t.append(self.occupation_to_ter)
+        t.append(self.get_occupy_from_ter())
+        t.append(self.get_occupy_to_ter())
         t.append(self.occupation_player_elimination)
         t.append(1 if self.player_has_taken_territory_this_turn else 0)
         t.append(1 if self.elimination_player_trade else 0)
         t.append(self.n_sets_traded_in)
-        for territory in self.get_all_territories():
-            t.append(self.get_owner(territory))
-            t.append(self.get_number_of_armies(territory))
+        for i in range(self.n_territories):
+            t.append(self.owners[i])
+            t.append(self.armies[i])
         t.append(self.n_players)
         return tuple(t)
     
+    cdef unsigned long long _compute_board_hash(self):
+        cdef int t
+        cdef unsigned long long h = 0
+        for t in range(self.n_territories):
+            h ^= _zobrist_key(ZOBRIST_OWNER, t, self.owners[t] + 1) ^ _zobrist_key(ZOBRIST_ARMIES, t, self.armies[t])
+        return h
+    
+    cdef void _hash_hand(self, int player) noexcept nogil:
+        cdef mask_t cards = self.hands.cards[player]
+        cdef unsigned long long h = 0
+        while cards:
+            h ^= _zobrist_key(ZOBRIST_CARD, player, lowest_bit(cards))
+            cards &= cards - 1
+        self.hands.hashes[player] = h
+    
+    cdef void _hash_all_hands(self):
+        cdef int player
+        for player in range(MAX_PLAYERS):
+            self._hash_hand(player)
+    
+    cdef void _give_card(self, int player, int card) noexcept nogil:
+        cdef int t = self.card_territories[card]
+        self.hands.cards[player] |= (<mask_t>1) << card
+        self.hands.counts[player][card_types[card]] += 1
+        if t != -1:
+            self.hands.territories[player] |= (<mask_t>1) << t
+        self.hands.hashes[player] ^= _zobrist_key(ZOBRIST_CARD, player, card)
+    
+    cdef void _clear_hand(self, int player) noexcept nogil:
+        cdef int i
+        self.hands.cards[player] = 0
+        for i in range(N_CARD_TYPES):
+            self.hands.counts[player][i] = 0
+        self.hands.territories[player] = 0
+        self.hands.hashes[player] = 0
+    
+    cdef void _set_hand(self, int player, cards):
+        cdef int i
+        self._clear_hand(player)
+        for i in get_card_ids(cards):
+            self._give_card(player, i)
+    
+    cdef bint _has_set(self, int player) noexcept nogil:
+        cdef int *counts = self.hands.counts[player]
+        return (counts[CARD_CANON] >= 3 or counts[CARD_HORSE] >= 3 or counts[CARD_SOLDIER] >= 3
+                or (counts[CARD_CANON] >= 1 and counts[CARD_HORSE] >= 1 and counts[CARD_SOLDIER] >= 1)
+                or (counts[CARD_WILDCARD] >= 1 and popcount(self.hands.cards[player]) >= 3))
+    
+    cdef tuple _get_canonical_set(self, int player):
+        """Returns the set that stands for all sets of a player: three of a 
+        kind before one of each before a wildcard, each with the lowest ids."""
+        cdef int t
+        cdef int *counts = self.hands.counts[player]
+        cdef mask_t hand = self.hands.cards[player]
+        cdef mask_t chosen
+        for t in range(CARD_WILDCARD):
+            if counts[t] >= 3:
+                return _cards_tuple(_first_cards(hand & card_type_masks[t], 3))
+        if counts[CARD_CANON] >= 1 and counts[CARD_HORSE] >= 1 and counts[CARD_SOLDIER] >= 1:
+            chosen = (_first_cards(hand & card_type_masks[CARD_CANON], 1) 
+                      | _first_cards(hand & card_type_masks[CARD_HORSE], 1)
+                      | _first_cards(hand & card_type_masks[CARD_SOLDIER], 1))
+            return _cards_tuple(chosen)
+        if counts[CARD_WILDCARD] >= 1 and popcount(hand) >= 3:
+            chosen = _first_cards(hand & card_type_masks[CARD_WILDCARD], 1)
+            return _cards_tuple(chosen | _first_cards(hand & ~chosen, 2))
+        return None
+    
+    cdef unsigned long long _hash_scalars(self):
+        cdef int player
+        cdef unsigned long long h = self.board_hash
+        for player in range(self.n_players):
+            h ^= self.hands.hashes[player]
+            if self.phase == PHASE_SETUP or self.phase == PHASE_SETUP_DEPLOYMENT:
+                h ^= _zobrist_key(ZOBRIST_SETUP_ARMIES, player, self.setup_armies_to_place[player])
+        h ^= _zobrist_key(ZOBRIST_PHASE, 0, self.phase)
+        h ^= _zobrist_key(ZOBRIST_PLAYER_TURN, self.n_players, self.player_turn)
+        h ^= _zobrist_key(ZOBRIST_SETS_TRADED_IN, 0, self.n_sets_traded_in)
+        h ^= _zobrist_key(ZOBRIST_ARMIES_TO_DEPLOY, 0, self.armies_to_deploy)
+        if self.phase == PHASE_OCCUPATION:
+            h ^= _zobrist_key(ZOBRIST_OCCUPATION, 0, self.mandatory_occupation_armies)
+            h ^= _zobrist_key(ZOBRIST_OCCUPATION, 1, self.occupation_from_ter)
+            h ^= _zobrist_key(ZOBRIST_OCCUPATION, 2, self.occupation_to_ter)
+            h ^= _zobrist_key(ZOBRIST_OCCUPATION, 3, self.occupation_player_elimination)
+        h ^= _zobrist_key(ZOBRIST_FLAGS, 0, self.player_has_taken_territory_this_turn)
+        h ^= _zobrist_key(ZOBRIST_FLAGS, 1, self.elimination_player_trade)
+        return h
+    
+    cpdef unsigned long long get_hash(self):
+        """Returns a 64-bit Zobrist hash of everything to_tuple holds, with 
+        hands hashed as sets of cards, and of the player to move. The board
+        and hands are hashed incrementally as they change, so this takes 
+        O(n_players)."""
+        return self._hash_scalars()
+    
+    cpdef bytes to_bytes(self):
+        """Returns the whole state of the game, including its deck and dice 
+        but not its undo stack, in a versioned binary layout of about 250 
+        bytes on the classic map. See from_bytes."""
+        cdef int i, player
+        cdef int flags = (self.player_has_taken_territory_this_turn
+                          | self.elimination_player_trade << 1
+                          | self.is_determinized << 2)
+        setup_armies = [self.setup_armies_to_place[i] for i in range(MAX_PLAYERS)]
+        hand_sizes = [popcount(self.hands.cards[player]) for player in range(MAX_PLAYERS)]
+        cards = bytearray()
+        for player in range(self.n_players):
+            cards.extend([i for i in range(N_CARDS) if (self.hands.cards[player] >> i) & 1])
+        cards.extend([self.deck[i] for i in range(self.deck_size)])
+        return b''.join([
+            _HEADER.pack(SERIALIZATION_VERSION, self.n_players, self.phase, 
+                         self.player_turn, flags, self.turn, self.step, 
+                         self.armies_to_deploy, self.mandatory_occupation_armies,
+                         self.occupation_from_ter, self.occupation_to_ter, 
+                         self.occupation_player_elimination, self.n_sets_traded_in,
+                         self.winner, self.deck_size, *setup_armies,
+                         self.topology.fingerprint, self.n_territories),
+            struct.pack('<%db%dH' % (self.n_territories, self.n_territories),
+                        *[self.owners[i] for i in range(self.n_territories)],
+                        *[self.armies[i] for i in range(self.n_territories)]),
+            _RNG.pack(*self.get_rng_state(), *hand_sizes),
+            bytes(cards)])
+    
+    cdef void _load_bytes(self, data) except *:
+        """Loads to_bytes output. Every field is checked before the game is
+        changed, so corrupt or truncated data raises ValueError."""
+        cdef int i, t, player, flags, n_players, n_deck, n_territories
+        cdef RiskGame template
+        cdef MapTopology topology
+        if len(data) == 0 or data[0] != SERIALIZATION_VERSION:
+            raise ValueError("Unsupported serialization version")
+        try:
+            header = _HEADER.unpack_from(data, 0)
+            n_players = header[1]
+            fingerprint = header[15 + MAX_PLAYERS]
+            n_territories = header[16 + MAX_PLAYERS]
+            if fingerprint not in _fingerprint_topologies:
+                raise ValueError("Serialized game is on a map that is not loaded, see get_map_topology")
+            topology = _fingerprint_topologies[fingerprint]
+            if n_territories != topology.n_territories:
+                raise ValueError("Serialized game has {} territories, its map has {}".format(n_territories, topology.n_territories))
+            board_format = '<%db%dH' % (n_territories, n_territories)
+            board = struct.unpack_from(board_format, data, _HEADER.size)
+            i = _HEADER.size + struct.calcsize(board_format)
+            rng = _RNG.unpack_from(data, i)
+        except struct.error:
+            raise ValueError("Serialized game is truncated")
+        
+        (_, _, phase, player_turn, flags, turn, step, armies_to_deploy, 
+         mandatory_occupation_armies, occupation_from_ter, occupation_to_ter, 
+         occupation_player_elimination, n_sets_traded_in, winner, n_deck) = header[:15]
+        hand_sizes = rng[4:]
+        i += _RNG.size
+        if not 3 <= n_players <= MAX_PLAYERS:
+            raise ValueError("Serialized game has {} players".format(n_players))
+        if (not PHASE_SETUP <= phase <= PHASE_GAME_END or not 0 <= player_turn < n_players 
+                or flags >> 3 or turn < 0 or step < 0):
+            raise ValueError("Serialized game has an invalid phase, turn or flags")
+        if (not -1 <= occupation_from_ter < n_territories or not -1 <= occupation_to_ter < n_territories
+                or (phase == PHASE_OCCUPATION and (occupation_from_ter == -1 or occupation_to_ter == -1))
+                or not -1 <= occupation_player_elimination < n_players or not -1 <= winner < n_players):
+            raise ValueError("Serialized game has an invalid occupation or winner")
+        if not all(-1 <= owner < n_players for owner in board[:n_territories]):
+            raise ValueError("Serialized game has a territory with an invalid owner")
+        if any(hand_sizes[n_players:]) or i + sum(hand_sizes) + n_deck != len(data) or n_deck > N_CARDS:
+            raise ValueError("Serialized game has the wrong size")
+        cards = data[i:]
+        if any(card >= N_CARDS for card in cards) or len(set(cards)) != len(cards):
+            raise ValueError("Serialized game has invalid or repeated cards")
+        
+        if (fingerprint, n_players) not in _template_games:
+            template = RiskGame.__new__(RiskGame)
+            template._set_topology(topology)
+            template.seed(0)
+            template.new_game(n_players)
+            _template_games[(fingerprint, n_players)] = template
+        (<RiskGame> _template_games[(fingerprint, n_players)]).copy_into(self, False)
+        
+        self.phase = phase
+        self.player_turn = player_turn
+        self.turn = turn
+        self.step = step
+        self.armies_to_deploy = armies_to_deploy
+        self.mandatory_occupation_armies = mandatory_occupation_armies
+        self.occupation_from_ter = occupation_from_ter
+        self.occupation_to_ter = occupation_to_ter
+        self.occupation_player_elimination = occupation_player_elimination
+        self.n_sets_traded_in = n_sets_traded_in
+        self.winner = winner
+        for player in range(MAX_PLAYERS):
+            self.setup_armies_to_place[player] = header[15 + player]
+        self.player_has_taken_territory_this_turn = flags & 1
+        self.elimination_player_trade = (flags >> 1) & 1
+        self.is_determinized = (flags >> 2) & 1
+        
+        for t in range(n_territories):
+            self._set_owner(t, board[t])
+            self._add_armies(t, board[n_territories + t] - self.armies[t])
+        
+        self.set_rng_state(rng[:4])
+        for player in range(n_players):
+            for card in data[i:i + hand_sizes[player]]:
+                self._give_card(player, card)
+            i += hand_sizes[player]
+        for t in range(n_deck):
+            self.deck[t] = data[i + t]
+        self.deck_size = n_deck
+        
+        self.attack_dirty = self.territory_mask
+        self.fortify_dirty = self.attack_dirty
+        self.compute_legal_actions()
+    
+    @staticmethod
+    def from_bytes(data):
+        return game_from_bytes(data)
+    
+    def __reduce__(self):
+        return (game_from_bytes, (self.to_bytes(),))
+    
+    cpdef unsigned long long compute_hash(self):
+        """Computes get_hash from scratch, to check the incremental hash."""
+        cdef unsigned long long board_hash = self.board_hash
+        cdef unsigned long long h
+        cdef unsigned long long[MAX_PLAYERS] hand_hashes
+        memcpy(hand_hashes, self.hands.hashes, sizeof(hand_hashes))
+        self.board_hash = self._compute_board_hash()
+        self._hash_all_hands()
+        h = self._hash_scalars()
+        self.board_hash = board_hash
+        memcpy(self.hands.hashes, hand_hashes, sizeof(hand_hashes))
+        return h
+    
     cpdef void compute_legal_actions(self):
-        if self.state == 'setup':
+        if self.phase == PHASE_SETUP:
             self.compute_setup_legal_actions()
-        elif self.state == 'setup_deployment':
+        elif self.phase == PHASE_SETUP_DEPLOYMENT:
             self.compute_setup_deployment_legal_actions()
-        elif self.state == 'reinforcement':
+        elif self.phase == PHASE_REINFORCEMENT:
             self.compute_reinforcement_legal_actions()
-        elif self.state == 'attack':
+        elif self.phase == PHASE_ATTACK:
             self.compute_attack_legal_actions()
-        elif self.state == 'occupation':
+        elif self.phase == PHASE_OCCUPATION:
             self.compute_occupation_legal_actions()
-        elif self.state == 'trading':
+        elif self.phase == PHASE_TRADING:
             self.compute_trading_legal_actions()
-        elif self.state == 'fortify':
+        elif self.phase == PHASE_FORTIFY:
             self.compute_fortify_legal_actions()
         else:
-            assert self.state == 'game_end'
+            assert self.phase == PHASE_GAME_END
             self.legal_actions = []
         
-        self.legal_actions = sorted(self.legal_actions)
+        self.legal_actions_stale = False
         
     cpdef void compute_setup_legal_actions(self):
-        cdef str node
-        self.legal_actions = [node for node in self.territory_data if self.territory_data[node]['owner'] == -1]
+        self.legal_actions = self._get_player_territories(-1)
         
     cpdef void compute_setup_deployment_legal_actions(self):
-        cdef str node
-        self.legal_actions = [node for node in self.territory_data if self.territory_data[node]['owner'] == self.player_turn]
+        self.legal_actions = self._get_player_territories(self.player_turn)
 
     cpdef void compute_reinforcement_legal_actions(self):
-        cdef str node
-        self.legal_actions = [node for node in self.territory_data if self.territory_data[node]['owner'] == self.player_turn]
+        self.legal_actions = self._get_player_territories(self.player_turn)
+        
+    cdef list _get_attack_chunk(self, int t):
+        cdef int n_dice, i
+        cdef mask_t targets
+        cdef str node, neighbor_node
+        cdef list chunk
+        
+        if not (self.attack_dirty >> t) & 1:
+            return self.attack_chunks[t]
+        
+        chunk = []
+        n_dice = min(self.armies[t] - 1, 3)
+        if n_dice > 0:
+            node = self.territory_names[t]
+            targets = self._hostile_neighbor_mask(t)
+            while targets:
+                neighbor_node = self.territory_names[lowest_bit(targets)]
+                targets &= targets - 1
+                for i in range(1, n_dice + 1):
+                    chunk.append((node, neighbor_node, i))
+        self.attack_chunks[t] = chunk
+        self.attack_dirty &= ~((<mask_t>1) << t)
+        return chunk
+        
+    cdef list _get_fortify_chunk(self, int t):
+        cdef int i
+        cdef mask_t targets
+        cdef str node, neighbor_node
+        cdef list chunk
+        
+        if not (self.fortify_dirty >> t) & 1:
+            return self.fortify_chunks[t]
+        
+        chunk = []
+        if self.owners[t] != -1:
+            node = self.territory_names[t]
+            targets = self.neighbor_masks[t] & self.owner_masks[self.owners[t]]
+            while targets:
+                neighbor_node = self.territory_names[lowest_bit(targets)]
+                targets &= targets - 1
+                for i in range(1, self.armies[t]):
+                    chunk.append((node, neighbor_node, i))
+        self.fortify_chunks[t] = chunk
+        self.fortify_dirty &= ~((<mask_t>1) << t)
+        return chunk
         
     cpdef void compute_attack_legal_actions(self):
-        cdef str neighbor_node
-        cdef str node
-        self.legal_actions = [('pass', 'pass', 0)]
-        for node in self.get_player_territories(self.player_turn):
-            if self.territory_data[node]['armies'] >= 2:
-                for neighbor_node in self.get_hostile_neighbors(node):
-                    if self.territory_data[node]['armies'] >= 4:
-                        self.legal_actions.append((node, neighbor_node, 3))
-                        self.legal_actions.append((node, neighbor_node, 2))
-                        self.legal_actions.append((node, neighbor_node, 1))
-                    elif self.territory_data[node]['armies'] == 3:
-                        self.legal_actions.append((node, neighbor_node, 2))
-                        self.legal_actions.append((node, neighbor_node, 1))
-                    else:
-                        self.legal_actions.append((node, neighbor_node, 1))
+        cdef mask_t territories = self.owner_masks[self.player_turn]
+        self.legal_actions = [ATTACK_PASS]
+        while territories:
+            self.legal_actions.extend(self._get_attack_chunk(lowest_bit(territories)))
+            territories &= territories - 1
 
     cpdef void compute_occupation_legal_actions(self):
         cdef int max_n_occupation_troops
-        max_n_occupation_troops = self.territory_data[self.occupation_from_ter]['armies'] - 1
+        max_n_occupation_troops = self.armies[self.occupation_from_ter] - 1
         self.legal_actions = list(range(self.mandatory_occupation_armies, max_n_occupation_troops + 1))
 
     cpdef void compute_trading_legal_actions(self):
-        cdef list player_hand
-        player_hand = self.player_hands[self.player_turn]
-        if self.elimination_player_trade:
-            if len(player_hand) >= 6:
-                self.legal_actions = legal_sets(player_hand)
-            else:
-                self.legal_actions = [(('pass', 'pass'), ('pass', 'pass'), ('pass', 'pass'))]
-        else:
-            if len(player_hand) >= 5:
-                self.legal_actions = legal_sets(player_hand)
-            else:
-                self.legal_actions = legal_sets(player_hand) + [(('pass', 'pass'), ('pass', 'pass'), ('pass', 'pass'))]
+        #Every set trades in the whole hand, so one set stands for all of them
+        self.legal_actions = [self._get_canonical_set(self.player_turn)] if self._can_trade_set() else []
+        if self._can_pass_trade():
+            self.legal_actions.append(TRADE_PASS)
         
     cpdef void compute_fortify_legal_actions(self):
-        cdef str t, t2
+        cdef mask_t territories = self.owner_masks[self.player_turn]
+        self.legal_actions = [FORTIFY_PASS]
+        while territories:
+            self.legal_actions.extend(self._get_fortify_chunk(lowest_bit(territories)))
+            territories &= territories - 1
+    
+    cdef bint _can_place(self, int t) noexcept nogil:
+        if self.phase == PHASE_SETUP:
+            return self.owners[t] == -1
+        elif self.phase == PHASE_SETUP_DEPLOYMENT or self.phase == PHASE_REINFORCEMENT:
+            return self.owners[t] == self.player_turn
+        return False
+    
+    cdef bint _can_attack(self, int from_ter, int to_ter, int n_dice) noexcept nogil:
+        return (self.phase == PHASE_ATTACK and self.owners[from_ter] == self.player_turn
+                and (self._hostile_neighbor_mask(from_ter) >> to_ter) & 1
+                and n_dice >= 1 and n_dice <= 3 and n_dice < self.armies[from_ter])
+    
+    cdef bint _can_occupy(self, int n_armies) noexcept nogil:
+        return (self.phase == PHASE_OCCUPATION and n_armies >= self.mandatory_occupation_armies
+                and n_armies < self.armies[self.occupation_from_ter])
+    
+    cdef bint _can_fortify(self, int from_ter, int to_ter, int n_armies) noexcept nogil:
+        return (self.phase == PHASE_FORTIFY and self.owners[from_ter] == self.player_turn
+                and (self.neighbor_masks[from_ter] & self.owner_masks[self.player_turn]) >> to_ter & 1
+                and n_armies >= 1 and n_armies < self.armies[from_ter])
+    
+    cdef bint _can_trade_set(self) noexcept nogil:
+        cdef int n_cards = popcount(self.hands.cards[self.player_turn])
+        return (self.phase == PHASE_TRADING and (n_cards >= 6 or (n_cards >= 3 and not self.elimination_player_trade))
+                and self._has_set(self.player_turn))
+    
+    cdef bint _can_pass_trade(self) noexcept nogil:
+        cdef int n_cards = popcount(self.hands.cards[self.player_turn])
+        return self.phase == PHASE_TRADING and n_cards < (6 if self.elimination_player_trade else 5)
+    
+    cdef bint _can_trade(self, tuple cards):
         cdef int i
-        self.legal_actions = [('pass', 'pass', 0)]
-        for t in self.get_player_territories(self.player_turn):
-            for t2 in self.G.neighbors(t):
-                if self.territory_data[t]['owner'] == self.territory_data[t2]['owner']:
-                    for i in range(1, self.territory_data[t]['armies']):
-                        self.legal_actions.append((t, t2, i))
+        cdef mask_t held = self.hands.cards[self.player_turn]
+        if not self._can_trade_set() or len(cards) != 3 or not _is_set(*sorted(cards, key=itemgetter(1))):
+            return False
+        for card in cards:
+            if not card in CARD_IDS:
+                return False
+            #Identical cards (the wildcards) take the next id that is held
+            i = CARD_IDS[card]
+            while i < N_CARDS and CARDS[i] == card and not (held >> i) & 1:
+                i += 1
+            if i == N_CARDS or CARDS[i] != card:
+                return False
+            held &= ~((<mask_t>1) << i)
+        return True
+    
+    cdef bint _is_legal_action(self, action):
+        if self.phase == PHASE_SETUP or self.phase == PHASE_SETUP_DEPLOYMENT or self.phase == PHASE_REINFORCEMENT:
+            return action in self.territory_ids and self._can_place(self.territory_ids[action])
+        elif self.phase == PHASE_ATTACK:
+            if action == ATTACK_PASS:
+                return True
+            return self._can_attack(self._tid(action[0]), self._tid(action[1]), action[2])
+        elif self.phase == PHASE_OCCUPATION:
+            return self._can_occupy(action)
+        elif self.phase == PHASE_TRADING:
+            if action == TRADE_PASS:
+                return self._can_pass_trade()
+            return self._can_trade(action)
+        elif self.phase == PHASE_FORTIFY:
+            if action == FORTIFY_PASS:
+                return True
+            return self._can_fortify(self._tid(action[0]), self._tid(action[1]), action[2])
+        return False
         
     cpdef void do_action(self, action):
-        cdef bint recompute_legal_actions
-        cdef str after_state, before_state
-        assert action in self.legal_actions
-        before_state = self.state
-        recompute_legal_actions = True
+        cdef int before_phase = self.phase
+        assert self._is_legal_action(action)
         
-        if self.state == 'setup':
+        if self.phase == PHASE_SETUP:
             self.do_setup_action(action)
-        elif self.state == 'setup_deployment':
+        elif self.phase == PHASE_SETUP_DEPLOYMENT:
             self.do_setup_deployment_action(action)
-        elif self.state == 'reinforcement':
+        elif self.phase == PHASE_REINFORCEMENT:
             self.do_reinforce_action(action)
-        elif self.state == 'attack':
+        elif self.phase == PHASE_ATTACK:
             self.do_attack_action(action)
-        elif self.state == 'occupation':
+        elif self.phase == PHASE_OCCUPATION:
             self.do_occupation_action(action)
-        elif self.state == 'trading':
+        elif self.phase == PHASE_TRADING:
             self.do_trading_action(action)
-        elif self.state == 'fortify':
+        elif self.phase == PHASE_FORTIFY:
             self.do_fortify_action(action)
         else:
             assert False
-            
+        
+        self._after_action(before_phase)
+        
+    cdef inline void _after_action(self, int before_phase) noexcept nogil:
         self.step += 1
-            
-        after_state = self.state
         
-        if before_state == after_state:
-            if after_state in ['reinforcement']:
-                recompute_legal_actions = False
-
-        if recompute_legal_actions:
-            self.compute_legal_actions()
+        #Reinforcing only changes army counts, the legal territories stay the same.
+        #Everything else is rebuilt from the chunks the next time it is requested.
+        if not (before_phase == PHASE_REINFORCEMENT and self.phase == PHASE_REINFORCEMENT):
+            self.legal_actions_stale = True
         
     cpdef void do_setup_action(self, str action):
-        self.territory_data[action]['armies'] = 1
-        self.territory_data[action]['owner'] = self.player_turn
+        self._do_setup(self._tid(action))
+        
+    cdef void _do_setup(self, int t) noexcept nogil:
+        self._set_owner(t, self.player_turn)
+        self._add_armies(t, 1 - self.armies[t])
         self.setup_armies_to_place[self.player_turn] -= 1
         
-        self.increment_player_turn()
+        self._increment_player_turn()
         
-        if self.n_unclaimed_territories() == 0:
-            self.state = 'setup_deployment'
+        if self.unclaimed_mask == 0:
+            self.phase = PHASE_SETUP_DEPLOYMENT
 
     cpdef void do_setup_deployment_action(self, str action):
-        self.territory_data[action]['armies'] += 1
+        self._do_setup_deployment(self._tid(action))
+        
+    cdef void _do_setup_deployment(self, int t) noexcept nogil:
+        self._add_armies(t, 1)
         self.setup_armies_to_place[self.player_turn] -= 1
         
-        self.increment_player_turn()
+        self._increment_player_turn()
         if self.setup_armies_to_place[self.player_turn] == 0:
             self.player_turn = 0
-            self.state = 'reinforcement'
-            self.compute_armies_to_deploy()
+            self.phase = PHASE_REINFORCEMENT
+            self._compute_armies_to_deploy()
             
     cpdef void do_reinforce_action(self, str action):
-        self.territory_data[action]['armies'] += 1
+        self._do_reinforce(self._tid(action))
+        
+    cdef void _do_reinforce(self, int t) noexcept nogil:
+        self._add_armies(t, 1)
         self.armies_to_deploy -= 1
         
         if self.armies_to_deploy == 0:
-            self.state = 'attack'
+            self.phase = PHASE_ATTACK
             
     cpdef tuple get_determinized_casaulties(self, int n_atk_dice, int n_def_dice):
-        if n_atk_dice == 3:
-            if n_def_dice == 2:
-                return (1, 1)
-            else:
-                return (0, 1)
-        elif n_atk_dice == 2:
-            if n_def_dice == 1:
-                return (1, 0)
-            else:
-                return (2, 0)
-        else:
-            return (1, 0)
+        cdef int atk_casaulties, def_casualties
+        _determinized_casaulties(n_atk_dice, n_def_dice, &atk_casaulties, &def_casualties)
+        return (atk_casaulties, def_casualties)
             
     cpdef void do_attack_action(self, tuple action):
-        cdef str from_ter, to_ter
-        cdef int n_atk_armies, n_atk_dice, n_def_armies, n_def_dice
+        if action == ATTACK_PASS:
+            self._do_attack_pass()
+        else:
+            self._do_attack(self._tid(action[0]), self._tid(action[1]), action[2])
+            
+    cdef void _do_attack_pass(self) noexcept nogil:
+        self.phase = PHASE_FORTIFY
+            
+    cdef void _do_attack(self, int from_ter, int to_ter, int n_atk_dice) noexcept nogil:
+        cdef int n_def_armies, n_def_dice
         cdef int atk_casaulties, def_casualties, i
-        cdef list atk_dice, def_dice
+        cdef int dice[5]
         
-        if action == ('pass', 'pass', 0):
-            self.state = 'fortify'
-        else:
-            from_ter = action[0]
-            to_ter = action[1]
-            n_atk_armies = action[2]
-            n_atk_dice = n_atk_armies
-            n_def_armies = self.territory_data[to_ter]['armies']
-            n_def_dice = min(n_def_armies, 2)
-            atk_casaulties = 0
-            def_casualties = 0
+        n_def_armies = self.armies[to_ter]
+        n_def_dice = min(n_def_armies, 2)
+        atk_casaulties = 0
+        def_casualties = 0
+        
+        if not self.is_determinized:
+            #Attacker dice first, then defender dice
+            self._roll_dice(dice, n_atk_dice + n_def_dice)
+            _sort_descending(dice, n_atk_dice)
+            _sort_descending(dice + n_atk_dice, n_def_dice)
             
-            if not self.is_determinized:
-                atk_dice = sorted([random.randint(1, 6) for _ in range(n_atk_dice)], reverse=True)
-                def_dice = sorted([random.randint(1, 6) for _ in range(n_def_dice)], reverse=True)
-                
-                for i in range(min(n_atk_dice, n_def_dice)):
-                    if atk_dice[i] > def_dice[i]:
-                        def_casualties += 1
-                    else:
-                        atk_casaulties += 1
-            else:
-                (atk_casaulties, def_casualties) = self.get_determinized_casaulties(n_atk_dice, n_def_dice)
+            for i in range(min(n_atk_dice, n_def_dice)):
+                if dice[i] > dice[n_atk_dice + i]:
+                    def_casualties += 1
+                else:
+                    atk_casaulties += 1
+        else:
+            _determinized_casaulties(n_atk_dice, n_def_dice, &atk_casaulties, &def_casualties)
+        
+        self._apply_attack_result(from_ter, to_ter, n_atk_dice, atk_casaulties, def_casualties)
+    
+    cdef void _apply_attack_result(self, int from_ter, int to_ter, int n_atk_dice, int atk_casaulties, int def_casualties) noexcept nogil:
+        self._add_armies(from_ter, -atk_casaulties)
+        self._add_armies(to_ter, -def_casualties)
+        
+        if self.armies[to_ter] == 0:
+            #Conquest
+            self.mandatory_occupation_armies = n_atk_dice - atk_casaulties
+            self.phase = PHASE_OCCUPATION
+            self.player_has_taken_territory_this_turn = True
+            self.occupation_from_ter = from_ter
+            self.occupation_to_ter = to_ter
+            if self._n_player_territories(self.owners[to_ter]) == 1:
+                self.occupation_player_elimination = self.owners[to_ter]
+
+            self._set_owner(to_ter, self.owners[from_ter])
             
-            self.territory_data[from_ter]['armies'] -= atk_casaulties
-            self.territory_data[to_ter]['armies'] -= def_casualties
+            if self._n_player_territories(self.owners[from_ter]) == self.n_territories:
+                #Game was won
+                self.phase = PHASE_GAME_END
+                self.winner = self.owners[from_ter]
             
-            assert self.territory_data[from_ter]['armies'] >= 1
-            if self.territory_data[to_ter]['armies'] == 0:
-                #Conquest
-                self.mandatory_occupation_armies = n_atk_armies - atk_casaulties
-                self.state = 'occupation'
-                self.player_has_taken_territory_this_turn = True
-                self.occupation_from_ter = from_ter
-                self.occupation_to_ter = to_ter
-                if len(self.get_player_territories(self.territory_data[to_ter]['owner'])) == 1:
-                    self.occupation_player_elimination = self.territory_data[to_ter]['owner']
-
-                self.territory_data[to_ter]['owner'] = self.territory_data[from_ter]['owner']
-                
-                if len(self.get_player_territories(self.territory_data[from_ter]['owner'])) == 42:
-                    #Game was won
-                    self.state = 'game_end'
-                    self.winner = self.territory_data[from_ter]['owner']
+    cpdef void resolve_attack(self, str from_ter, str to_ter, int n_dice):
+        """Repeats an attack until it conquers the territory or is no longer
+        legal, the same as doing it with do_action over and over. Every roll
+        is sampled from the roll outcome table and counts as a step."""
+        cdef int ft = self._tid(from_ter)
+        cdef int tt = self._tid(to_ter)
+        assert self._can_attack(ft, tt, n_dice)
+        self._resolve_attack(ft, tt, n_dice)
+    
+    cdef void _resolve_attack(self, int ft, int tt, int n_dice) noexcept nogil:
+        cdef int n_def_dice, n_fought, atk_casaulties, def_casualties
+        cdef double u
+        while self._can_attack(ft, tt, n_dice):
+            n_def_dice = min(self.armies[tt], 2)
+            if self.is_determinized:
+                _determinized_casaulties(n_dice, n_def_dice, &atk_casaulties, &def_casualties)
+                self._apply_attack_result(ft, tt, n_dice, atk_casaulties, def_casualties)
+            else:
+                n_fought = min(n_dice, n_def_dice)
+                u = self._random_unit()
+                atk_casaulties = 0
+                while atk_casaulties < n_fought and u >= roll_loss_probabilities[n_dice][n_def_dice][atk_casaulties]:
+                    u -= roll_loss_probabilities[n_dice][n_def_dice][atk_casaulties]
+                    atk_casaulties += 1
+                self._apply_attack_result(ft, tt, n_dice, atk_casaulties, n_fought - atk_casaulties)
+            self._after_action(PHASE_ATTACK)
+    
+    cpdef bint attack_until(self, str from_ter, str to_ter, int n_dice, int stop_armies=0):
+        """Repeats an attack with rolled dice until it conquers the territory,
+        is no longer legal or leaves the attacker with stop_armies armies or
+        fewer. The same as doing it with do_action over and over, with the 
+        same dice. Returns whether the territory was conquered."""
+        cdef int ft = self._tid(from_ter)
+        cdef int tt = self._tid(to_ter)
+        assert self._can_attack(ft, tt, n_dice)
+        
+        while self._can_attack(ft, tt, n_dice) and self.armies[ft] > stop_armies:
+            self._do_attack(ft, tt, n_dice)
+            self._after_action(PHASE_ATTACK)
+        return self.owners[tt] == self.owners[ft]
+    
+    cpdef void reinforce(self, str territory, int n_armies):
+        """Places n_armies armies on a territory, the same as n_armies 
+        reinforcement actions."""
+        cdef int t = self._tid(territory)
+        cdef int i
+        assert self._can_place(t) and self.phase == PHASE_REINFORCEMENT
+        assert n_armies >= 1 and n_armies <= self.armies_to_deploy
+        
+        for i in range(n_armies):
+            self._do_reinforce(t)
+            self._after_action(PHASE_REINFORCEMENT)
+    
+    cpdef void apply_turn_plan(self, plan) except *:
+        """Makes each move of plan the way BaseAgent.do_actions_to_game does:
+        a reinforcement places a fifth of the armies to deploy, an attack is
+        resolved with resolve_attack and an attack pass also passes the 
+        fortification. Raises ValueError and leaves the game as it was if a
+        move is not legal when its turn comes."""
+        cdef bint legal
+        cdef bint atomic = len(plan) > 1
+        if atomic:
+            self._push_undo_record()
+        try:
+            for action in plan:
+                try:
+                    legal = self._is_legal_action(action)
+                except (AssertionError, IndexError, TypeError):
+                    legal = False
+                if not legal:
+                    raise ValueError("{} is not legal in phase {}".format(action, self.get_state()))
+                if self.phase == PHASE_REINFORCEMENT:
+                    self.reinforce(action, (self.armies_to_deploy - 1) // 5 + 1)
+                elif self.phase == PHASE_ATTACK and action != ATTACK_PASS:
+                    self.resolve_attack(action[0], action[1], action[2])
+                elif self.phase == PHASE_ATTACK:
+                    #ATTACK_PASS and FORTIFY_PASS are the same action
+                    self.do_action(ATTACK_PASS)
+                    self.do_action(FORTIFY_PASS)
+                else:
+                    self.do_action(action)
+        except:
+            if atomic:
+                self.pop_action()
+            raise
+        if atomic:
+            self._drop_undo_record()
+    
+    cpdef double get_attack_win_probability(self, str from_ter, str to_ter, int n_dice):
+        """Probability that resolve_attack conquers to_ter."""
+        return get_attack_win_probability(self.armies[self._tid(from_ter)], self.armies[self._tid(to_ter)], n_dice)
             
     cpdef void do_occupation_action(self, int action):
-        cdef int n_armies_to_move
-        n_armies_to_move = action
-        self.territory_data[self.occupation_from_ter]['armies'] -= n_armies_to_move
-        self.territory_data[self.occupation_to_ter]['armies'] += n_armies_to_move
+        self._do_occupation(action)
+        
+    cdef void _do_occupation(self, int n_armies_to_move) noexcept nogil:
+        cdef mask_t cards
+        self._add_armies(self.occupation_from_ter, -n_armies_to_move)
+        self._add_armies(self.occupation_to_ter, n_armies_to_move)
         
         if self.occupation_player_elimination != -1:
-            self.player_hands[self.player_turn].extend(self.player_hands[self.occupation_player_elimination])
-            self.player_hands[self.occupation_player_elimination].clear()
-            if len(self.player_hands[self.player_turn]) >= 6:
+            cards = self.hands.cards[self.occupation_player_elimination]
+            self._clear_hand(self.occupation_player_elimination)
+            while cards:
+                self._give_card(self.player_turn, lowest_bit(cards))
+                cards &= cards - 1
+            if popcount(self.hands.cards[self.player_turn]) >= 6:
                 #Do mandatory trading and reinforcement
                 self.elimination_player_trade = True
                 self.armies_to_deploy = 0
-                self.state = 'trading'
+                self.phase = PHASE_TRADING
             else:
-                self.state = 'attack'
+                self.phase = PHASE_ATTACK
         else:
-            self.state = 'attack'
+            self.phase = PHASE_ATTACK
             
         self.mandatory_occupation_armies = 0
-        self.occupation_from_ter = None
-        self.occupation_to_ter = None
+        self.occupation_from_ter = -1
+        self.occupation_to_ter = -1
         self.occupation_player_elimination = -1
                     
     cpdef void do_trading_action(self, tuple action):
-        cdef list player_hand, set_indices
-        cdef str ter_name
-        cdef tuple card, cards
-        cdef int i, player_turn
-        
-        if action == (('pass', 'pass'), ('pass', 'pass'), ('pass', 'pass')):
-            if self.elimination_player_trade:
-                if self.armies_to_deploy > 0:
-                    self.state = 'reinforcement'
-                    self.elimination_player_trade = False
-                else:
-                    assert False
-            else:
-                self.compute_armies_to_deploy()
-                self.state = 'reinforcement'
+        if action == TRADE_PASS:
+            self._do_trade_pass()
         else:
-            player_turn = self.player_turn
-            player_hand = self.player_hands[self.player_turn]
-            cards = action
+            self._do_trade()
             
-            set_indices = [player_hand.index(card) for card in player_hand]
-    
-            for i in set_indices:
-                ter_name = player_hand[i][0]
-                if ter_name != 'null' and self.territory_data[ter_name]['owner'] == player_turn:
-                    self.territory_data[ter_name]['armies'] += 2
-    
-            new_player_hand = [player_hand[i] for i in range(len(player_hand)) if not i in set_indices]
-            self.player_hands[player_turn] = new_player_hand
-                    
-            self.armies_to_deploy += self.get_n_reinforcements_for_set()
-            self.n_sets_traded_in += 1
+    cdef void _do_trade_pass(self) noexcept nogil:
+        if self.elimination_player_trade:
+            #_can_pass_trade only allows this after the mandatory trade
+            self.phase = PHASE_REINFORCEMENT
+            self.elimination_player_trade = False
+        else:
+            self._compute_armies_to_deploy()
+            self.phase = PHASE_REINFORCEMENT
+            
+    cdef void _do_trade(self) noexcept nogil:
+        cdef int player_turn = self.player_turn
+        cdef mask_t bonus_territories = self.hands.territories[player_turn] & self.owner_masks[player_turn]
+        
+        #The whole hand is traded in, each card of an owned territory gives 2 armies
+        while bonus_territories:
+            self._add_armies(lowest_bit(bonus_territories), 2)
+            bonus_territories &= bonus_territories - 1
+        self._clear_hand(player_turn)
+                
+        self.armies_to_deploy += (self.n_sets_traded_in + 1) * 5
+        self.n_sets_traded_in += 1
             
     cpdef int get_n_reinforcements_for_set(self):
         return (self.n_sets_traded_in + 1) * 5
         
     cpdef void do_fortify_action(self, tuple action):
-        cdef str ft, tt
-        cdef int n_armies
+        if action == FORTIFY_PASS:
+            self._do_fortify_pass()
+        else:
+            self._do_fortify(self._tid(action[0]), self._tid(action[1]), action[2])
+            
+    cdef void _do_fortify(self, int from_ter, int to_ter, int n_armies) noexcept nogil:
+        self._add_armies(to_ter, n_armies)
+        self._add_armies(from_ter, -n_armies)
+        self._do_fortify_pass()
         
-        if action != ('pass', 'pass', 0):
-            (ft, tt, n_armies) = action
-            self.territory_data[tt]['armies'] += n_armies
-            self.territory_data[ft]['armies'] -= n_armies
+    cdef void _do_fortify_pass(self) noexcept nogil:
         if self.player_has_taken_territory_this_turn:
             self.player_has_taken_territory_this_turn = False
-            if len(self.deck) > 0:
-                self.player_hands[self.player_turn].append(self.deck.pop())
+            if self.deck_size > 0:
+                self.deck_size -= 1
+                self._give_card(self.player_turn, self.deck[self.deck_size])
         
         self.armies_to_deploy = 0
-        self.increment_player_turn()
-        self.state = 'trading'
+        self._increment_player_turn()
+        self.phase = PHASE_TRADING
         
-    cpdef int get_reinforcement_amount(self, player: int):
-        amount = max(math.floor(len(self.get_player_territories(player)) / 3), 3)
-        amount += self.get_continent_troop_bonuses(player)
-        return amount        
+    cpdef int get_reinforcement_amount(self, int player):
+        return self._reinforcement_amount(player)
+    
+    cdef int _reinforcement_amount(self, int player) noexcept nogil:
+        return max(self._n_player_territories(player) // 3, 3) + self._continent_troop_bonuses(player)
         
     cpdef compute_armies_to_deploy(self):
-        self.armies_to_deploy += self.get_reinforcement_amount(self.player_turn)
+        self._compute_armies_to_deploy()
+    
+    cdef void _compute_armies_to_deploy(self) noexcept nogil:
+        self.armies_to_deploy += self._reinforcement_amount(self.player_turn)
         
     cpdef increment_player_turn(self):
+        self._increment_player_turn()
+    
+    cdef void _increment_player_turn(self) noexcept nogil:
+        cdef bint in_setup = self.phase == PHASE_SETUP or self.phase == PHASE_SETUP_DEPLOYMENT
         self.player_turn = (self.player_turn + 1) % self.n_players
-        if self.player_turn == 0 and not self.state in ['setup', 'setup_deployment']:
+        if self.player_turn == 0 and not in_setup:
             self.turn += 1
             
-        if not self.state in ['setup', 'setup_deployment']:
-            while len(self.get_player_territories(self.player_turn)) == 0:
+        if not in_setup:
+            while self._n_player_territories(self.player_turn) == 0:
                 self.player_turn = (self.player_turn + 1) % self.n_players
-                if self.player_turn == 0 and not self.state in ['setup', 'setup_deployment']:
+                if self.player_turn == 0:
                     self.turn += 1
     
+    cdef int _n_player_territories(self, int player) noexcept nogil:
+        return popcount(self._owner_mask(player))
+    
+    cdef list _get_player_territories(self, int player):
+        return self._mask_to_names(self._owner_mask(player))
+    
     cpdef int n_unclaimed_territories(self):
-        cdef str node
-        return sum([1 for node in self.territory_data if self.territory_data[node]['owner'] == -1])
+        return self._n_player_territories(-1)
     
     cpdef list get_player_territories(self, int player):
-        cdef str node
-        return [node for node in self.territory_data if self.territory_data[node]['owner'] == player]
+        return self._get_player_territories(player)
     
     cpdef list get_hostile_neighbors(self, str node):
-        cdef str neighbor_node
-        return [neighbor_node for neighbor_node in self.G.neighbors(node) if self.territory_data[node]['owner'] != self.territory_data[neighbor_node]['owner']]
+        return self._mask_to_names(self._hostile_neighbor_mask(self._tid(node)))
     
     cpdef bint has_hostile_neighbor(self, str node):
-        cdef str neighbor
-        
-        for neighbor in self.G.neighbors(node):
-            if self.territory_data[node]['owner'] != self.territory_data[neighbor]['owner']:
-                return True
-        return False
+        return self._hostile_neighbor_mask(self._tid(node)) != 0
     
     cpdef bint has_continent(self, int player, tuple continent):
-        cdef int n_matching_ters
-        cdef set continent_ters
-        cdef list player_ters
+        cdef int c
         
         assert continent in self.continents
-        continent_ters = set(self.continents[continent])
-        player_ters = self.get_player_territories(player)
-        n_matching_ters = sum([1 for ter in player_ters if ter in continent_ters])
-        return n_matching_ters == len(self.continents[continent])
+        c = self.continent_keys.index(continent)
+        if player == -1:
+            return (self.unclaimed_mask & self.continent_masks[c]) == self.continent_masks[c]
+        return self.player_continent_counts[player][c] == self.continent_sizes[c]
 
     cpdef int get_continent_troop_bonuses(self, int player):
-        cdef int n_bonus_troops
-        cdef tuple continent
+        return self._continent_troop_bonuses(player)
+    
+    cdef int _continent_troop_bonuses(self, int player) noexcept nogil:
+        cdef int n_bonus_troops, i
+        
+        if player != -1:
+            return self.player_continent_bonuses[player]
         
         n_bonus_troops = 0
-        for continent in self.continents:
-            if self.has_continent(player, continent):
-                n_bonus_troops += continent[1]
+        for i in range(self.n_continents):
+            if (self.unclaimed_mask & self.continent_masks[i]) == self.continent_masks[i]:
+                n_bonus_troops += self.continent_bonuses[i]
         return n_bonus_troops
     
     cpdef void make_new_deck(self):
-        self.deck = get_new_deck()
+        cdef int i, j
+        for i in range(N_CARDS):
+            self.deck[i] = i
+        for i in range(N_CARDS - 1, 0, -1):
+            j = self._randint(i + 1)
+            (self.deck[i], self.deck[j]) = (self.deck[j], self.deck[i])
+        self.deck_size = N_CARDS
         
-    def copy(self, bint is_determinized):
-        cdef str node
-        cdef tuple card
-        
-        new_game = copy.copy(self)
-        new_game.set_territory_data({node: copy.copy(self.territory_data[node]) for node in self.territory_data})
-        new_game.set_setup_armies_to_place([x for x in self.setup_armies_to_place])
-        new_game.set_player_hands([[card for card in hand] for hand in self.player_hands])
-        new_game.set_deck([card for card in self.deck])
-        new_game.set_determinization(is_determinized)
+    def copy(self, bint is_determinized, bint fork_rng=False):
+        cdef RiskGame new_game = RiskGame.__new__(RiskGame)
+        self.copy_into(new_game, is_determinized, fork_rng)
         return new_game
     
+    cpdef void copy_into(self, RiskGame dst, bint is_determinized=False, bint fork_rng=False):
+        """Overwrites dst with this game, reusing the lists dst already has.
+        The undo stack of dst is cleared, the undo stack of this game is not
+        copied. dst continues with the random state of this game, so it rolls
+        the dice this game would. With fork_rng this game jumps ahead to an 
+        independent stream instead, so repeated copies of a game roll 
+        different dice; otherwise this game is left untouched."""
+        cdef int player
+        
+        if dst.topology is not self.topology:
+            dst._set_topology(self.topology)
+        
+        dst.n_players = self.n_players
+        dst.player_turn = self.player_turn
+        dst.turn = self.turn
+        dst.step = self.step
+        dst.armies_to_deploy = self.armies_to_deploy
+        dst.mandatory_occupation_armies = self.mandatory_occupation_armies
+        dst.phase = self.phase
+        dst.occupation_from_ter = self.occupation_from_ter
+        dst.occupation_to_ter = self.occupation_to_ter
+        dst.occupation_player_elimination = self.occupation_player_elimination
+        dst.player_has_taken_territory_this_turn = self.player_has_taken_territory_this_turn
+        dst.elimination_player_trade = self.elimination_player_trade
+        dst.n_sets_traded_in = self.n_sets_traded_in
+        dst.winner = self.winner
+        dst.is_determinized = is_determinized
+        memcpy(dst.rng_state, self.rng_state, sizeof(self.rng_state))
+        if fork_rng:
+            self._jump_random()
+        
+        memcpy(dst.owners, self.owners, sizeof(self.owners))
+        memcpy(dst.armies, self.armies, sizeof(self.armies))
+        memcpy(dst.owner_masks, self.owner_masks, sizeof(self.owner_masks))
+        dst.unclaimed_mask = self.unclaimed_mask
+        dst.total_armies = self.total_armies
+        memcpy(dst.player_armies, self.player_armies, sizeof(self.player_armies))
+        memcpy(dst.player_continent_counts, self.player_continent_counts, sizeof(self.player_continent_counts))
+        memcpy(dst.player_continent_bonuses, self.player_continent_bonuses, sizeof(self.player_continent_bonuses))
+        dst.board_hash = self.board_hash
+        dst.hands = self.hands
+        memcpy(dst.setup_armies_to_place, self.setup_armies_to_place, sizeof(self.setup_armies_to_place))
+        memcpy(dst.deck, self.deck, self.deck_size)
+        dst.deck_size = self.deck_size
+        
+        #Legal actions and chunks are never changed in place, so they can be shared
+        dst.legal_actions = self.legal_actions
+        dst.legal_actions_stale = self.legal_actions_stale
+        dst.attack_dirty = self.attack_dirty
+        dst.fortify_dirty = self.fortify_dirty
+        if dst.attack_chunks is None:
+            dst.attack_chunks = list(self.attack_chunks)
+            dst.fortify_chunks = list(self.fortify_chunks)
+        else:
+            dst.attack_chunks[:] = self.attack_chunks
+            dst.fortify_chunks[:] = self.fortify_chunks
+        
+        dst.undo_records.clear()
+        dst.journal_size = 0
+        dst.journal_enabled = False
+        dst.journaled_mask = 0
+    
     cpdef void set_territory_data(self, territory_data):
-        self.territory_data = territory_data
+        cdef int t
+        for node in territory_data:
+            t = self._tid(node)
+            self._add_armies(t, territory_data[node]['armies'] - self.armies[t])
+            self._set_owner(t, territory_data[node]['owner'])
         
     cpdef void set_setup_armies_to_place(self, setup_armies_to_place):
-        self.setup_armies_to_place = setup_armies_to_place
+        cdef int player
+        for player in range(self.n_players):
+            self.setup_armies_to_place[player] = setup_armies_to_place[player]
         
     cpdef void set_player_hands(self, player_hands):
-        self.player_hands = player_hands
+        cdef int player
+        for player in range(self.n_players):
+            self._set_hand(player, player_hands[player])
         
     cpdef void set_deck(self, deck):
-        self.deck = deck
+        """Sets the deck from a list of cards, the last card is drawn first.
+        Identical cards take ids that are in no hand."""
+        cdef int i, n, player
+        cdef mask_t used = 0
+        for player in range(self.n_players):
+            used |= self.hands.cards[player]
+        assert len(deck) <= N_CARDS
+        for (n, card) in enumerate(deck):
+            i = CARD_IDS[card]
+            while (used >> i) & 1:
+                i += 1
+            assert i < N_CARDS and CARDS[i] == card
+            used |= (<mask_t>1) << i
+            self.deck[n] = i
+        self.deck_size = len(deck)
+        
+    cpdef list get_deck(self):
+        return [CARDS[self.deck[i]] for i in range(self.deck_size)]
             
     cpdef bint has_finished(self):
-        return self.state == 'game_end'
+        return self.phase == PHASE_GAME_END
     
     cpdef list get_legal_actions(self):
+        if self.legal_actions_stale:
+            self.compute_legal_actions()
         return self.legal_actions
     
+    cdef inline int _edge_id(self, int from_ter, int to_ter) noexcept nogil:
+        return self.edge_offsets[from_ter] + popcount(self.neighbor_masks[from_ter] & (((<mask_t>1) << to_ter) - 1))
+    
+    cdef inline bint _is_edge(self, int from_ter, int to_ter) noexcept nogil:
+        return (self.neighbor_masks[from_ter] >> to_ter) & 1
+    
+    cpdef int get_n_actions(self):
+        return self.n_actions
+    
+    cpdef int encode_action(self, action) except -1:
+        """Maps an action of the current phase to its id in the fixed integer
+        action space. The id ranges are, in order: a territory to claim or 
+        reinforce, an attack (edge, n_dice), attack pass, an occupation 
+        amount, a fortification (edge, n_armies), fortify pass, a card set
+        and trade pass. Every set trades in the whole hand, so all sets share
+        one id, which decodes to the canonical set. Occupation and fortification amounts above 
+        MAX_MOVE_ARMIES can not be encoded."""
+        cdef int from_ter, to_ter, n
+        
+        if self.phase == PHASE_SETUP or self.phase == PHASE_SETUP_DEPLOYMENT or self.phase == PHASE_REINFORCEMENT:
+            return self._tid(action)
+        elif self.phase == PHASE_ATTACK or self.phase == PHASE_FORTIFY:
+            if action == ATTACK_PASS:
+                return self.attack_pass_id if self.phase == PHASE_ATTACK else self.fortify_pass_id
+            from_ter = self._tid(action[0])
+            to_ter = self._tid(action[1])
+            n = action[2]
+            if not self._is_edge(from_ter, to_ter):
+                raise ValueError("{} and {} are not neighbors".format(action[0], action[1]))
+            if self.phase == PHASE_ATTACK:
+                if n < 1 or n > 3:
+                    raise ValueError("Can not attack with {} dice".format(n))
+                return self.attack_offset + 3 * self._edge_id(from_ter, to_ter) + n - 1
+            if n < 1 or n > MAX_MOVE_ARMIES:
+                raise ValueError("Can not encode a fortification of {} armies".format(n))
+            return self.fortify_offset + MAX_MOVE_ARMIES * self._edge_id(from_ter, to_ter) + n - 1
+        elif self.phase == PHASE_OCCUPATION:
+            if action < 0 or action > MAX_MOVE_ARMIES:
+                raise ValueError("Can not encode an occupation of {} armies".format(action))
+            return self.occupation_offset + action
+        elif self.phase == PHASE_TRADING:
+            if action == TRADE_PASS:
+                return self.trade_pass_id
+            if len(action) != 3 or not _is_set(*sorted(action, key=itemgetter(1))):
+                raise ValueError("{} is not a set".format(action))
+            #Every set trades in the whole hand, so all sets share one id
+            return self.trade_offset
+        raise ValueError("No actions in state {}".format(self.get_state()))
+    
+    cpdef object decode_action(self, int action_id):
+        cdef int e, i
+        
+        if action_id < 0 or action_id >= self.n_actions:
+            raise ValueError("Action id {} out of range".format(action_id))
+        elif action_id < self.attack_offset:
+            return self.territory_names[action_id]
+        elif action_id < self.attack_pass_id:
+            i = action_id - self.attack_offset
+            e = i // 3
+            return (self.territory_names[self.edge_from[e]], self.territory_names[self.edge_to[e]], i % 3 + 1)
+        elif action_id == self.attack_pass_id:
+            return ATTACK_PASS
+        elif action_id < self.fortify_offset:
+            return action_id - self.occupation_offset
+        elif action_id < self.fortify_pass_id:
+            i = action_id - self.fortify_offset
+            e = i // MAX_MOVE_ARMIES
+            return (self.territory_names[self.edge_from[e]], self.territory_names[self.edge_to[e]], i % MAX_MOVE_ARMIES + 1)
+        elif action_id == self.fortify_pass_id:
+            return FORTIFY_PASS
+        elif action_id == self.trade_offset:
+            if not self._has_set(self.player_turn):
+                raise ValueError("Player {} has no set to trade".format(self.player_turn))
+            return self._get_canonical_set(self.player_turn)
+        return TRADE_PASS
+    
+    cdef bint _is_legal_action_id(self, int action_id) noexcept nogil:
+        cdef int e, i
+        
+        if action_id < 0 or action_id >= self.n_actions:
+            return False
+        elif action_id < self.attack_offset:
+            return self._can_place(action_id)
+        elif action_id < self.attack_pass_id:
+            i = action_id - self.attack_offset
+            e = i // 3
+            return self._can_attack(self.edge_from[e], self.edge_to[e], i % 3 + 1)
+        elif action_id == self.attack_pass_id:
+            return self.phase == PHASE_ATTACK
+        elif action_id < self.fortify_offset:
+            return self._can_occupy(action_id - self.occupation_offset)
+        elif action_id < self.fortify_pass_id:
+            i = action_id - self.fortify_offset
+            e = i // MAX_MOVE_ARMIES
+            return self._can_fortify(self.edge_from[e], self.edge_to[e], i % MAX_MOVE_ARMIES + 1)
+        elif action_id == self.fortify_pass_id:
+            return self.phase == PHASE_FORTIFY
+        elif action_id == self.trade_offset:
+            return self._can_trade_set()
+        return self._can_pass_trade()
+    
+    cpdef bint is_legal_action_id(self, int action_id):
+        return self._is_legal_action_id(action_id)
+    
+    cpdef void do_action_id(self, int action_id):
+        assert self._is_legal_action_id(action_id)
+        self._do_action_id(action_id)
+    
+    cdef void _do_action_id(self, int action_id) noexcept nogil:
+        """do_action_id without the legality check, for callers that only 
+        pick ids from _legal_action_ids."""
+        cdef int before_phase = self.phase
+        cdef int e, i
+        
+        if action_id < self.attack_offset:
+            if self.phase == PHASE_SETUP:
+                self._do_setup(action_id)
+            elif self.phase == PHASE_SETUP_DEPLOYMENT:
+                self._do_setup_deployment(action_id)
+            else:
+                self._do_reinforce(action_id)
+        elif action_id < self.attack_pass_id:
+            i = action_id - self.attack_offset
+            e = i // 3
+            self._do_attack(self.edge_from[e], self.edge_to[e], i % 3 + 1)
+        elif action_id == self.attack_pass_id:
+            self._do_attack_pass()
+        elif action_id < self.fortify_offset:
+            self._do_occupation(action_id - self.occupation_offset)
+        elif action_id < self.fortify_pass_id:
+            i = action_id - self.fortify_offset
+            e = i // MAX_MOVE_ARMIES
+            self._do_fortify(self.edge_from[e], self.edge_to[e], i % MAX_MOVE_ARMIES + 1)
+        elif action_id == self.fortify_pass_id:
+            self._do_fortify_pass()
+        elif action_id == self.trade_offset:
+            self._do_trade()
+        else:
+            self._do_trade_pass()
+        
+        self._after_action(before_phase)
+    
+    cdef void _push_undo_record(self):
+        cdef UndoRecord r = UndoRecord.__new__(UndoRecord)
+        r.phase = self.phase
+        r.player_turn = self.player_turn
+        r.turn = self.turn
+        r.step = self.step
+        r.armies_to_deploy = self.armies_to_deploy
+        r.mandatory_occupation_armies = self.mandatory_occupation_armies
+        r.occupation_from_ter = self.occupation_from_ter
+        r.occupation_to_ter = self.occupation_to_ter
+        r.occupation_player_elimination = self.occupation_player_elimination
+        r.n_sets_traded_in = self.n_sets_traded_in
+        r.winner = self.winner
+        r.player_has_taken_territory_this_turn = self.player_has_taken_territory_this_turn
+        r.elimination_player_trade = self.elimination_player_trade
+        r.legal_actions = self.legal_actions
+        r.legal_actions_stale = self.legal_actions_stale
+        r.journal_mark = self.journal_size
+        r.journaled_mask = self.journaled_mask
+        self._reserve_journal(self.journal_size + self.n_territories)
+        self.journaled_mask = 0
+        
+        memcpy(r.setup_armies_to_place, self.setup_armies_to_place, sizeof(self.setup_armies_to_place))
+        r.hands = self.hands
+        r.deck_size = self.deck_size
+        memcpy(r.rng_state, self.rng_state, sizeof(self.rng_state))
+        
+        self.undo_records.append(r)
+        self.journal_enabled = True
+    
+    cdef void _reserve_journal(self, int capacity):
+        cdef TerritoryRecord *journal
+        if capacity <= self.journal_capacity:
+            return
+        capacity = max(capacity, 2 * self.journal_capacity)
+        journal = <TerritoryRecord *> realloc(self.journal, capacity * sizeof(TerritoryRecord))
+        if journal == NULL:
+            raise MemoryError()
+        self.journal = journal
+        self.journal_capacity = capacity
+    
+    cdef void _drop_undo_record(self):
+        """Keeps the changes since the last undo record and forgets it. Its
+        journal entries now belong to the record before it."""
+        cdef UndoRecord r = self.undo_records.pop()
+        self.journaled_mask |= r.journaled_mask
+        if len(self.undo_records) == 0:
+            self.journal_size = 0
+            self.journal_enabled = False
+            self.journaled_mask = 0
+    
+    cpdef void push_action(self, action):
+        """Does an action so that it can be undone with pop_action."""
+        self._push_undo_record()
+        try:
+            self.do_action(action)
+        except:
+            self.pop_action()
+            raise
+        
+    cpdef void push_action_id(self, int action_id):
+        """Does an action id so that it can be undone with pop_action."""
+        self._push_undo_record()
+        try:
+            self.do_action_id(action_id)
+        except:
+            self.pop_action()
+            raise
+        
+    cpdef void pop_action(self):
+        """Undoes the last pushed action, including the dice it rolled."""
+        cdef UndoRecord r
+        cdef int i, t
+        assert len(self.undo_records) > 0
+        r = self.undo_records.pop()
+        
+        self.journal_enabled = False
+        for i in range(self.journal_size - 1, r.journal_mark - 1, -1):
+            t = self.journal[i].territory
+            self._set_owner(t, self.journal[i].owner)
+            self._add_armies(t, self.journal[i].armies - self.armies[t])
+        self.journal_size = r.journal_mark
+        self.journaled_mask = r.journaled_mask
+        self.journal_enabled = len(self.undo_records) > 0
+        
+        self.phase = r.phase
+        self.player_turn = r.player_turn
+        self.turn = r.turn
+        self.step = r.step
+        self.armies_to_deploy = r.armies_to_deploy
+        self.mandatory_occupation_armies = r.mandatory_occupation_armies
+        self.occupation_from_ter = r.occupation_from_ter
+        self.occupation_to_ter = r.occupation_to_ter
+        self.occupation_player_elimination = r.occupation_player_elimination
+        self.n_sets_traded_in = r.n_sets_traded_in
+        self.winner = r.winner
+        self.player_has_taken_territory_this_turn = r.player_has_taken_territory_this_turn
+        self.elimination_player_trade = r.elimination_player_trade
+        self.legal_actions = r.legal_actions
+        self.legal_actions_stale = r.legal_actions_stale
+        
+        memcpy(self.setup_armies_to_place, r.setup_armies_to_place, sizeof(self.setup_armies_to_place))
+        self.hands = r.hands
+        #Drawn cards stay in the deck array, only the cursor moves
+        self.deck_size = r.deck_size
+        memcpy(self.rng_state, r.rng_state, sizeof(self.rng_state))
+            
+    cpdef int get_undo_depth(self):
+        return len(self.undo_records)
+    
+    cdef int _legal_action_ids(self, int *out) noexcept nogil:
+        """Writes the ids of all legal actions to out, which must have room for
+        n_actions ids, and returns how many were written."""
+        cdef int n, t, i, e, n_max
+        cdef mask_t territories, targets
+        
+        n = 0
+        if self.phase == PHASE_SETUP or self.phase == PHASE_SETUP_DEPLOYMENT or self.phase == PHASE_REINFORCEMENT:
+            territories = self._owner_mask(-1 if self.phase == PHASE_SETUP else self.player_turn)
+            while territories:
+                out[n] = lowest_bit(territories)
+                territories &= territories - 1
+                n += 1
+        elif self.phase == PHASE_ATTACK or self.phase == PHASE_FORTIFY:
+            out[n] = self.attack_pass_id if self.phase == PHASE_ATTACK else self.fortify_pass_id
+            n += 1
+            territories = self.owner_masks[self.player_turn]
+            while territories:
+                t = lowest_bit(territories)
+                territories &= territories - 1
+                if self.phase == PHASE_ATTACK:
+                    targets = self._hostile_neighbor_mask(t)
+                    n_max = min(self.armies[t] - 1, 3)
+                else:
+                    targets = self.neighbor_masks[t] & self.owner_masks[self.player_turn]
+                    n_max = min(self.armies[t] - 1, MAX_MOVE_ARMIES)
+                while targets:
+                    e = self._edge_id(t, lowest_bit(targets))
+                    targets &= targets - 1
+                    for i in range(n_max):
+                        if self.phase == PHASE_ATTACK:
+                            out[n] = self.attack_offset + 3 * e + i
+                        else:
+                            out[n] = self.fortify_offset + MAX_MOVE_ARMIES * e + i
+                        n += 1
+        elif self.phase == PHASE_OCCUPATION:
+            n_max = min(self.armies[self.occupation_from_ter] - 1, MAX_MOVE_ARMIES)
+            for i in range(self.mandatory_occupation_armies, n_max + 1):
+                out[n] = self.occupation_offset + i
+                n += 1
+        elif self.phase == PHASE_TRADING:
+            if self._can_trade_set():
+                out[n] = self.trade_offset
+                n += 1
+            if self._can_pass_trade():
+                out[n] = self.trade_pass_id
+                n += 1
+        return n
+    
+    cpdef list get_legal_action_ids(self):
+        cdef int i, n
+        cdef int *ids = <int *> malloc(self.n_actions * sizeof(int))
+        try:
+            n = self._legal_action_ids(ids)
+            return [ids[i] for i in range(n)]
+        finally:
+            free(ids)
+    
+    cdef int _play_random(self, int max_steps, int *legal_ids) noexcept nogil:
+        cdef int n_steps = 0
+        while self.phase != PHASE_GAME_END and n_steps < max_steps:
+            self._do_action_id(legal_ids[self._randint(self._legal_action_ids(legal_ids))])
+            n_steps += 1
+        return n_steps
+    
+    cpdef int play_random(self, int max_steps=1000000) except -1:
+        """Plays uniformly random legal action ids, drawn from the generator
+        of the game, until the game ends or max_steps actions were done. 
+        Returns the number of actions done. The GIL is released while 
+        playing, so games can be played on several threads at once."""
+        cdef int n_steps
+        cdef int *ids = <int *> malloc(self.n_actions * sizeof(int))
+        if ids == NULL:
+            raise MemoryError()
+        with nogil:
+            n_steps = self._play_random(max_steps, ids)
+        free(ids)
+        return n_steps
+    
+    cdef int _choose_policy_action_id(self, int policy, int *ids, int n) noexcept nogil:
+        """Picks one of the n pruned action ids the way the agent of the 
+        policy does, see rollout."""
+        cdef int i, k, a, e, t, c, player, best_action
+        cdef double score, best_score
+        
+        if policy == ROLLOUT_BETTER:
+            player = self.player_turn
+            if self.phase == PHASE_SETUP:
+                #The first territory that gives the most continent bonus
+                best_action = ids[0]
+                best_score = -1
+                for i in range(n):
+                    t = ids[i]
+                    c = self.territory_continents[t]
+                    score = self.player_continent_bonuses[player]
+                    if c != -1 and self.player_continent_counts[player][c] + 1 == self.continent_sizes[c]:
+                        score += self.continent_bonuses[c]
+                    if score > best_score:
+                        best_score = score
+                        best_action = t
+                return best_action
+            elif self.phase == PHASE_SETUP_DEPLOYMENT or self.phase == PHASE_REINFORCEMENT:
+                #Prefer territories with more than two armies
+                k = 0
+                for i in range(n):
+                    if self.armies[ids[i]] > 2:
+                        ids[k] = ids[i]
+                        k += 1
+                n = n if k == 0 else k
+        elif policy == ROLLOUT_GREEDY:
+            #DeterministicAgent.move_score, with the same tie-breaking noise
+            best_action = ids[0]
+            best_score = -1e300
+            for i in range(n):
+                a = ids[i]
+                score = self._random_unit() * 0.01
+                if self.phase == PHASE_SETUP_DEPLOYMENT or self.phase == PHASE_REINFORCEMENT:
+                    score += self.armies[a] - popcount(self._hostile_neighbor_mask(a)) * 0.1
+                elif self.phase == PHASE_ATTACK and a != self.attack_pass_id:
+                    e = (a - self.attack_offset) // 3
+                    score += self.armies[self.edge_from[e]] - self.armies[self.edge_to[e]] * 0.1
+                elif self.phase == PHASE_OCCUPATION:
+                    score += a - self.occupation_offset
+                elif self.phase == PHASE_FORTIFY and a != self.fortify_pass_id:
+                    score += (a - self.fortify_offset) % MAX_MOVE_ARMIES + 1
+                if score > best_score:
+                    best_score = score
+                    best_action = a
+            return best_action
+        return ids[self._randint(n)]
+    
+    cdef void _do_policy_action_id(self, int action_id) noexcept nogil:
+        """Does an action id the way BaseAgent.do_actions_to_game does: a 
+        reinforcement places a fifth of the armies to deploy, an attack is
+        resolved and an attack pass also passes the fortification."""
+        cdef int i, e, n_armies
+        if self.phase == PHASE_REINFORCEMENT:
+            n_armies = (self.armies_to_deploy - 1) // 5 + 1
+            for i in range(n_armies):
+                self._do_action_id(action_id)
+        elif self.phase == PHASE_ATTACK and action_id != self.attack_pass_id:
+            i = action_id - self.attack_offset
+            e = i // 3
+            self._resolve_attack(self.edge_from[e], self.edge_to[e], i % 3 + 1)
+        elif self.phase == PHASE_ATTACK:
+            #ATTACK_PASS and FORTIFY_PASS are the same action
+            self._do_action_id(self.attack_pass_id)
+            self._do_action_id(self.fortify_pass_id)
+        else:
+            self._do_action_id(action_id)
+    
+    cpdef void do_macro_action_id(self, int action_id):
+        """Does a legal action id the way apply_turn_plan makes a move, as the
+        rollouts do."""
+        assert self._is_legal_action_id(action_id)
+        self._do_policy_action_id(action_id)
+    
+    cdef int _rollout(self, int policy, int max_steps, int *ids) noexcept nogil:
+        cdef int n, n_steps = 0
+        while self.phase != PHASE_GAME_END and n_steps < max_steps:
+            n = self._pruned_action_ids(ids, REDUCED_ACTIONS if policy == ROLLOUT_RANDOM else REDUCED_ACTIONS | PRUNE_PASS)
+            self._do_policy_action_id(self._choose_policy_action_id(policy, ids, n))
+            n_steps += 1
+        return n_steps
+    
+    cpdef double rollout(self, policy='greedy', int max_steps=1000000, seed=None, int player=-1, double proj_n_turns=1.0) except -1:
+        """Plays the game on in place with a built-in policy until it ends or
+        max_steps moves were made. The policies pick from the actions of 
+        helper_functions.get_reduced_actions and make moves the way
+        BaseAgent.do_actions_to_game does:
+        
+        'random' picks uniformly, as BaseAgent does.
+        'better' also drops passes and picks as BetterAgent does.
+        'greedy' also drops passes and picks the best move by 
+        DeterministicAgent.move_score.
+        
+        With a seed the generator of the game is reseeded first. Returns 1 
+        if player (by default the player to move) won, 0 if another player 
+        won and get_heuristic_value otherwise. The GIL is released while 
+        playing."""
+        cdef int policy_id = ROLLOUT_POLICIES.index(policy)
+        cdef int *ids
+        cdef double value
+        if seed is not None:
+            self.seed(seed)
+        if player == -1:
+            player = self.player_turn
+        ids = <int *> malloc(self.n_actions * sizeof(int))
+        if ids == NULL:
+            raise MemoryError()
+        with nogil:
+            self._rollout(policy_id, max_steps, ids)
+            value = self._heuristic_value(player, proj_n_turns)
+        free(ids)
+        return value
+    
+    cdef void _evaluate_all_players(self, double n_turns, double *out) noexcept nogil:
+        """Writes the armies of every player projected n_turns ahead, counting
+        cards in hand and future reinforcements at their expected value, the 
+        same as helper_functions.get_projected_n_armies."""
+        cdef double armies_per_set = (self.n_sets_traded_in + 1) * 5
+        cdef int i
+        for i in range(self.n_players):
+            out[i] = (self.player_armies[i] + popcount(self.hands.cards[i]) * 0.33 * armies_per_set 
+                      + (armies_per_set * 0.33 + self._reinforcement_amount(i)) * n_turns)
+    
+    cdef double _heuristic_value(self, int player, double n_turns) noexcept nogil:
+        cdef double projected[MAX_PLAYERS]
+        cdef double all_armies = 0
+        cdef int i
+        if self.phase == PHASE_GAME_END:
+            return 1 if self.winner == player else 0
+        self._evaluate_all_players(n_turns, projected)
+        for i in range(self.n_players):
+            all_armies += projected[i]
+        return projected[player] / max(1, all_armies)
+    
+    cpdef double get_heuristic_value(self, int player, double proj_n_turns):
+        """1 if player won, 0 if another player won, otherwise the share of
+        player in the armies projected proj_n_turns ahead by
+        helper_functions.get_projected_n_armies."""
+        return self._heuristic_value(player, proj_n_turns)
+    
+    cdef mask_t _border_mask(self, int player) noexcept nogil:
+        """Territories of player with a hostile neighbor."""
+        cdef mask_t territories = self._owner_mask(player)
+        cdef mask_t border = 0
+        cdef int t
+        while territories:
+            t = lowest_bit(territories)
+            territories &= territories - 1
+            if self._hostile_neighbor_mask(t):
+                border |= (<mask_t>1) << t
+        return border
+    
+    cdef mask_t _placement_mask(self, int profile) noexcept nogil:
+        cdef mask_t territories
+        if self.phase == PHASE_SETUP:
+            return self.unclaimed_mask
+        territories = self.owner_masks[self.player_turn]
+        if profile & PRUNE_BORDER_PLACEMENT and self._border_mask(self.player_turn):
+            return self._border_mask(self.player_turn)
+        return territories
+    
+    cdef bint _attack_dice(self, int t, int profile, int *lo, int *hi) noexcept nogil:
+        """The range of dice t may attack with, False if there is none."""
+        hi[0] = min(self.armies[t] - 1, 3)
+        lo[0] = hi[0] if profile & PRUNE_MAX_DICE else 1
+        if profile & PRUNE_THREE_DICE:
+            lo[0] = 3
+        return lo[0] >= 1 and lo[0] <= hi[0]
+    
+    cdef bint _occupation_amounts(self, int profile, int *amounts, int *n) noexcept nogil:
+        """Writes the pruned occupation amounts to amounts, when there are at
+        most three. Otherwise returns False and the whole range is kept."""
+        cdef int lo = self.mandatory_occupation_armies
+        cdef int hi = self.armies[self.occupation_from_ter] - 1
+        cdef bint from_border, to_border
+        if profile & PRUNE_BORDER_OCCUPATION:
+            from_border = self._hostile_neighbor_mask(self.occupation_from_ter) != 0
+            to_border = self._hostile_neighbor_mask(self.occupation_to_ter) != 0
+            if from_border and not to_border:
+                hi = lo
+            elif to_border and not from_border:
+                lo = hi
+        if hi - lo <= 1 or profile & PRUNE_OCCUPATION_HIGH_LOW:
+            n[0] = 0
+            amounts[n[0]] = lo
+            n[0] += 1
+            if hi - lo >= 2:
+                amounts[n[0]] = lo + (hi - lo + 1) // 2
+                n[0] += 1
+            if hi > lo:
+                amounts[n[0]] = hi
+                n[0] += 1
+            return True
+        return False
+    
+    cpdef list get_pruned_actions(self, int profile):
+        """Generates only the legal actions that a profile of PRUNE_ flags 
+        keeps, in the order of get_legal_actions. Placements fall back to 
+        every territory when the profile would keep none."""
+        cdef int t, target, i, lo, hi, n
+        cdef int amounts[3]
+        cdef int player = self.player_turn
+        cdef mask_t territories, targets, border
+        cdef list actions
+        cdef str node
+        
+        if self.phase == PHASE_SETUP or self.phase == PHASE_SETUP_DEPLOYMENT or self.phase == PHASE_REINFORCEMENT:
+            actions = self._mask_to_names(self._placement_mask(profile))
+        elif self.phase == PHASE_ATTACK:
+            actions = [ATTACK_PASS]
+            territories = self.owner_masks[player]
+            while territories:
+                t = lowest_bit(territories)
+                territories &= territories - 1
+                if not self._attack_dice(t, profile, &lo, &hi):
+                    continue
+                node = self.territory_names[t]
+                targets = self._hostile_neighbor_mask(t)
+                while targets:
+                    target = lowest_bit(targets)
+                    targets &= targets - 1
+                    if profile & PRUNE_REASONABLE_ATTACKS and self.armies[t] - 1 <= self.armies[target]:
+                        continue
+                    for i in range(lo, hi + 1):
+                        actions.append((node, self.territory_names[target], i))
+        elif self.phase == PHASE_OCCUPATION:
+            if self._occupation_amounts(profile, amounts, &n):
+                actions = [amounts[i] for i in range(n)]
+            else:
+                actions = list(self.get_legal_actions())
+        elif self.phase == PHASE_FORTIFY:
+            actions = [FORTIFY_PASS]
+            border = self._border_mask(player)
+            territories = self.owner_masks[player]
+            if profile & PRUNE_BORDER_FORTIFY:
+                territories &= ~border
+            while territories:
+                t = lowest_bit(territories)
+                territories &= territories - 1
+                node = self.territory_names[t]
+                targets = self.neighbor_masks[t] & self.owner_masks[player]
+                if profile & PRUNE_BORDER_FORTIFY:
+                    targets &= border
+                while targets:
+                    target = lowest_bit(targets)
+                    targets &= targets - 1
+                    for i in range(max(self.armies[t] - 1, 1) if profile & PRUNE_MAX_FORTIFY else 1, self.armies[t]):
+                        actions.append((node, self.territory_names[target], i))
+        else:
+            actions = list(self.get_legal_actions())
+        
+        if profile & PRUNE_PASS and len(actions) > 1:
+            actions = [action for action in actions if action != ATTACK_PASS and action != TRADE_PASS] or actions
+        return actions
+    
+    cdef int _pruned_action_ids(self, int *out, int profile) noexcept nogil:
+        """Writes the ids of the actions get_pruned_actions generates to out,
+        which must have room for n_actions ids, and returns how many were 
+        written. Amounts above MAX_MOVE_ARMIES are left out."""
+        cdef int n, k, t, target, i, e, lo, hi, n_amounts
+        cdef int amounts[3]
+        cdef int player = self.player_turn
+        cdef mask_t territories, targets, border
+        
+        n = 0
+        if self.phase == PHASE_SETUP or self.phase == PHASE_SETUP_DEPLOYMENT or self.phase == PHASE_REINFORCEMENT:
+            territories = self._placement_mask(profile)
+            while territories:
+                out[n] = lowest_bit(territories)
+                territories &= territories - 1
+                n += 1
+        elif self.phase == PHASE_ATTACK:
+            out[n] = self.attack_pass_id
+            n += 1
+            territories = self.owner_masks[player]
+            while territories:
+                t = lowest_bit(territories)
+                territories &= territories - 1
+                if not self._attack_dice(t, profile, &lo, &hi):
+                    continue
+                targets = self._hostile_neighbor_mask(t)
+                while targets:
+                    target = lowest_bit(targets)
+                    targets &= targets - 1
+                    if profile & PRUNE_REASONABLE_ATTACKS and self.armies[t] - 1 <= self.armies[target]:
+                        continue
+                    e = self._edge_id(t, target)
+                    for i in range(lo, hi + 1):
+                        out[n] = self.attack_offset + 3 * e + i - 1
+                        n += 1
+        elif self.phase == PHASE_OCCUPATION:
+            if self._occupation_amounts(profile, amounts, &n_amounts):
+                for i in range(n_amounts):
+                    if amounts[i] <= MAX_MOVE_ARMIES:
+                        out[n] = self.occupation_offset + amounts[i]
+                        n += 1
+            else:
+                n = self._legal_action_ids(out)
+        elif self.phase == PHASE_FORTIFY:
+            out[n] = self.fortify_pass_id
+            n += 1
+            border = self._border_mask(player)
+            territories = self.owner_masks[player]
+            if profile & PRUNE_BORDER_FORTIFY:
+                territories &= ~border
+            while territories:
+                t = lowest_bit(territories)
+                territories &= territories - 1
+                targets = self.neighbor_masks[t] & self.owner_masks[player]
+                if profile & PRUNE_BORDER_FORTIFY:
+                    targets &= border
+                hi = min(self.armies[t] - 1, MAX_MOVE_ARMIES)
+                lo = max(hi, 1) if profile & PRUNE_MAX_FORTIFY else 1
+                while targets:
+                    e = self._edge_id(t, lowest_bit(targets))
+                    targets &= targets - 1
+                    for i in range(lo, hi + 1):
+                        out[n] = self.fortify_offset + MAX_MOVE_ARMIES * e + i - 1
+                        n += 1
+        else:
+            n = self._legal_action_ids(out)
+        
+        if profile & PRUNE_PASS and n > 1:
+            k = 0
+            for i in range(n):
+                if out[i] != self.attack_pass_id and out[i] != self.fortify_pass_id and out[i] != self.trade_pass_id:
+                    out[k] = out[i]
+                    k += 1
+            n = n if k == 0 else k
+        return n
+    
+    cpdef list get_pruned_action_ids(self, int profile):
+        cdef int i, n
+        cdef int *ids = <int *> malloc(self.n_actions * sizeof(int))
+        if ids == NULL:
+            raise MemoryError()
+        try:
+            n = self._pruned_action_ids(ids, profile)
+            return [ids[i] for i in range(n)]
+        finally:
+            free(ids)
+    
+    cpdef int get_observation_size(self):
+        return 2 * self.n_territories + self.n_continents + 6
+    
+    cdef void _write_observation(self, float *out) noexcept nogil:
+        """Writes the features of ai_helper.get_state_2 as seen by the player
+        to move: the armies on each territory, which territories the player 
+        owns, the armies to deploy, which continents the player holds, the 
+        game phase, the number of cards in hand, the number of sets traded 
+        in, whether a territory was taken this turn and the proportion of 
+        alive players."""
+        cdef int t, c, k, n_alive
+        cdef int player = self.player_turn
+        for t in range(self.n_territories):
+            out[t] = self.armies[t]
+            out[self.n_territories + t] = 1 if self.owners[t] == player else 0
+        k = 2 * self.n_territories
+        out[k] = self.armies_to_deploy
+        k += 1
+        for c in range(self.n_continents):
+            out[k + c] = 1 if self.player_continent_counts[player][c] == self.continent_sizes[c] else 0
+        k += self.n_continents
+        out[k] = self.phase
+        out[k + 1] = popcount(self.hands.cards[player])
+        out[k + 2] = self.n_sets_traded_in
+        out[k + 3] = 1 if self.player_has_taken_territory_this_turn else 0
+        if self.phase == PHASE_SETUP:
+            n_alive = self.n_players
+        else:
+            n_alive = 0
+            for c in range(self.n_players):
+                if self.owner_masks[c] != 0:
+                    n_alive += 1
+        out[k + 4] = n_alive / <float> self.n_players
+    
+    def get_observation(self):
+        """Returns the features of ai_helper.get_state_2 as a float32 array,
+        see VecRiskGame.observations."""
+        observation = np.zeros(self.get_observation_size(), dtype=np.float32)
+        cdef float[::1] out = observation
+        self._write_observation(&out[0])
+        return observation
+    
+    cpdef tuple get_action_delta(self, action):
+        """Returns how an action of the current phase would change the 
+        armies, the number of territories and the continent bonus of the
+        player to move, without doing it. An attack is resolved as with
+        resolve_attack, so its deltas are expected values. Moving armies
+        between territories changes none of them."""
+        cdef int action_id
+        cdef int player = self.player_turn
+        cdef int i, e, c, from_ter, to_ter, n_dice
+        cdef double p
+        cdef mask_t territories
+        assert self._is_legal_action(action)
+        if self.phase == PHASE_OCCUPATION or self.phase == PHASE_FORTIFY:
+            return (0.0, 0.0, 0.0)
+        action_id = self.encode_action(action)
+        
+        if self.phase == PHASE_SETUP:
+            c = self.territory_continents[action_id]
+            if c != -1 and self.player_continent_counts[player][c] + 1 == self.continent_sizes[c]:
+                return (1.0, 1.0, <double> self.continent_bonuses[c])
+            return (1.0, 1.0, 0.0)
+        elif self.phase == PHASE_SETUP_DEPLOYMENT or self.phase == PHASE_REINFORCEMENT:
+            return (1.0, 0.0, 0.0)
+        elif self.phase == PHASE_ATTACK and action_id != self.attack_pass_id:
+            i = action_id - self.attack_offset
+            e = i // 3
+            (from_ter, to_ter, n_dice) = (self.edge_from[e], self.edge_to[e], i % 3 + 1)
+            p = get_attack_win_probability(self.armies[from_ter], self.armies[to_ter], n_dice)
+            (atk_survivors, _) = get_expected_survivors(self.armies[from_ter], self.armies[to_ter], n_dice)
+            c = self.territory_continents[to_ter]
+            if c != -1 and self.player_continent_counts[player][c] + 1 == self.continent_sizes[c]:
+                return (atk_survivors - min(self.armies[from_ter], MAX_BATTLE_ARMIES), p, p * self.continent_bonuses[c])
+            return (atk_survivors - min(self.armies[from_ter], MAX_BATTLE_ARMIES), p, 0.0)
+        elif self.phase == PHASE_TRADING and action_id == self.trade_offset:
+            territories = self.hands.territories[player] & self.owner_masks[player]
+            return (2.0 * popcount(territories), 0.0, 0.0)
+        return (0.0, 0.0, 0.0)
+    
+    def peek_observations(self, actions, bint is_determinized=False):
+        """Returns, for each action, the observation of get_observation after 
+        making it with apply_turn_plan, and an int array with the winner 
+        after it (-1 while the game goes on). The game is left as it was: 
+        each action is undone with the undo stack, so nothing is copied.
+        With is_determinized, attacks lose the fixed casualties of a 
+        determinized game instead of rolling dice."""
+        cdef int i
+        cdef bint was_determinized = self.is_determinized
+        observations = np.zeros((len(actions), self.get_observation_size()), dtype=np.float32)
+        winners = np.full(len(actions), -1, dtype=np.intc)
+        cdef float[:, ::1] out = observations
+        cdef int[::1] winners_view = winners
+        
+        self.is_determinized = is_determinized
+        try:
+            for (i, action) in enumerate(actions):
+                self._push_undo_record()
+                try:
+                    self.apply_turn_plan([action])
+                    self._write_observation(&out[i, 0])
+                    winners_view[i] = self.winner
+                finally:
+                    self.pop_action()
+        finally:
+            self.is_determinized = was_determinized
+        return (observations, winners)
+    
+    def get_legal_action_mask(self):
+        cdef int i, n
+        cdef int *ids = <int *> malloc(self.n_actions * sizeof(int))
+        mask = np.zeros(self.n_actions, dtype=np.bool_)
+        cdef unsigned char[::1] mask_view = mask.view(np.uint8)
+        try:
+            n = self._legal_action_ids(ids)
+            for i in range(n):
+                mask_view[ids[i]] = 1
+        finally:
+            free(ids)
+        return mask
+    
     cpdef str get_state(self):
-        return self.state
+        return PHASE_NAMES[self.phase]
 
     cpdef int get_setup_armies_to_place(self, player):
         return self.setup_armies_to_place[player]
@@ -479,29 +2321,22 @@ cdef class RiskGame:
         return self.player_turn
     
     cpdef int get_total_player_armies(self, player):
-        n_armies = 0
-        
-        for node in self.get_player_territories(player):
-            n_armies += self.territory_data[node]['armies']
-        
-        return n_armies
+        return self.get_n_player_armies(player)
     
     cpdef str get_occupy_from_ter(self):
-        return self.occupation_from_ter
+        return None if self.occupation_from_ter == -1 else self.territory_names[self.occupation_from_ter]
     
     cpdef str get_occupy_to_ter(self):
-        return self.occupation_to_ter
+        return None if self.occupation_to_ter == -1 else self.territory_names[self.occupation_to_ter]
     
     cpdef int get_n_armies_to_deploy(self):
         return self.armies_to_deploy
     
     cpdef int get_number_of_armies(self, t):
-        assert t in self.territory_data
-        return self.territory_data[t]['armies']
+        return self.armies[self._tid(t)]
     
     cpdef int get_owner(self, t):
-        assert t in self.territory_data
-        return self.territory_data[t]['owner']
+        return self.owners[self._tid(t)]
     
     def draw(self, size=750):
         im = PIL.Image.new('RGB', (size, size), (255, 255, 255))
@@ -521,18 +2356,19 @@ cdef class RiskGame:
             owner = self.get_owner(node)
             color = null_color if owner == -1 else colors[owner]
             draw.ellipse([c1, c2], fill=color)
-            draw.text(pos[node], str(self.territory_data[node]['armies']), fill="black", anchor="mm")
+            draw.text(pos[node], str(self.get_number_of_armies(node)), fill="black", anchor="mm")
             
         return im
         
     cpdef void debug_set_territory_armies(self, t, n_armies):
-        self.territory_data[t]['armies'] = n_armies
+        cdef int i = self._tid(t)
+        self._add_armies(i, n_armies - self.armies[i])
         
     cpdef void debug_set_territory_owner(self, t, player):
-        self.territory_data[t]['owner'] = player
+        self._set_owner(self._tid(t), player)
         
     cpdef void debug_set_player_hand(self, player, hand):
-        self.player_hands[player] = hand
+        self._set_hand(player, hand)
         
     cpdef void debug_set_player_territory_conquest_bonus(self, value):
         self.player_has_taken_territory_this_turn = value
@@ -541,16 +2377,29 @@ cdef class RiskGame:
         self.elimination_player_trade = value
         
     cpdef list get_player_hand(self, player):
-        return self.player_hands[player]
+        """Returns the cards of a player, ordered by id."""
+        cdef mask_t cards = self.hands.cards[player]
+        cdef list hand = []
+        while cards:
+            hand.append(CARDS[lowest_bit(cards)])
+            cards &= cards - 1
+        return hand
         
     cpdef bint get_territory_conquest_bonus(self):
         return self.player_has_taken_territory_this_turn
     
     cpdef dict get_territory_data(self):
-        return self.territory_data
+        cdef int i
+        return {self.territory_names[i]: {'armies': self.armies[i], 'owner': self.owners[i]} for i in range(self.n_territories)}
     
     cpdef list get_all_territories(self):
-        return list(self.territory_data.keys())
+        return list(self.territory_names)
+    
+    cpdef dict get_continents(self):
+        return self.continents
+    
+    cpdef MapTopology get_topology(self):
+        return self.topology
     
     cpdef int get_winner(self):
         return self.winner
@@ -565,15 +2414,23 @@ cdef class RiskGame:
         self.is_determinized = value
         
     cpdef int get_n_player_armies(self, int player):
-        cdef str t
-        return sum([self.territory_data[t]['armies'] for t in self.get_player_territories(player)])
+        cdef int n
+        cdef mask_t territories = self.unclaimed_mask
+        
+        if player != -1:
+            return self.player_armies[player]
+        
+        n = 0
+        while territories:
+            n += self.armies[lowest_bit(territories)]
+            territories &= territories - 1
+        return n
     
     cpdef int get_n_player_territories(self, int player):
-        return len(self.get_player_territories(player))
+        return self._n_player_territories(player)
     
     cpdef int get_total_armies_on_board(self):
-        cdef str t
-        return sum([self.territory_data[t]['armies'] for t in self.territory_data])
+        return self.total_armies
     
     cpdef list get_neighboring_territories(self, str t):
         return self.G.neighbors(t)
@@ -588,4 +2445,31 @@ cdef class RiskGame:
             return sum([1 for player in range(self.n_players) if not self.is_player_dead(player)])
         
     cpdef int get_n_players(self):
-        return self.n_players
\ No newline at end of file
+        return self.n_players
+    
+cdef class GamePool:
+    """Recycles RiskGame instances for code that copies games many times, 
+    such as the simulations of the search agents. A game from copy should 
+    be given back with release once it is no longer used."""
+    def __init__(self):
+        self.free_games = []
+        
+    cpdef RiskGame copy(self, RiskGame game, bint is_determinized, bint fork_rng=False):
+        """RiskGame.copy into a free game of the pool."""
+        cdef RiskGame new_game
+        if len(self.free_games) > 0:
+            new_game = self.free_games.pop()
+        else:
+            new_game = RiskGame.__new__(RiskGame)
+        game.copy_into(new_game, is_determinized, fork_rng)
+        return new_game
+    
+    def __reduce__(self):
+        #The free games are only a cache, a copied pool starts out empty
+        return (GamePool, ())
+    
+    cpdef void release(self, RiskGame game):
+        self.free_games.append(game)
+        
+    cpdef int get_n_free_games(self):
+        return len(self.free_games)
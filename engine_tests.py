@@ -1,5 +1,16 @@
-from engine import RiskGame
+from engine import GamePool, RiskGame, get_attack_win_probability, get_map_topology, get_expected_survivors, get_roll_outcome_probabilities
+from cards import CARDS
 from RiskMap import RiskMap
+from vec_engine import VecRiskGame
+import helper_functions as hf
+from concurrent.futures import ThreadPoolExecutor
+import json
+import numpy as np
+import os
+import pickle
+import struct
+import tempfile
+import time
 import unittest
 import random
 
@@ -17,6 +28,660 @@ class EngineTest(unittest.TestCase):
                 game.do_action(random.choice(legal_actions))
                 i += 1
                 
+    def test_board_queries(self):
+        """Compares the board queries against a direct computation from the
+        territory data and the map."""
+        random.seed(1)
+        m = RiskMap()
+        m.compile_edge_dict()
+        continents = m.get_continents()
+
+        for n_players in range(3, 7):
+            game = RiskGame(n_players)
+            i = 0
+            while not game.has_finished() and i < 500:
+                data = game.get_territory_data()
+                for t in data:
+                    hostile = [t2 for t2 in m.neighbors(t) if data[t2]['owner'] != data[t]['owner']]
+                    self.assertSequenceEqual(game.get_hostile_neighbors(t), hostile)
+                    self.assertEqual(game.has_hostile_neighbor(t), len(hostile) > 0)
+
+                for player in range(n_players):
+                    ters = sorted([t for t in data if data[t]['owner'] == player])
+                    self.assertSequenceEqual(game.get_player_territories(player), ters)
+                    self.assertEqual(game.get_n_player_territories(player), len(ters))
+                    self.assertEqual(game.get_n_player_armies(player), sum([data[t]['armies'] for t in ters]))
+
+                    bonus = 0
+                    for continent in continents:
+                        has_continent = all([data[t]['owner'] == player for t in continents[continent]])
+                        self.assertEqual(game.has_continent(player, continent), has_continent)
+                        bonus += continent[1] if has_continent else 0
+                    self.assertEqual(game.get_continent_troop_bonuses(player), bonus)
+                    self.assertEqual(game.get_reinforcement_amount(player), max(len(ters) // 3, 3) + bonus)
+
+                self.assertEqual(game.get_total_armies_on_board(), sum([data[t]['armies'] for t in data]))
+                self.do_random_action(game)
+                i += 1
+
+    def test_incremental_legal_actions(self):
+        """The attack and fortify moves are maintained incrementally, compare
+        them against a full generation from the territory data."""
+        random.seed(2)
+        m = RiskMap()
+        m.compile_edge_dict()
+
+        for n_players in range(3, 7):
+            game = RiskGame(n_players)
+            i = 0
+            while not game.has_finished() and i < 2000:
+                state = game.get_state()
+                if state in ['attack', 'fortify']:
+                    data = game.get_territory_data()
+                    player = game.get_player_turn()
+                    expected = [('pass', 'pass', 0)]
+                    for t in game.get_player_territories(player):
+                        for t2 in m.neighbors(t):
+                            if state == 'attack' and data[t2]['owner'] != player:
+                                expected.extend([(t, t2, x) for x in range(1, min(data[t]['armies'] - 1, 3) + 1)])
+                            elif state == 'fortify' and data[t2]['owner'] == player:
+                                expected.extend([(t, t2, x) for x in range(1, data[t]['armies'])])
+                    self.assertSequenceEqual(sorted(game.get_legal_actions()), sorted(expected))
+                self.do_random_action(game)
+                i += 1
+
+    def test_action_ids(self):
+        """Legal action ids, the legal action mask and the legal actions
+        should agree, and playing by id should be the same as playing by action."""
+        for n_players in range(3, 7):
+            random.seed(n_players)
+            #Determinized, so both games see the same battle results
+            game = RiskGame(n_players)
+            game.set_determinization(True)
+            id_game = game.copy(True)
+            i = 0
+            while not game.has_finished() and i < 2000:
+                ids = id_game.get_legal_action_ids()
+                mask = id_game.get_legal_action_mask()
+                self.assertEqual(len(mask), game.get_n_actions())
+                self.assertSequenceEqual(sorted(ids), list(mask.nonzero()[0]))
+
+                actions = game.get_legal_actions()
+                expected = [a for a in actions if not (type(a) == tuple and type(a[2]) == int and a[2] > 128)]
+                self.assertEqual(set(ids), set([id_game.encode_action(a) for a in expected]))
+                for a in ids:
+                    self.assertEqual(id_game.encode_action(id_game.decode_action(a)), a)
+                    self.assertTrue(id_game.is_legal_action_id(a))
+
+                action = random.choice(expected)
+                game.do_action(action)
+                id_game.do_action_id(id_game.encode_action(action))
+                self.assertEqual(game.to_tuple(), id_game.to_tuple())
+                i += 1
+
+    def game_snapshot(self, game):
+        return (game.to_tuple(), game.get_turn(), game.get_player_turn(), 
+                game.get_step(), game.get_winner(), list(game.get_deck()),
+                game.get_total_armies_on_board(), sorted(game.get_legal_actions()),
+                [game.get_reinforcement_amount(player) for player in range(game.get_n_players())],
+                [game.get_n_player_armies(player) for player in range(game.get_n_players())],
+                game.get_rng_state(), game.get_hash())
+
+    def test_push_pop_action(self):
+        """Pushing a few random actions and popping them again should give 
+        back exactly the same game, including the state of its dice."""
+        for n_players in range(3, 7):
+            random.seed(n_players)
+            rng = random.Random(n_players)
+            game = RiskGame(n_players)
+            i = 0
+            while not game.has_finished() and i < 1500:
+                snapshot = self.game_snapshot(game)
+                depth = 0
+                while depth < 3 and not game.has_finished():
+                    game.push_action(rng.choice(game.get_legal_actions()))
+                    depth += 1
+                    if depth == 1:
+                        snapshot_1 = self.game_snapshot(game)
+                while depth > 0:
+                    game.pop_action()
+                    depth -= 1
+                    if depth == 1:
+                        self.assertEqual(self.game_snapshot(game), snapshot_1)
+                self.assertEqual(self.game_snapshot(game), snapshot)
+                self.assertEqual(game.get_undo_depth(), 0)
+
+                self.do_random_action(game)
+                i += 1
+
+    def test_nested_turn_plans(self):
+        """A turn plan applied under a pushed action is undone with it, and a
+        failing turn plan only undoes itself."""
+        rng = random.Random(4)
+        game = RiskGame(4, 4)
+        while not game.has_finished():
+            snapshot = self.game_snapshot(game)
+            game.push_action(rng.choice(game.get_legal_actions()))
+            snapshot_1 = self.game_snapshot(game)
+            #Games rebuilt from bytes roll the same dice, so the plan is legal
+            plan = []
+            copy = RiskGame.from_bytes(game.to_bytes())
+            while len(plan) < 30 and not copy.has_finished():
+                plan.append(rng.choice(copy.get_legal_actions()))
+                copy.apply_turn_plan(plan[-1:])
+            self.assertRaises(ValueError, game.apply_turn_plan, plan + [('pass', 'pass', -1)])
+            self.assertEqual(self.game_snapshot(game), snapshot_1)
+            game.apply_turn_plan(plan)
+            self.assertEqual(game.to_bytes(), copy.to_bytes())
+            game.pop_action()
+            self.assertEqual(self.game_snapshot(game), snapshot)
+            self.assertEqual(game.get_hash(), game.compute_hash())
+            for _ in range(20):
+                if not game.has_finished():
+                    self.do_random_action(game)
+
+    def test_hash(self):
+        """The incremental hash should always equal the hash computed from 
+        scratch, and should tell apart the states that to_tuple and the player
+        to move tell apart."""
+        for n_players in range(3, 7):
+            rng = random.Random(n_players)
+            game = RiskGame(n_players, n_players)
+            hashes = {}
+            i = 0
+            while not game.has_finished() and i < 3000:
+                h = game.get_hash()
+                self.assertEqual(h, game.compute_hash())
+                self.assertEqual(game.copy(False).get_hash(), h)
+                state = (game.to_tuple(), game.get_player_turn())
+                if state in hashes:
+                    self.assertEqual(hashes[state], h)
+                hashes[state] = h
+                game.do_action(rng.choice(game.get_legal_actions()))
+                i += 1
+            self.assertEqual(len(set(hashes.values())), len(hashes))
+
+        game = RiskGame(3, 0)
+        h = game.get_hash()
+        game.debug_set_player_hand(0, [('japan', 'horse')])
+        self.assertNotEqual(game.get_hash(), h)
+        game.debug_set_player_hand(0, [])
+        self.assertEqual(game.get_hash(), h)
+
+    def test_map_topology(self):
+        """Games should share one topology, with the same neighbors as the
+        map it was built from."""
+        m = RiskMap()
+        m.compile_edge_dict()
+        game = RiskGame(3, 0)
+        self.assertIs(get_map_topology(), get_map_topology())
+        self.assertEqual(game.get_all_territories(), m.get_territories())
+        for t in m.get_territories():
+            neighbors = game.get_neighboring_territories(t)
+            self.assertEqual(neighbors, sorted(neighbors))
+            self.assertEqual(set(neighbors), {t2 for (t1, t2) in m.get_map().G_edges if t1 == t})
+            for t2 in neighbors:
+                self.assertIn(t, game.get_neighboring_territories(t2))
+
+    def test_map_files(self):
+        """The classic map file should give the classic game. Games on other 
+        maps, up to 64 territories, should play to the end and serialize."""
+        m = RiskMap("maps/classic.json")
+        classic = RiskMap()
+        classic.compile_edge_dict()
+        self.assertEqual(m.get_territories(), classic.get_territories())
+        self.assertEqual({c: sorted(ts) for (c, ts) in m.get_continents().items()}, 
+                         {c: sorted(ts) for (c, ts) in classic.get_continents().items()})
+        self.assertEqual(m.get_territory_positions(10), classic.get_territory_positions(10))
+        for t in m.get_territories():
+            self.assertEqual(m.neighbors(t), classic.neighbors(t))
+
+        games = [RiskGame(4, 1), RiskGame(4, 1, "maps/classic.json")]
+        for game in games:
+            rng = random.Random(1)
+            while not game.has_finished():
+                game.do_action_id(rng.choice(game.get_legal_action_ids()))
+        self.assertEqual(games[0].to_tuple(), games[1].to_tuple())
+
+        with tempfile.TemporaryDirectory() as directory:
+            for (n_territories, should_load) in [(5, True), (64, True), (65, False)]:
+                names = ["t{:02d}".format(i) for i in range(n_territories)]
+                data = {"territories": {t: [i % 10, i // 10] for (i, t) in enumerate(names)},
+                        "edges": [[names[i], names[i + 1]] for i in range(n_territories - 1)] + [[names[0], names[-1]]],
+                        "continents": {"first": {"bonus": 1, "territories": names[:3]}, 
+                                       "second": {"bonus": 3, "territories": names[3:]}}}
+                map_file = os.path.join(directory, "ring_{}.json".format(n_territories))
+                with open(map_file, "w") as f:
+                    json.dump(data, f)
+                if not should_load:
+                    self.assertRaises(ValueError, RiskGame, 3, 0, map_file)
+                    continue
+                
+                game = RiskGame(3, 0, map_file)
+                self.assertEqual(game.get_all_territories(), names)
+                self.assertEqual(game.get_neighboring_territories("t01"), ["t00", "t02"])
+                rng = random.Random(n_territories)
+                i = 0
+                while not game.has_finished() and i < 5000:
+                    if rng.random() < 0.02:
+                        self.assertEqual(self.game_snapshot(RiskGame.from_bytes(game.to_bytes())), self.game_snapshot(game))
+                    game.do_action_id(rng.choice(game.get_legal_action_ids()))
+                    i += 1
+                if n_territories == 5:
+                    self.assertEqual(game.get_n_player_territories(game.get_winner()), n_territories)
+                self.assertTrue(os.path.exists(map_file + ".npz"))
+
+    def test_serialization(self):
+        """Games rebuilt from to_bytes or pickled should equal the original,
+        down to their deck and dice, and play on the same way."""
+        for n_players in range(3, 7):
+            rng = random.Random(n_players)
+            game = RiskGame(n_players, n_players)
+            i = 0
+            while not game.has_finished() and i < 3000:
+                if i % 10 == 0:
+                    data = game.to_bytes()
+                    self.assertLess(len(data), 300)
+                    for copy in [RiskGame.from_bytes(data), pickle.loads(pickle.dumps(game))]:
+                        self.assertEqual(self.game_snapshot(copy), self.game_snapshot(game))
+                        self.assertEqual(copy.to_bytes(), data)
+                    action = rng.choice(game.get_legal_actions())
+                    copy.do_action(action)
+                    game.do_action(action)
+                    self.assertEqual(self.game_snapshot(copy), self.game_snapshot(game))
+                else:
+                    game.do_action(rng.choice(game.get_legal_actions()))
+                i += 1
+        self.assertRaises(ValueError, RiskGame.from_bytes, b'\x00' + data[1:])
+
+    def test_corrupt_serialization(self):
+        """Truncated data and fields out of range raise ValueError, they are
+        never used to index the board, hands or deck."""
+        data = RiskGame(4, 0).to_bytes()
+        owners = struct.calcsize('<BBBBBiiHHbbbBbB6HQB')
+        self.assertRaises(ValueError, RiskGame.from_bytes, data[:owners] + bytes([9]) + data[owners + 1:])
+        self.assertRaises(ValueError, RiskGame.from_bytes, data[:-1] + data[-2:-1])
+        self.assertRaises(ValueError, RiskGame.from_bytes, data[:-1] + bytes([len(CARDS)]))
+        for n in range(len(data)):
+            self.assertRaises(ValueError, RiskGame.from_bytes, data[:n])
+        for i in range(1, len(data)):
+            for value in [0, 1, 9, 0x7f, 0xff]:
+                try:
+                    game = RiskGame.from_bytes(data[:i] + bytes([value]) + data[i + 1:])
+                except ValueError:
+                    continue
+                game.get_legal_actions()
+                game.get_hash()
+
+    def test_seeded_games(self):
+        """Games with the same seed should shuffle the same deck and roll the
+        same dice."""
+        for seed in range(4):
+            games = [RiskGame(3 + seed, seed) for _ in range(2)]
+            for game in games:
+                rng = random.Random(seed)
+                i = 0
+                while not game.has_finished() and i < 2000:
+                    game.do_action(rng.choice(game.get_legal_actions()))
+                    i += 1
+            self.assertEqual(games[0].to_tuple(), games[1].to_tuple())
+            self.assertEqual(games[0].get_deck(), games[1].get_deck())
+            self.assertEqual(games[0].get_rng_state(), games[1].get_rng_state())
+        self.assertNotEqual(RiskGame(3, 0).get_deck(), RiskGame(3, 1).get_deck())
+
+        dice = RiskGame(3, 0).roll_dice(60000)
+        self.assertEqual(set(dice), {1, 2, 3, 4, 5, 6})
+        for value in range(1, 7):
+            self.assertAlmostEqual(list(dice).count(value) / 60000, 1 / 6, delta=0.01)
+
+    def test_deck(self):
+        """Every card is either in the deck or in one hand, drawing from a 
+        copy leaves the original deck alone."""
+        game = RiskGame(3, 0)
+        self.assertEqual(sorted(game.get_deck()), sorted(CARDS))
+        rng = random.Random(0)
+        while not game.has_finished():
+            game.do_action(rng.choice(game.get_legal_actions()))
+            held = game.get_deck() + [card for player in range(3) for card in game.get_player_hand(player)]
+            self.assertTrue(set(held) <= set(CARDS))
+            self.assertTrue(len(held) <= len(CARDS))
+            if game.get_state() == 'fortify':
+                deck = game.get_deck()
+                clone = game.copy(False)
+                clone.do_action(('pass', 'pass', 0))
+                self.assertEqual(game.get_deck(), deck)
+        
+        game = RiskGame(3, 0)
+        game.debug_set_player_hand(0, [('null', 'wildcard')])
+        game.set_deck([('japan', 'horse'), ('null', 'wildcard')])
+        self.assertEqual(RiskGame.from_bytes(game.to_bytes()).get_deck(), [('japan', 'horse'), ('null', 'wildcard')])
+
+    def test_play_random(self):
+        """play_random releases the GIL, games played on several threads end
+        the same as games played one after another."""
+        for seed in range(3):
+            game = RiskGame(3, seed)
+            n_steps = game.play_random(50)
+            self.assertEqual(n_steps, 50)
+            self.assertEqual(game.get_step(), 50)
+            self.assertEqual(game.get_hash(), game.compute_hash())
+        
+        games = [[RiskGame(4, seed) for seed in range(16)] for _ in range(2)]
+        for game in games[0]:
+            game.play_random()
+        with ThreadPoolExecutor(4) as executor:
+            list(executor.map(lambda game: game.play_random(), games[1]))
+        for (game, threaded_game) in zip(*games):
+            self.assertTrue(game.has_finished())
+            self.assertEqual(game.to_bytes(), threaded_game.to_bytes())
+
+    def test_rollout(self):
+        """Rollouts play legal moves, are repeatable with a seed and score the
+        final state like helper_functions does."""
+        for policy in ['random', 'better', 'greedy']:
+            for seed in range(3):
+                games = [RiskGame(4, seed) for _ in range(2)]
+                values = [game.rollout(policy, 100000, seed) for game in games]
+                self.assertEqual(values[0], values[1])
+                self.assertEqual(games[0].to_bytes(), games[1].to_bytes())
+                self.assertTrue(games[0].has_finished())
+                self.assertEqual(games[0].get_hash(), games[0].compute_hash())
+                self.assertEqual(games[0].rollout(policy, 10, None, games[0].get_winner()), 1)
+        
+        game = RiskGame(4, 0)
+        value = game.rollout('greedy', 60, 0, 2, 1.5)
+        self.assertFalse(game.has_finished())
+        projected = [hf.get_projected_n_armies(game, player, 1.5) for player in range(4)]
+        self.assertAlmostEqual(value, projected[2] / sum(projected))
+        self.assertAlmostEqual(value, game.get_heuristic_value(2, 1.5))
+        self.assertRaises(ValueError, game.rollout, 'unknown')
+
+    def test_evaluate_all_players(self):
+        """Every player is evaluated at once the same as projecting their
+        armies one by one."""
+        rng = random.Random(1)
+        game = RiskGame(5, 1)
+        while not game.has_finished():
+            for n_turns in [0, 2.5]:
+                projected = hf.evaluate_all_players(game, n_turns)
+                self.assertEqual(projected.shape, (5,))
+                np.testing.assert_allclose(projected, [hf.get_projected_n_armies(game, player, n_turns) for player in range(5)])
+            game.do_action(rng.choice(game.get_legal_actions()))
+
+    def test_macro_actions(self):
+        """reinforce and attack_until are the same as the single actions they
+        stand for, a turn plan is applied whole or not at all."""
+        rng = random.Random(0)
+        game = RiskGame(3, 0)
+        while game.get_state() != 'reinforcement':
+            game.do_action(rng.choice(game.get_legal_actions()))
+        
+        #Copies made from bytes keep the generator of the game
+        games = [RiskGame.from_bytes(game.to_bytes()) for _ in range(2)]
+        territory = games[0].get_legal_actions()[0]
+        n_armies = games[0].get_n_armies_to_deploy()
+        games[0].reinforce(territory, n_armies)
+        for _ in range(n_armies):
+            games[1].do_action(territory)
+        self.assertEqual(games[0].to_bytes(), games[1].to_bytes())
+        self.assertEqual(games[0].get_state(), 'attack')
+        
+        attack = max([action for action in games[0].get_legal_actions() if action[2] == 3], 
+                     key=lambda action: games[0].get_number_of_armies(action[0]))
+        conquered = games[0].attack_until(*attack)
+        while attack in games[1].get_legal_actions():
+            games[1].do_action(attack)
+        self.assertEqual(games[0].to_bytes(), games[1].to_bytes())
+        self.assertEqual(conquered, games[0].get_state() == 'occupation')
+        
+        game = game.copy(False)
+        data = game.to_bytes()
+        plan = [territory] * 10 + [('pass', 'pass', 0)]
+        self.assertRaises(ValueError, game.apply_turn_plan, plan)
+        self.assertEqual(game.to_bytes(), data)
+        self.assertEqual(game.get_undo_depth(), 0)
+        #Each reinforcement places a fifth of the armies left to deploy
+        (n_armies, n_moves) = (game.get_n_armies_to_deploy(), 0)
+        while n_armies > 0:
+            n_armies -= (n_armies - 1) // 5 + 1
+            n_moves += 1
+        plan = [territory] * n_moves + [('pass', 'pass', 0)]
+        game.apply_turn_plan(plan)
+        self.assertEqual(game.get_state(), 'trading')
+        self.assertEqual(game.get_player_turn(), 1)
+
+        #do_macro_action_id makes the same moves as apply_turn_plan
+        games = [RiskGame(4, 5) for _ in range(2)]
+        while not games[0].has_finished():
+            action_id = rng.choice(games[0].get_pruned_action_ids(0))
+            games[0].do_macro_action_id(action_id)
+            games[1].apply_turn_plan([games[1].decode_action(action_id)])
+            self.assertEqual(games[0].to_bytes(), games[1].to_bytes())
+        self.assertEqual(game.get_hash(), game.compute_hash())
+
+    def test_peek(self):
+        """Peeking at actions gives what doing them gives and leaves the game
+        as it was."""
+        def player_values(game, player):
+            return (game.get_n_player_armies(player), game.get_n_player_territories(player), 
+                    game.get_continent_troop_bonuses(player))
+        
+        rng = random.Random(0)
+        game = RiskGame(3, 0)
+        while not game.has_finished():
+            data = game.to_bytes()
+            actions = game.get_legal_actions()[:10]
+            (observations, winners) = game.peek_observations(actions)
+            self.assertEqual(game.to_bytes(), data)
+            self.assertEqual(game.get_undo_depth(), 0)
+            player = game.get_player_turn()
+            for (i, action) in enumerate(actions[:5]):
+                copy = RiskGame.from_bytes(data)
+                copy.apply_turn_plan([action])
+                self.assertTrue(np.array_equal(observations[i], copy.get_observation()))
+                self.assertEqual(winners[i], copy.get_winner())
+                if game.get_state() != 'attack':
+                    copy = RiskGame.from_bytes(data)
+                    copy.do_action(action)
+                    before = player_values(game, player)
+                    after = player_values(copy, player)
+                    self.assertEqual(game.get_action_delta(action), tuple(float(x - y) for (x, y) in zip(after, before)))
+            if game.get_state() == 'attack' and actions[-1][2] > 0:
+                (n_armies, n_territories, _) = game.get_action_delta(actions[-1])
+                self.assertAlmostEqual(n_territories, game.get_attack_win_probability(*actions[-1]))
+                self.assertTrue(-game.get_number_of_armies(actions[-1][0]) < n_armies <= 0)
+            game.do_action(rng.choice(actions))
+
+    def test_pruned_actions(self):
+        """Pruned actions are generated in the engine the same as filtering 
+        the legal actions with helper_functions."""
+        from engine import (PRUNE_BORDER_OCCUPATION, PRUNE_BORDER_PLACEMENT, PRUNE_MAX_DICE, PRUNE_MAX_FORTIFY,
+                            PRUNE_OCCUPATION_HIGH_LOW, PRUNE_PASS, REDUCED_ACTIONS)
+        rng = random.Random(0)
+        game = RiskGame(4, 0)
+        while not game.has_finished():
+            state = game.get_state()
+            legal_actions = game.get_legal_actions()
+            actions = game.get_pruned_actions(REDUCED_ACTIONS)
+            if state in ['setup_deployment', 'reinforcement']:
+                expected = hf.get_border_reinforce_moves(game) or legal_actions
+            elif state == 'attack':
+                expected = hf.get_reasonable_attacks(game, hf.get_attacks_above_threshold(legal_actions, 3))
+            elif state == 'fortify':
+                expected = hf.get_border_fortify_moves(game)
+            else:
+                expected = legal_actions
+            self.assertEqual(actions, expected)
+            self.assertEqual(game.get_pruned_actions(REDUCED_ACTIONS | PRUNE_PASS), hf.eliminate_pass(game, expected))
+            self.assertEqual(game.get_pruned_actions(0), legal_actions)
+            if state in ['setup_deployment', 'reinforcement']:
+                self.assertEqual(game.get_pruned_actions(PRUNE_BORDER_PLACEMENT), expected)
+            elif state == 'attack':
+                self.assertEqual(game.get_pruned_actions(PRUNE_MAX_DICE), [action for action in legal_actions 
+                    if action[2] == 0 or action[2] == min(game.get_number_of_armies(action[0]) - 1, 3)])
+            elif state == 'occupation':
+                self.assertEqual(game.get_pruned_actions(PRUNE_OCCUPATION_HIGH_LOW), hf.get_border_high_low_moves(game))
+                self.assertEqual(game.get_pruned_actions(PRUNE_BORDER_OCCUPATION), hf.get_border_occupy_moves(game))
+            elif state == 'fortify':
+                self.assertEqual(game.get_pruned_actions(PRUNE_MAX_FORTIFY), hf.get_highest_moves(legal_actions))
+            for profile in [0, REDUCED_ACTIONS, REDUCED_ACTIONS | PRUNE_PASS | PRUNE_OCCUPATION_HIGH_LOW]:
+                self.assertEqual(game.get_pruned_action_ids(profile), 
+                                 [game.encode_action(action) for action in game.get_pruned_actions(profile)])
+            game.do_action(rng.choice(legal_actions))
+
+    def test_mcts_tree(self):
+        """The array tree counts every simulation, keeps siblings together and
+        replays paths to the same states as the agent playing them on a copy. A move is
+        searched in one tree, within its budget."""
+        from MCTSAgent import MCTSAgent
+        rng = random.Random(0)
+        game = RiskGame(4, 0)
+        while game.get_state() != 'attack':
+            game.do_action(rng.choice(game.get_legal_actions()))
+        with tempfile.TemporaryDirectory() as directory:
+            mcts_agent = MCTSAgent(10, 20, 2, 1 / np.sqrt(2), os.path.join(directory, "mcts.log"))
+            mcts_agent.set_game(game)
+            mcts_agent.seed(0)
+            tree = mcts_agent.mcts_tree(300, game)
+
+            self.assertEqual(tree.n[0], 300)
+            np.testing.assert_allclose(tree.v[:tree.size].sum(axis=1), tree.n[:tree.size])
+            for node in range(tree.size):
+                children = range(tree.first_child[node], tree.first_child[node] + tree.n_children[node])
+                self.assertTrue(all(tree.parent[child] == node for child in children))
+                self.assertLessEqual(sum(tree.n[child] for child in children), tree.n[node])
+
+            path = [tree.size - 1]
+            while path[0] != 0:
+                path.insert(0, tree.parent[path[0]])
+            game_copy = game.copy(True)
+            for node in path[1:]:
+                game_copy.apply_turn_plan([game_copy.decode_action(tree.action_ids[node])])
+            replayed = tree.replay(path)
+            np.testing.assert_array_equal(replayed.get_observation(), game_copy.get_observation())
+            self.assertEqual(replayed.get_hash(), game_copy.get_hash())
+            self.assertEqual(replayed.get_state(), game_copy.get_state())
+
+            #A single tree per move, within the node or time budget
+            mcts_agent.max_nodes = 100
+            action = mcts_agent.get_action()
+            self.assertIn(action, game.get_legal_actions())
+            game_copy = game.copy(True)
+            mcts_agent.do_actions_to_game(action, game_copy)
+            #The move played is the move the root child measured
+            first = tree.first_child[0]
+            root_ids = tree.action_ids[first:first + tree.n_children[0]].tolist()
+            replayed = tree.replay([0, first + root_ids.index(game.encode_action(action))])
+            self.assertEqual(replayed.get_hash(), game_copy.get_hash())
+            self.assertEqual(replayed.get_state(), game_copy.get_state())
+            mcts_agent.n_simulations_per_move = None
+            mcts_agent.max_nodes = None
+            mcts_agent.time_limit = 0.2
+            start = time.perf_counter()
+            action = mcts_agent.get_action()
+            self.assertLess(time.perf_counter() - start, 1.0)
+            self.assertIn(action, game.get_legal_actions())
+
+    def test_border_info(self):
+        """BorderInfo computes the border analysis of the whole board the
+        same as asking the game territory by territory."""
+        rng = random.Random(2)
+        game = RiskGame(5, 2)
+        while not game.has_finished():
+            info = hf.BorderInfo(game)
+            for t in game.get_all_territories():
+                hostile_neighbors = game.get_hostile_neighbors(t)
+                n_threatening_armies = sum([game.get_number_of_armies(hn) - 1 for hn in hostile_neighbors])
+                self.assertEqual(info.is_border(t), game.has_hostile_neighbor(t))
+                self.assertEqual(info.get_n_hostile_neighbors(t), len(hostile_neighbors))
+                self.assertEqual(info.get_threatening_armies(t), n_threatening_armies)
+                self.assertEqual(info.is_threatened(t), n_threatening_armies > game.get_number_of_armies(t) * 0.8)
+            for player in range(5):
+                ts = game.get_player_territories(player)
+                border = [t for t in ts if game.has_hostile_neighbor(t)]
+                self.assertEqual(sorted(info.get_border_territories(player)), sorted(border))
+                self.assertEqual(info.get_n_border_territories(player), len(border))
+                self.assertEqual(info.get_n_links(player), sum([len(game.get_hostile_neighbors(t)) for t in ts]))
+                self.assertEqual(info.get_n_threatened(player), sum([info.is_threatened(t) for t in ts]))
+                self.assertEqual(info.get_n_mobile_armies(player), sum([game.get_number_of_armies(t) - 1 for t in border]))
+                self.assertEqual(info.get_n_mobile_armies(player) + info.get_n_held_back_armies(player),
+                                 sum([game.get_number_of_armies(t) - 1 for t in ts]))
+            game.do_action(rng.choice(game.get_legal_actions()))
+
+    def test_copy_into(self):
+        """Games copied into recycled instances should equal the original and
+        play on independently of it. The original moves on to new dice."""
+        random.seed(3)
+        pool = GamePool()
+        for n_players in [3, 6, 4, 5, 3]:
+            game = RiskGame(n_players)
+            i = 0
+            while not game.has_finished() and i < 1000:
+                if i % 50 == 0:
+                    snapshot = self.game_snapshot(game)
+                    game_copy = pool.copy(game, False)
+                    self.assertEqual(self.game_snapshot(game_copy), snapshot)
+                    self.assertNotEqual(game.get_rng_state(), snapshot[-1])
+                    snapshot = self.game_snapshot(game)
+                    for _ in range(20):
+                        if not game_copy.has_finished():
+                            self.do_random_action(game_copy)
+                    self.assertEqual(self.game_snapshot(game), snapshot)
+                    pool.release(game_copy)
+                self.do_random_action(game)
+                i += 1
+        self.assertEqual(pool.get_n_free_games(), 1)
+
+    def test_vec_engine(self):
+        """A VecRiskGame should play exactly like separate games given the
+        same actions."""
+        n_games = 4
+        rng = np.random.default_rng(1)
+        for n_players in range(3, 7):
+            vec_game = VecRiskGame(n_games, n_players, n_players)
+            games = []
+            for i in range(n_games):
+                games.append(vec_game.get_game(i).copy(False))
+
+            for _ in range(500):
+                masks = vec_game.legal_masks()
+                observations = vec_game.observations()
+                self.assertEqual(observations.shape, (n_games, vec_game.get_observation_size()))
+                for (i, game) in enumerate(games):
+                    self.assertEqual(vec_game.get_game(i).to_tuple(), game.to_tuple())
+                    self.assertTrue((masks[i] == game.get_legal_action_mask()).all())
+                    player = game.get_player_turn()
+                    territories = game.get_all_territories()
+                    self.assertEqual(list(observations[i, :42]), [game.get_number_of_armies(t) for t in territories])
+                    self.assertEqual(list(observations[i, 42:84]), [1 if game.get_owner(t) == player else 0 for t in territories])
+                    self.assertEqual(observations[i, -1], game.get_n_alive_players() / n_players)
+
+                actions = [rng.choice(np.flatnonzero(mask)) for mask in masks]
+                vec_game.step(actions)
+                for (i, game) in enumerate(games):
+                    game.do_action_id(actions[i])
+
+    def test_vec_engine_reset(self):
+        """Finished games should be reported with their winner and reset."""
+        rng = np.random.default_rng(1)
+        vec_game = VecRiskGame(1, 3, 1)
+        game = vec_game.get_game(0)
+        done = False
+        while not done:
+            ids = np.flatnonzero(vec_game.legal_masks()[0])
+            #Always attack and occupy with everything so that the game finishes
+            if game.get_state() == 'attack' and len(ids) > 1:
+                ids = ids[ids != game.encode_action(('pass', 'pass', 0))]
+            elif game.get_state() == 'occupation':
+                ids = ids[-1:]
+            player = game.get_player_turn()
+            (dones, winners) = vec_game.step([rng.choice(ids)])
+            done = dones[0]
+        self.assertEqual(winners[0], player)
+        self.assertEqual(game.get_state(), 'setup')
+        self.assertEqual(game.get_step(), 0)
+        self.assertEqual(game.n_unclaimed_territories(), 42)
+
     def test_setup_statistics(self):
         """Tests the setup phase. Do tests on the statistics of this phase, 
         that all should be as it is supposed to be."""
@@ -376,7 +1041,7 @@ class EngineTest(unittest.TestCase):
         atk_win = []
         
         for _ in range(n):
-            copy_game = game.copy(False)
+            copy_game = game.copy(False, True)
             copy_game.do_action(('indonesia', 'siam', 3))
             x = copy_game.get_number_of_armies('indonesia')
         
@@ -411,7 +1076,7 @@ class EngineTest(unittest.TestCase):
         atk_win = []
         
         for _ in range(n):
-            copy_game = game.copy(False)
+            copy_game = game.copy(False, True)
             copy_game.do_action(('indonesia', 'siam', 3))
             x = copy_game.get_number_of_armies('indonesia')
             if x == 7:
@@ -442,10 +1107,12 @@ class EngineTest(unittest.TestCase):
         for _ in range(6):
             game.do_action('indonesia')
 
+        #The window is narrow, use more samples
+        n = 200000
         atk_win = []
         
         for _ in range(n):
-            copy_game = game.copy(False)
+            copy_game = game.copy(False, True)
             copy_game.do_action(('indonesia', 'siam', 1))
             x = copy_game.get_number_of_armies('indonesia')
             if x == 7:
@@ -455,6 +1122,54 @@ class EngineTest(unittest.TestCase):
         self.assertGreaterEqual(mean_atk_win, 0.41)
         self.assertLessEqual(mean_atk_win, 0.42)
         
+    def test_battle_tables(self):
+        self.assertSequenceEqual([round(p * 7776) for (_, _, p) in get_roll_outcome_probabilities(3, 2)], [2890, 2611, 2275])
+        self.assertSequenceEqual([round(p * 36) for (_, _, p) in get_roll_outcome_probabilities(1, 1)], [15, 21])
+        self.assertAlmostEqual(get_attack_win_probability(4, 1, 3), 855 / 1296)
+        self.assertAlmostEqual(get_attack_win_probability(3, 1, 3), 0)
+        self.assertAlmostEqual(get_attack_win_probability(5, 0, 3), 1)
+        self.assertEqual(get_expected_survivors(5, 0, 2), (5, 0))
+
+        #Resolving attacks should conquer as often as the tables say
+        random.seed(4)
+        game = RiskGame(3, 4)
+        while game.get_state() != 'attack' or len(game.get_legal_actions()) < 10:
+            self.do_random_action(game)
+        action = max(game.get_legal_actions(), key=lambda a: (game.get_number_of_armies(a[0]), a[2]) if a[2] > 0 else (0, 0))
+        n = 20000
+        n_wins = 0
+        atk_survivors = 0
+        for _ in range(n):
+            game_copy = game.copy(False, True)
+            game_copy.resolve_attack(*action)
+            n_wins += 1 if game_copy.get_owner(action[1]) == game.get_player_turn() else 0
+            atk_survivors += game_copy.get_number_of_armies(action[0]) + (game_copy.get_number_of_armies(action[1]) if game_copy.get_state() == 'occupation' else 0)
+        self.assertAlmostEqual(n_wins / n, game.get_attack_win_probability(*action), delta=0.015)
+        (expected_atk, _) = get_expected_survivors(game.get_number_of_armies(action[0]), game.get_number_of_armies(action[1]), action[2])
+        self.assertAlmostEqual(atk_survivors / n, expected_atk, delta=0.1)
+
+    def test_resolve_attack(self):
+        """With determinized battles, resolving an attack should be the same 
+        as repeating it until it is no longer legal."""
+        random.seed(5)
+        for n_players in range(3, 7):
+            game = RiskGame(n_players)
+            game.set_determinization(True)
+            i = 0
+            while not game.has_finished() and i < 1000:
+                if game.get_state() == 'attack':
+                    for action in game.get_legal_actions()[1:]:
+                        resolved = game.copy(True)
+                        resolved.resolve_attack(*action)
+                        repeated = game.copy(True)
+                        while action in repeated.get_legal_actions():
+                            repeated.do_action(action)
+                        self.assertEqual(resolved.to_tuple(), repeated.to_tuple())
+                        self.assertEqual(resolved.get_step(), repeated.get_step())
+                        self.assertEqual(sorted(resolved.get_legal_actions()), sorted(repeated.get_legal_actions()))
+                self.do_random_action(game)
+                i += 1
+
     def test_determinization(self):
         n_players = 3
         game = RiskGame(n_players)
@@ -871,8 +1586,32 @@ class EngineTest(unittest.TestCase):
                                        ('great_britain', 'soldier')])
         game.do_action(('pass', 'pass', 0))
         self.assertEqual(game.get_state(), 'trading')
-        self.assertSequenceEqual(sorted(game.get_legal_actions()), [(('japan', 'horse'), ('venezuela', 'horse'), ('india', 'horse')),
-                                                                     (('ukraine', 'soldier'), ('brazil', 'soldier'), ('great_britain', 'soldier'))])
+        #Every set trades in the whole hand, so only one set is offered
+        self.assertSequenceEqual(game.get_legal_actions(), [(('japan', 'horse'), ('venezuela', 'horse'), ('india', 'horse'))])
+        self.assertEqual(game.get_legal_action_ids(), [game.encode_action(game.get_legal_actions()[0])])
+        
+        #Test the set offered for one of each and for wildcards
+        game = self._setup_trading_game()
+        game.debug_set_player_hand(1, [('japan', 'horse'), ('ukraine', 'soldier'), ('china', 'canon'), ('congo', 'canon')])
+        game.do_action(('pass', 'pass', 0))
+        self.assertSequenceEqual(game.get_legal_actions(), [(('china', 'canon'), ('japan', 'horse'), ('ukraine', 'soldier')), 
+                                                            (('pass', 'pass'), ('pass', 'pass'), ('pass', 'pass'))])
+        game.do_action((('congo', 'canon'), ('japan', 'horse'), ('ukraine', 'soldier')))
+        self.assertEqual(len(game.get_player_hand(1)), 0)
+        
+        game = self._setup_trading_game()
+        game.debug_set_player_hand(1, [('null', 'wildcard'), ('null', 'wildcard'), ('japan', 'horse'), ('ukraine', 'soldier')])
+        game.do_action(('pass', 'pass', 0))
+        self.assertSequenceEqual(game.get_legal_actions()[0], (('japan', 'horse'), ('ukraine', 'soldier'), ('null', 'wildcard')))
+        game.do_action((('null', 'wildcard'), ('null', 'wildcard'), ('japan', 'horse')))
+        self.assertEqual(len(game.get_player_hand(1)), 0)
+        
+        game = self._setup_trading_game()
+        game.debug_set_player_hand(1, [('japan', 'horse'), ('ukraine', 'soldier'), ('china', 'canon'), ('congo', 'canon'), ('venezuela', 'horse')])
+        game.do_action(('pass', 'pass', 0))
+        game.debug_set_player_hand(1, [('japan', 'horse'), ('venezuela', 'horse'), ('congo', 'canon')])
+        game.compute_legal_actions()
+        self.assertSequenceEqual(game.get_legal_actions(), [(('pass', 'pass'), ('pass', 'pass'), ('pass', 'pass'))])
         
         #Test cashing in set with n_sets_deployed = 0
         game = self._setup_trading_game()
@@ -1,18 +1,117 @@
 # cython: boundscheck=False, wraparound=False, initializedcheck=False, cdivision=True, language_level=3, profile=False
 
-from engine import RiskGame
+from engine cimport RiskGame, mask_t, popcount, lowest_bit, MAX_TERRITORIES, MAX_PLAYERS
+from engine import REDUCED_ACTIONS
 import math
+import numpy as np
+
+cdef class BorderInfo:
+    """Border analysis of a whole board, computed once per state. For every
+    territory: whether it has a hostile neighbor, how many it has and how many
+    armies they could attack it with. For every player: the sums of these
+    over their territories. It is a snapshot, so build a new one after the
+    game changes."""
+    cdef RiskGame game
+    cdef mask_t border_mask, threatened_mask
+    cdef int n_hostile_neighbors[MAX_TERRITORIES]
+    cdef int threatening_armies[MAX_TERRITORIES]
+    cdef int n_border_territories[MAX_PLAYERS]
+    cdef int n_links[MAX_PLAYERS]
+    cdef int n_threatened[MAX_PLAYERS]
+    cdef int n_mobile_armies[MAX_PLAYERS]
+    cdef int n_held_back_armies[MAX_PLAYERS]
+
+    def __init__(self, RiskGame game):
+        cdef int t, player, n
+        cdef mask_t hostile, bit
+
+        self.game = game
+        self.border_mask = 0
+        self.threatened_mask = 0
+        for player in range(MAX_PLAYERS):
+            self.n_border_territories[player] = 0
+            self.n_links[player] = 0
+            self.n_threatened[player] = 0
+            self.n_mobile_armies[player] = 0
+            self.n_held_back_armies[player] = 0
+
+        for t in range(game.n_territories):
+            bit = (<mask_t>1) << t
+            hostile = game._hostile_neighbor_mask(t)
+            self.n_hostile_neighbors[t] = popcount(hostile)
+            n = 0
+            while hostile:
+                n += game.armies[lowest_bit(hostile)] - 1
+                hostile &= hostile - 1
+            self.threatening_armies[t] = n
+            if self.n_hostile_neighbors[t]:
+                self.border_mask |= bit
+            if n > game.armies[t] * 0.8:
+                self.threatened_mask |= bit
+
+            player = game.owners[t]
+            if player == -1:
+                continue
+            self.n_links[player] += self.n_hostile_neighbors[t]
+            if self.border_mask & bit:
+                self.n_border_territories[player] += 1
+                self.n_mobile_armies[player] += game.armies[t] - 1
+            else:
+                self.n_held_back_armies[player] += game.armies[t] - 1
+            if self.threatened_mask & bit:
+                self.n_threatened[player] += 1
+
+    cdef inline bint _is_border(self, int t) noexcept:
+        return (self.border_mask >> t) & 1
+
+    cpdef bint is_border(self, str t):
+        return self._is_border(self.game._tid(t))
+
+    cpdef int get_n_hostile_neighbors(self, str t):
+        return self.n_hostile_neighbors[self.game._tid(t)]
+
+    cpdef int get_threatening_armies(self, str t):
+        return self.threatening_armies[self.game._tid(t)]
+
+    cpdef bint is_threatened(self, str t):
+        return (self.threatened_mask >> self.game._tid(t)) & 1
+
+    cpdef list get_border_territories(self, int player):
+        return self.game._mask_to_names(self.game._owner_mask(player) & self.border_mask)
+
+    cpdef int get_n_border_territories(self, int player):
+        return self.n_border_territories[player]
+
+    cpdef int get_n_links(self, int player):
+        return self.n_links[player]
+
+    cpdef int get_n_threatened(self, int player):
+        return self.n_threatened[player]
+
+    cpdef int get_n_mobile_armies(self, int player):
+        return self.n_mobile_armies[player]
+
+    cpdef int get_n_held_back_armies(self, int player):
+        return self.n_held_back_armies[player]
 
 def get_projected_n_armies(game: RiskGame, player: int, n_turns: float):
     armies = game.get_n_player_armies(player)
     card_armies = len(game.get_player_hand(player)) * 0.33 * game.get_n_reinforcements_for_set()
     armies_per_turn = game.get_n_reinforcements_for_set() * 0.33 + game.get_reinforcement_amount(player)
-    
+
     armies += card_armies + armies_per_turn * n_turns
     return armies
 
+def evaluate_all_players(RiskGame game, double n_turns):
+    """Returns get_projected_n_armies of every player as a float64 array,
+    computed in one pass over the engine's running totals."""
+    projected = np.empty(game.n_players)
+    cdef double[::1] view = projected
+    game._evaluate_all_players(n_turns, &view[0])
+    return projected
+
 def get_border_territories(game: RiskGame, player: int):
-    return [t for t in game.get_player_territories(player) if is_border_territory(game, t)]
+    return BorderInfo(game).get_border_territories(player)
 
 def is_border_territory(game: RiskGame, t: str):
     return game.has_hostile_neighbor(t)
@@ -20,8 +119,9 @@ def is_border_territory(game: RiskGame, t: str):
 def get_attacks_above_threshold(legal_actions: list, threshold=3):
     return [action for action in legal_actions if action[2] >= threshold or action[2] == 0]
 
-def get_reasonable_attacks(game: RiskGame, legal_actions: list):
-    return [action for action in legal_actions if action[2] == 0 or ((game.get_number_of_armies(action[0]) - 1) > game.get_number_of_armies(action[1]))]
+def get_reasonable_attacks(RiskGame game, list legal_actions):
+    cdef tuple action
+    return [action for action in legal_actions if action[2] == 0 or ((game.armies[game._tid(action[0])] - 1) > game.armies[game._tid(action[1])])]
 
 def get_highest_moves(legal_actions: list):
     ter_pairs = set([(action[0], action[1]) for action in legal_actions])
@@ -30,28 +130,35 @@ def get_highest_moves(legal_actions: list):
         highest[(t1, t2)] = max(highest[(t1, t2)], x)
     return [action for action in legal_actions if action[2] == highest[(action[0], action[1])] or action[2] == 0]
 
-def get_border_fortify_moves(game: RiskGame):
-    legal_actions = [action for action in game.get_legal_actions() if action[2] == 0 or (is_border_territory(game, action[1]) and not is_border_territory(game, action[0]))]
-    return legal_actions
+def get_border_fortify_moves(RiskGame game, BorderInfo info=None):
+    cdef tuple action
+    if info is None:
+        info = BorderInfo(game)
+    return [action for action in game.get_legal_actions() if action[2] == 0 or (info._is_border(game._tid(action[1])) and not info._is_border(game._tid(action[0])))]
 
-def get_highest_border_fortify_moves(game: RiskGame):
-    return get_highest_moves(get_border_fortify_moves(game))
+def get_highest_border_fortify_moves(RiskGame game, BorderInfo info=None):
+    return get_highest_moves(get_border_fortify_moves(game, info))
 
-def get_border_reinforce_moves(game: RiskGame):
-    return [action for action in game.get_legal_actions() if is_border_territory(game, action)]
+def get_border_reinforce_moves(RiskGame game, BorderInfo info=None):
+    cdef str action
+    if info is None:
+        info = BorderInfo(game)
+    return [action for action in game.get_legal_actions() if info._is_border(game._tid(action))]
 
-def get_border_occupy_moves(game: RiskGame):
-    from_ter_is_border = is_border_territory(game, game.get_occupy_from_ter())
-    to_ter_is_border = is_border_territory(game, game.get_occupy_to_ter())
+def get_border_occupy_moves(RiskGame game, BorderInfo info=None):
+    if info is None:
+        info = BorderInfo(game)
+    from_ter_is_border = info._is_border(game.occupation_from_ter)
+    to_ter_is_border = info._is_border(game.occupation_to_ter)
     legal_actions = game.get_legal_actions()
 
-    if (from_ter_is_border and to_ter_is_border) or (not from_ter_is_border and not to_ter_is_border):
+    if from_ter_is_border == to_ter_is_border:
         return legal_actions
     elif from_ter_is_border and not to_ter_is_border:
         return [min(legal_actions)]
     else:
         return [max(legal_actions)]
-    
+
 def get_border_high_low_moves(game: RiskGame):
     legal_actions = game.get_legal_actions()
     if len(legal_actions) == 1:
@@ -66,21 +173,9 @@ def eliminate_pass(game, legal_actions):
                                                                                      ('pass', 'pass', 0)]]
     if len(new_legal_actions) == 0:
         new_legal_actions = legal_actions
-    
+
     return new_legal_actions
 
 def get_reduced_actions(game: RiskGame):
-    state = game.get_state()
-    legal_actions = game.get_legal_actions()
-    if state in ['reinforcement', 'setup_deployment']:
-        return get_border_reinforce_moves(game)
-    elif state == 'trading':
-        return legal_actions
-    elif state == 'attack':
-        return get_reasonable_attacks(game, get_attacks_above_threshold(legal_actions, 3))
-    elif state == 'fortify':
-        return get_border_fortify_moves(game)
-    elif state == 'occupy':
-        return get_border_high_low_moves(game)
-    else:
-        return legal_actions
\ No newline at end of file
+    #Generated in the engine, the same as filtering with the functions above
+    return game.get_pruned_actions(REDUCED_ACTIONS)
@@ -94,16 +94,12 @@ class NeuralAgent(BaseAgent):
         else:
             actions = self.get_actions()
             best_action = None
-            states = []
+            (states, winners) = self.game.peek_observations(actions, True)
             
-            for action in actions:
-                game = self.game.copy(True)
-                self.do_actions_to_game(action, game)
-                if game.has_finished() and game.get_winner() == self.game.get_player_turn():
+            for (action, winner) in zip(actions, winners):
+                if winner == self.game.get_player_turn():
                     return action
-                states.append(get_state_2(game))
                 
-            states = tf.concat(states, 0)
             scores = self.model(states, training=False)
     
             best_action = actions[tf.argmax(scores, 0)[0]]
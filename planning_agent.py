@@ -1,9 +1,9 @@
+from engine import GamePool
 from neural_network import get_model
 from ai_helper import get_state_2
 import agent
 import collections
 import helper_functions as hf
-import random
 import tensorflow as tf
 import time
 
@@ -15,6 +15,7 @@ class MonteCarloPlanningAgent(agent.BaseAgent):
         self.n_simulations_per_plan = n_simulations
         self.plan = collections.deque([])
         self.better_agent = agent.BetterAgent()
+        self.pool = GamePool()
     
     def set_game(self, game):
         super().set_game(game)
@@ -43,15 +44,12 @@ class MonteCarloPlanningAgent(agent.BaseAgent):
         if game.has_finished():
             return 100 if game.get_winner() == player else -100
         else:
-            return game.get_n_player_armies(player) / game.get_total_armies_on_board()
+            projected = hf.evaluate_all_players(game, 0)
+            return projected[player] / max(1, projected.sum())
     
     def simulate(self, step, game):
-        _agent = agent.BetterAgent()
-        _agent.set_game(game)
-        
-        while not game.has_finished() and step < self.n_steps:
-            _agent.do_actions_to_game(_agent.get_action(), game)
-            step += 1
+        #Plays BetterAgent in the engine
+        game.rollout('better', max(self.n_steps - step, 0), self.rng.getrandbits(64))
         return game
         
     def make_plan(self, game):
@@ -63,9 +61,9 @@ class MonteCarloPlanningAgent(agent.BaseAgent):
             self.better_agent.set_game(game)
             state = game.get_state()
             if not state in ['reinforcement', 'setup_deployment']:
-                action = random.choice(hf.get_reduced_actions(game))
+                action = self.rng.choice(hf.get_reduced_actions(game))
             else:                
-                action = random.choice(self.better_agent.get_actions())
+                action = self.rng.choice(self.better_agent.get_actions())
             plan.append(action)
             self.do_actions_to_game(action, game)
             step += 1
@@ -76,14 +74,16 @@ class MonteCarloPlanningAgent(agent.BaseAgent):
         best_plan = collections.deque([])
         player = self.game.get_player_turn()
         for _ in range(self.n_plans):
-            game_copy = self.game.copy(True)
+            game_copy = self.pool.copy(self.game, True)
             (game_copy, step, plan) = self.make_plan(game_copy)
             score = 0
             
             for _ in range(self.n_simulations_per_plan):
-                game_copy_copy = game_copy.copy(True)
+                game_copy_copy = self.pool.copy(game_copy, True)
                 game_copy_copy = self.simulate(step, game_copy_copy)            
                 score += self.heuristic(player, game_copy_copy)
+                self.pool.release(game_copy_copy)
+            self.pool.release(game_copy)
             
             if score > best_score:
                 best_score = score
@@ -2,5 +2,5 @@ from setuptools import setup
 from Cython.Build import cythonize
 
 setup(
-    ext_modules = cythonize(["engine.pyx", "cards.pyx", "RiskMap.pyx", "helper_functions.pyx"], annotate=True)
+    ext_modules = cythonize(["engine.pyx", "vec_engine.pyx", "cards.pyx", "RiskMap.pyx", "helper_functions.pyx"], annotate=True)
 )
\ No newline at end of file
@@ -0,0 +1,126 @@
+# cython: boundscheck=False, wraparound=False, initializedcheck=False, cdivision=True, language_level=3, profile=False
+
+from engine cimport RiskGame, PHASE_GAME_END, splitmix64
+from libc.stdlib cimport malloc, free
+import numpy as np
+import random
+
+cdef class VecRiskGame:
+    """Steps a batch of games in lockstep through integer action ids, see
+    RiskGame.encode_action. The rules are those of RiskGame, every game of
+    the batch is one. A game that finishes is reset to a new game right away,
+    step reports which games finished and who won them. Every new game gets
+    its own seed, drawn from the seed of the batch."""
+    cdef int n_games, n_players, n_actions, n_territories, n_continents, observation_size
+    cdef list games
+    cdef RiskGame fresh_game
+    cdef int *legal_ids
+    cdef unsigned long long seed_state
+
+    def __cinit__(self):
+        self.legal_ids = NULL
+
+    def __init__(self, int n_games, int n_players, seed=None, map_file=None):
+        cdef int i
+        assert n_games >= 1
+        self.seed_state = random.getrandbits(64) if seed is None else seed
+        self.n_games = n_games
+        self.n_players = n_players
+        #Fresh games are copied from this game, so the map is only built once
+        self.fresh_game = RiskGame(n_players, 0, map_file)
+        self.n_actions = self.fresh_game.n_actions
+        self.n_territories = self.fresh_game.n_territories
+        self.n_continents = self.fresh_game.n_continents
+        self.observation_size = self.fresh_game.get_observation_size()
+        self.legal_ids = <int *> malloc(self.n_actions * sizeof(int))
+        if self.legal_ids == NULL:
+            raise MemoryError()
+        self.games = [RiskGame.__new__(RiskGame) for _ in range(n_games)]
+        for i in range(n_games):
+            self._reset_game(i)
+
+    def __dealloc__(self):
+        free(self.legal_ids)
+
+    cdef void _reset_game(self, int i):
+        cdef RiskGame game = self.games[i]
+        self.fresh_game.copy_into(game, False)
+        game.seed(splitmix64(&self.seed_state))
+        game.make_new_deck()
+
+    cpdef void reset(self):
+        cdef int i
+        for i in range(self.n_games):
+            self._reset_game(i)
+
+    def step(self, actions):
+        """Does actions[i] in game i. Returns a bool array of the games that
+        finished, which are reset already, and an int array with their
+        winners (-1 for games that did not finish)."""
+        cdef int i
+        cdef RiskGame game
+        cdef int[::1] action_ids = np.ascontiguousarray(actions, dtype=np.intc)
+        assert action_ids.shape[0] == self.n_games
+
+        dones = np.zeros(self.n_games, dtype=np.bool_)
+        winners = np.full(self.n_games, -1, dtype=np.intc)
+        cdef unsigned char[::1] dones_view = dones.view(np.uint8)
+        cdef int[::1] winners_view = winners
+
+        for i in range(self.n_games):
+            game = self.games[i]
+            game.do_action_id(action_ids[i])
+            if game.phase == PHASE_GAME_END:
+                dones_view[i] = 1
+                winners_view[i] = game.winner
+                self._reset_game(i)
+        return (dones, winners)
+
+    def legal_masks(self):
+        """Returns an (n_games, n_actions) bool array of the legal action ids."""
+        cdef int i, j, n
+        cdef RiskGame game
+        masks = np.zeros((self.n_games, self.n_actions), dtype=np.bool_)
+        cdef unsigned char[:, ::1] masks_view = masks.view(np.uint8)
+
+        for i in range(self.n_games):
+            game = self.games[i]
+            n = game._legal_action_ids(self.legal_ids)
+            for j in range(n):
+                masks_view[i, self.legal_ids[j]] = 1
+        return masks
+
+    def observations(self):
+        """Returns an (n_games, observation_size) float32 array with, as seen
+        by the player to move, the same features as ai_helper.get_state_2:
+        the armies on each territory, which territories the player owns, the
+        armies to deploy, which continents the player holds, the game phase,
+        the number of cards in hand, the number of sets traded in, whether a
+        territory was taken this turn and the proportion of alive players."""
+        cdef int i
+        observations = np.zeros((self.n_games, self.observation_size), dtype=np.float32)
+        cdef float[:, ::1] obs = observations
+
+        for i in range(self.n_games):
+            (<RiskGame> self.games[i])._write_observation(&obs[i, 0])
+        return observations
+
+    def current_players(self):
+        cdef int i
+        players = np.zeros(self.n_games, dtype=np.intc)
+        cdef int[::1] players_view = players
+        for i in range(self.n_games):
+            players_view[i] = (<RiskGame> self.games[i]).player_turn
+        return players
+
+    cpdef RiskGame get_game(self, int i):
+        return self.games[i]
+
+    cpdef int get_n_games(self):
+        return self.n_games
+
+    cpdef int get_n_actions(self):
+        return self.n_actions
+
+    cpdef int get_observation_size(self):
+        return self.observation_size